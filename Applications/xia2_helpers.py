@@ -2,6 +2,7 @@
 
 import os
 import shutil
+import time
 
 # Needed to make xia2 imports work correctly
 import libtbx.load_env
@@ -54,6 +55,7 @@ def process_one_sweep(args):
   output = None
   success = False
   xsweep_dict = None
+  start_time = time.time()
 
   try:
     xia2_integrate.run()
@@ -97,7 +99,186 @@ def process_one_sweep(args):
     if os.path.exists(tmpdir):
       shutil.rmtree(tmpdir, ignore_errors=True)
     DriverFactory.set_driver_type(default_driver_type)
-    return success, output, xsweep_dict
+    return success, output, xsweep_dict, time.time() - start_time
+
+# sweeps to be processed by process_one_sweep_in_process, keyed by
+# (crystal_id, wavelength_id, sweep_id) - this is populated before the
+# worker processes are forked so that they inherit the full project
+
+_sweeps = { }
+
+def register_sweeps(crystals):
+  '''Make the sweeps of the named crystals available to worker processes
+  started after this call.'''
+
+  _sweeps.clear()
+  for crystal_id in crystals.keys():
+    for wavelength_id in crystals[crystal_id].get_wavelength_names():
+      wavelength = crystals[crystal_id].get_xwavelength(wavelength_id)
+      for sweep in wavelength.get_sweeps():
+        _sweeps[(crystal_id, wavelength_id, sweep.get_name())] = sweep
+
+def update_sweep(sweep, xsweep_dict):
+  '''Update sweep with the serialized indexer, refiner and integrater from
+  processing it elsewhere.'''
+
+  from xia2.Schema.XSweep import XSweep
+  new_sweep = XSweep.from_dict(xsweep_dict)
+  sweep._indexer = new_sweep._indexer
+  sweep._refiner = new_sweep._refiner
+  sweep._integrater = new_sweep._integrater
+
+def process_one_sweep_in_process(args):
+  '''As process_one_sweep, but index, refine and integrate the sweep
+  directly in this (worker) process, which inherits the project and the
+  PHIL parameters from the parent, rather than by running xia2.integrate.
+  The sweep keeps the working directories of serial processing so no
+  paths need rewriting afterwards.'''
+
+  assert len(args) == 1
+  args = args[0]
+
+  from xia2.Driver.DriverFactory import DriverFactory
+  default_driver_type = DriverFactory.get_driver_type()
+  DriverFactory.set_driver_type(args.driver_type)
+
+  sweep = _sweeps[(args.crystal_id, args.wavelength_id, args.sweep_id)]
+
+  success = False
+  xsweep_dict = None
+  start_time = time.time()
+
+  # collect the output here and hand it back, to be written in one piece
+  Chatter.cache()
+
+  try:
+    if args.stop_after == 'index':
+      sweep.get_indexer_cell()
+    else:
+      sweep.get_integrater_intensities()
+    sweep.serialize()
+    xsweep_dict = sweep.to_dict()
+    success = True
+  except Exception as e:
+    if args.failover:
+      Chatter.write('Processing sweep %s failed: %s' % \
+                    (args.sweep_id, str(e)))
+    else:
+      raise
+  finally:
+    output = '\n'.join(Chatter.discard_cache())
+    DriverFactory.set_driver_type(default_driver_type)
+
+  return success, output, xsweep_dict, time.time() - start_time
+
+def check_one_sweep_symmetry(args, result):
+  '''Follow process_one_sweep_in_process with the per-sweep pointgroup
+  analysis which the scaler would otherwise make, and record it with the
+  integrater for the scaler to use. If this finds a different lattice the
+  sweep is reprocessed here, in parallel with the other sweeps, rather
+  than in the scaler. Returns result updated to match.'''
+
+  assert len(args) == 1
+  args = args[0]
+
+  success, output, xsweep_dict, duration = result
+  if not success:
+    return result
+
+  from xia2.Driver.DriverFactory import DriverFactory
+  from xia2.Modules.Scaler.CCP4ScalerHelpers import \
+    CCP4ScalerHelper, _prepare_pointless_hklin
+  default_driver_type = DriverFactory.get_driver_type()
+  DriverFactory.set_driver_type(args.driver_type)
+
+  # this worker need not be the one which integrated the sweep
+  sweep = _sweeps[(args.crystal_id, args.wavelength_id, args.sweep_id)]
+  update_sweep(sweep, xsweep_dict)
+
+  start_time = time.time()
+  Chatter.cache()
+
+  try:
+    intgr = sweep._get_integrater()
+    working_directory = intgr.get_working_directory()
+    helper = CCP4ScalerHelper()
+    helper.set_working_directory(working_directory)
+
+    # analyse the sweep as reprocessed, if it needs to be, but only
+    # reprocess once here: any further changes are left to the scaler
+    for attempt in range(2):
+      hklin = intgr.get_integrater_intensities()
+      pointless_hklin = _prepare_pointless_hklin(
+        working_directory, hklin, intgr.get_phi_width())
+      pointgroup, reindex_op, need_to_return, probably_twinned = \
+        helper.pointless_indexer_jiffy(
+          pointless_hklin, intgr.get_integrater_refiner())
+
+      if not need_to_return:
+        intgr.set_integrater_pointgroup_analysis(
+          hklin, pointgroup, reindex_op, probably_twinned)
+        break
+
+      if attempt == 0:
+        Debug.write('Reprocessing sweep %s in %s' % \
+                    (args.sweep_id, intgr.get_integrater_refiner(
+                    ).get_refiner_lattice()))
+        intgr.integrater_reset_reindex_operator()
+        sweep.get_integrater_intensities()
+
+    sweep.serialize()
+    xsweep_dict = sweep.to_dict()
+  except Exception as e:
+    if args.failover:
+      # the scaler will make this analysis instead
+      Chatter.write('Pointgroup analysis of sweep %s failed: %s' % \
+                    (args.sweep_id, str(e)))
+    else:
+      raise
+  finally:
+    output = '\n'.join([output] + Chatter.discard_cache())
+    DriverFactory.set_driver_type(default_driver_type)
+
+  return success, output, xsweep_dict, duration + time.time() - start_time
+
+def schedule_sweeps(crystals, args, njob):
+  '''Process the sweeps described by args as process_one_sweep_in_process,
+  in a pool of njob workers. As soon as each sweep is integrated its
+  pointgroup analysis is started, overlapping with the integration of
+  the remaining sweeps. Returns the results in the order of args.'''
+
+  from xia2.Handlers.Phil import PhilIndex
+  from xia2.Modules.TaskScheduler import TaskScheduler
+
+  register_sweeps(crystals)
+
+  # the analysis is that of the CCP4 scaler, which takes it from the
+  # integrater rather than repeating it
+  settings = PhilIndex.params.xia2.settings
+  check_symmetry = settings.space_group is None and \
+    settings.multi_sweep_indexing != True and settings.scaler == 'ccp4a'
+
+  scheduler = TaskScheduler(njob)
+  tasks = []
+
+  for arg in args:
+    sweep_id = (arg[0].crystal_id, arg[0].wavelength_id, arg[0].sweep_id)
+    task = ('integrate',) + sweep_id
+    scheduler.add_task(task, process_one_sweep_in_process, (arg,))
+    if check_symmetry and arg[0].stop_after != 'index':
+      scheduler.add_task(('symmetry',) + sweep_id, check_one_sweep_symmetry,
+                         (arg,), depends=(task,))
+      task = ('symmetry',) + sweep_id
+    tasks.append(task)
+
+  scheduler.run()
+
+  for task in tasks:
+    if task in scheduler.errors:
+      raise RuntimeError('Processing sweep %s failed:\n%s' % \
+                         (task[-1], scheduler.errors[task]))
+
+  return [scheduler.results[task] for task in tasks]
 
 def get_sweep_output_only(all_output):
   sweep_lines = []
@@ -14,6 +14,7 @@
 from __future__ import absolute_import, division, print_function
 
 import collections
+import json
 import os
 import sys
 import time
@@ -115,6 +116,17 @@ def get_template(f):
 
   global target_template
 
+  template = _get_template(f)
+
+  if template and target_template:
+    if template not in target_template:
+      return
+
+  return template
+
+def _get_template(f):
+  '''The template for image f, whether or not it is a target template.'''
+
   if not is_image_name(f):
     return
 
@@ -133,10 +145,6 @@ def get_template(f):
     template, directory = image2template_directory(f)
     template = os.path.join(directory, template)
 
-    if target_template:
-      if template not in target_template:
-        return
-
   except Exception as e:
     Debug.write('Exception A: %s (%s)' % (str(e), f))
     Debug.write(traceback.format_exc())
@@ -169,42 +177,232 @@ def parse_sequence(sequence_file):
   global latest_sequence
   latest_sequence = sequence
 
-def visit(root, directory, files):
-  files.sort()
+class ImageScanCache(object):
+  '''A persistent record of what was found in each file by a previous
+  scan for images, valid for as long as the file keeps the same
+  modification time and size - so that repeating setup on the same
+  directories needs only to stat the files - and of the sweeps read from
+  the images of each template, valid for as long as all of those images
+  are unchanged and read with the same settings.
+
+  Entries for files which no longer exist are dropped when the cache is
+  saved, and the caches kept for each directory (by for_directory) which
+  have not been used for max_age seconds are removed, along with the
+  least recently used beyond the max_files most recent.'''
+
+  max_age = 30 * 24 * 3600
+  max_files = 100
+
+  def __init__(self, filename):
+    self._filename = filename
+    self._entries = { }
+    self._sweeps = { }
+    self._seen = set()
+    self._changed = False
+
+    if os.path.exists(filename):
+      try:
+        with open(filename, 'r') as fh:
+          cached = json.load(fh)
+        self._entries = cached['files']
+        self._sweeps = cached['sweeps']
+      except (ValueError, KeyError, TypeError):
+        Debug.write('Ignoring unreadable image scan cache %s' % filename)
+        self._entries = { }
+        self._sweeps = { }
+
+  @staticmethod
+  def for_directory(directory):
+    '''The cache for the images under directory, kept with the user's
+    cache files ($XDG_CACHE_HOME/xia2 or ~/.cache/xia2) and named after
+    the real path of the directory, wherever xia2 is run from.'''
+
+    import hashlib
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+      os.path.join(os.path.expanduser('~'), '.cache')
+    key = hashlib.sha1(
+      os.path.realpath(directory).encode('utf-8')).hexdigest()
+    return ImageScanCache(os.path.join(
+      cache_home, 'xia2', 'image-scan', '%s.json' % key))
+
+  def get(self, path, stat):
+    self._seen.add(path)
+    entry = self._entries.get(path)
+    if entry and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+      return entry[2], entry[3]
+
+  def set(self, path, stat, kind, value):
+    self._seen.add(path)
+    self._entries[path] = [stat.st_mtime, stat.st_size, kind, value]
+    self._changed = True
+
+  def get_sweeps(self, template, key):
+    '''The sweeps stored for template, if they were stored with the same
+    key (see sweep_cache_key).'''
+
+    self._seen.add(template)
+    entry = self._sweeps.get(template)
+    if entry and entry[0] == key:
+      return entry[1]
+
+  def set_sweeps(self, template, key, value):
+    self._seen.add(template)
+    self._sweeps[template] = [key, value]
+    self._changed = True
+
+  def _prune(self):
+    '''Drop the entries for files, and the sweeps of templates with image
+    files, which no longer exist - looking only at those which were not
+    used in this scan.'''
+
+    for path in [p for p in self._entries if p not in self._seen]:
+      if not os.path.exists(path):
+        del self._entries[path]
+        self._changed = True
+
+    for template, (key, value) in list(self._sweeps.items()):
+      if template in self._seen:
+        continue
+      if not all(os.path.exists(path) for path, mtime, size in key[1]):
+        del self._sweeps[template]
+        self._changed = True
+
+  def save(self):
+    self._prune()
+    if not self._changed:
+      # record that the cache was used, so that it is not evicted
+      try:
+        os.utime(self._filename, None)
+      except OSError:
+        pass
+      return
+    tmp = '%s.%d.tmp' % (self._filename, os.getpid())
+    try:
+      directory = os.path.dirname(self._filename)
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+      with open(tmp, 'w') as fh:
+        json.dump({'files': self._entries, 'sweeps': self._sweeps}, fh)
+      os.rename(tmp, self._filename)
+    except (IOError, OSError) as e:
+      # the cache only saves time: never fail setup for want of it
+      Debug.write('Could not save image scan cache %s: %s' %
+                  (self._filename, str(e)))
+      return
+    self._changed = False
+    ImageScanCache.evict(directory)
+
+  @staticmethod
+  def evict(directory):
+    '''Remove the caches made by for_directory in directory which were
+    last used more than max_age seconds ago, or are older than the
+    max_files most recently used.'''
+
+    import re
+    caches = []
+    try:
+      for name in os.listdir(directory):
+        if re.match(r'^[0-9a-f]{40}\.json$', name):
+          path = os.path.join(directory, name)
+          caches.append((os.stat(path).st_mtime, path))
+    except OSError:
+      return
+
+    caches.sort(reverse=True)
+    oldest = time.time() - ImageScanCache.max_age
+    for j, (mtime, path) in enumerate(caches):
+      if j >= ImageScanCache.max_files or mtime < oldest:
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+
+def classify_file(full_path):
+  '''Decide what full_path is: returns ('hdf5', full_path) for a usable
+  HDF5 master file, ('template', template) for an image, ('sequence',
+  full_path) for a sequence file or (None, None) for anything else.'''
+
+  if is_hd5f_name(full_path):
+    from dxtbx.format.Registry import Registry
+
+    format_class = Registry.find(full_path)
+    if format_class is None:
+      Debug.write(
+        'Ignoring %s (Registry can not find format class)' % full_path)
+    elif not format_class.ignore():
+      return 'hdf5', full_path
+
+  elif is_image_name(full_path):
+    try:
+      template = _get_template(full_path)
+    except Exception as e:
+      Debug.write('Exception B: %s' % str(e))
+      Debug.write(traceback.format_exc())
+      return None, None
+    if template is not None:
+      return 'template', template
 
-  templates = set()
+  elif is_sequence_name(full_path):
+    return 'sequence', full_path
 
-  for f in files:
+  return None, None
 
-    full_path = os.path.join(directory, f)
+def _classify_file(args):
+  full_path, cache = args
 
-    if is_hd5f_name(full_path):
-      from dxtbx.format.Registry import Registry
+  try:
+    stat = os.stat(full_path)
+  except OSError:
+    return None, None
+
+  if cache is not None:
+    result = cache.get(full_path, stat)
+    if result is not None:
+      return result
+
+  kind, value = classify_file(full_path)
+  if cache is not None:
+    cache.set(full_path, stat, kind, value)
+  return kind, value
+
+def scan_files(paths, cache=None, nproc=1):
+  '''Classify the files in paths with up to nproc threads (the work is
+  mostly waiting on the file system), using and updating cache. Returns
+  the templates and HDF5 master files found; any sequence files are
+  parsed in the order given.'''
+
+  args = [(path, cache) for path in paths]
+  if nproc > 1 and len(paths) > 1:
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(nproc)
+    try:
+      results = pool.map(_classify_file, args, chunksize=64)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = [_classify_file(arg) for arg in args]
 
-      format_class = Registry.find(full_path)
-      if format_class is None:
-        Debug.write(
-          'Ignoring %s (Registry can not find format class)' % full_path)
-        continue
-      elif format_class.ignore():
-        continue
-      templates.add(full_path)
+  templates = set()
 
-    elif is_image_name(full_path):
-      try:
-        template = get_template(full_path)
-      except Exception as e:
-        Debug.write('Exception B: %s' % str(e))
-        Debug.write(traceback.format_exc())
+  for kind, value in results:
+    if kind == 'hdf5':
+      templates.add(value)
+    elif kind == 'template':
+      if target_template and value not in target_template:
         continue
-      if template is not None:
-        templates.add(template)
-
-    elif is_sequence_name(full_path):
-      parse_sequence(full_path)
+      templates.add(value)
+    elif kind == 'sequence':
+      parse_sequence(value)
 
   return templates
 
+def visit(root, directory, files, cache=None, nproc=1):
+  files.sort()
+
+  return scan_files(
+    [os.path.join(directory, f) for f in files], cache=cache, nproc=nproc)
+
 def print_sweeps(out=sys.stdout):
 
   global known_sweeps, latest_sequence
@@ -431,6 +629,56 @@ def print_sweeps(out=sys.stdout):
   out.write('END CRYSTAL %s\n' % crystal)
   out.write('END PROJECT %s\n' % project)
 
+def image_settings():
+  '''The settings which the sweeps read from the images depend on.'''
+
+  params = PhilIndex.get_python_object()
+  settings = PhilIndex.master_phil.format(python_object=params).get(
+    'xia2.settings.input').as_str()
+  return '%s\nread_all_image_headers = %s' % (
+    settings, params.xia2.settings.read_all_image_headers)
+
+def sweep_cache_key(template, settings):
+  '''What the sweeps read for template depend on: the settings for reading
+  images, and the path, modification time and size of each of its image
+  files (or of the HDF5 master file). None if there are no such files.'''
+
+  if os.path.splitext(template)[-1] in known_hdf5_extensions:
+    paths = [template]
+  else:
+    from dxtbx.sweep_filenames import locate_files_matching_template_string
+    paths = sorted(locate_files_matching_template_string(template))
+
+  files = []
+  for path in paths:
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+    files.append([path, stat.st_mtime, stat.st_size])
+  if not files:
+    return None
+  return [settings, files]
+
+def sweeps_as_dict(sweeplist):
+  '''The imagesets of the sweeps as a (JSON) datablock dictionary.'''
+
+  from dxtbx.datablock import DataBlock
+  return DataBlock([sweep.get_imageset() for sweep in sweeplist]).to_dict()
+
+def sweeps_from_dict(template, obj):
+  '''The sweeps of template from the datablock dictionary of their
+  imagesets, as made by sweeps_as_dict.'''
+
+  from dxtbx.datablock import DataBlockFactory
+  from xia2.Schema.Sweep import Sweep
+
+  directory, template = os.path.split(template)
+  imagesets = DataBlockFactory.from_dict(obj)[0].extract_sweeps()
+  return [Sweep(template, directory, imageset=imageset,
+                id_image=imageset.get_scan().get_image_range()[0])
+          for imageset in imagesets]
+
 def get_sweeps(templates):
   global known_sweeps
 
@@ -440,6 +688,25 @@ def get_sweeps(templates):
   mp_params = params.xia2.settings.multiprocessing
   nproc = mp_params.nproc
 
+  # the sweeps of any templates with unchanged images, as read before, are
+  # in the image scan cache for their directory
+
+  templates = list(templates)
+  settings = image_settings()
+  caches = { }
+  keys = { }
+  sweeps = { }
+  for template in templates:
+    directory = os.path.dirname(template)
+    if directory not in caches:
+      caches[directory] = ImageScanCache.for_directory(directory)
+    keys[template] = sweep_cache_key(template, settings)
+    if keys[template] is not None:
+      cached = caches[directory].get_sweeps(template, keys[template])
+      if cached is not None:
+        sweeps[template] = sweeps_from_dict(template, cached)
+  to_read = [template for template in templates if template not in sweeps]
+
   if params.xia2.settings.read_all_image_headers and nproc > 1:
     method = "multiprocessing"
 
@@ -449,7 +716,7 @@ def get_sweeps(templates):
     python_path = 'PYTHONPATH="%s"' % ":".join(sys.path)
     qsub_command = "qsub -v %s -V" % python_path
 
-    args = [(template, ) for template in templates]
+    args = [(template, ) for template in to_read]
     results_list = easy_mp.parallel_map(
       get_sweep, args,
       processes=nproc,
@@ -460,11 +727,20 @@ def get_sweeps(templates):
       preserve_exception_message=True)
 
   else:
-    results_list = [get_sweep((template,)) for template in templates]
+    results_list = [get_sweep((template,)) for template in to_read]
+
+  for template, sweeplist in zip(to_read, results_list):
+    sweeps[template] = sweeplist
+    if sweeplist and keys[template] is not None:
+      caches[os.path.dirname(template)].set_sweeps(
+        template, keys[template], sweeps_as_dict(sweeplist))
+  for cache in caches.values():
+    cache.save()
 
   from xia2.Schema import imageset_cache
 
-  for template, sweeplist in zip(templates, results_list):
+  for template in templates:
+    sweeplist = sweeps[template]
     if sweeplist is not None:
       known_sweeps[template] = sweeplist
       for sweep in sweeplist:
@@ -476,18 +752,36 @@ def get_sweeps(templates):
 
 
 
+def scan_nproc():
+  '''The number of threads to scan for images with: the nproc setting,
+  or all of the processors if this has not been decided.'''
+
+  from libtbx import Auto
+  from xia2.Handlers.Environment import get_number_cpus
+
+  nproc = PhilIndex.params.xia2.settings.multiprocessing.nproc
+  if nproc is Auto or nproc is None:
+    nproc = get_number_cpus()
+  return max(1, nproc)
+
 def rummage(directories):
   '''Walk through the directories looking for sweeps.'''
+  nproc = scan_nproc()
   templates = set()
   visited = set()
   for path in directories:
+    paths = []
     for root, dirs, files in os.walk(path, followlinks=True):
       realpath = os.path.realpath(root)
       if realpath in visited:
         # safety-check to avoid recursively symbolic links
         continue
       visited.add(realpath)
-      templates.update(visit(os.getcwd(), root, files))
+      paths.extend(os.path.join(root, f) for f in sorted(files))
+
+    cache = ImageScanCache.for_directory(path)
+    templates.update(scan_files(paths, cache=cache, nproc=nproc))
+    cache.save()
 
   get_sweeps(templates)
 
@@ -43,6 +43,7 @@
 import os
 
 import xia2.Driver.DefaultDriver
+from xia2.lib.loggraph import loggraph_parser
 
 def CCP4DecoratorFactory(DriverInstance):
   '''Create a CCP4 decorated Driver instance - based on the Driver
@@ -83,8 +84,10 @@ def __init__(self):
       self._mapin = None
       self._mapout = None
 
-      # somewhere to store the loggraph output
+      # somewhere to store the loggraph output, which is parsed as the
+      # program runs
       self._loggraph = {}
+      self._loggraph_parser = loggraph_parser()
 
       # put the CCP4 library directory at teh start of the
       # LD_LIBRARY_PATH in case it mashes CCP4 programs...
@@ -303,6 +306,29 @@ def start(self):
       # delegate the actual starting to the parent class
       self._original_class.start(self)
 
+    def reset(self):
+      self._original_class.reset(self)
+      self._loggraph_parser = loggraph_parser()
+
+    def output(self):
+      '''Pull a record from the child program, also parsing it for
+      loggraph output and errors.'''
+
+      record = self._original_class.output(self)
+      self._loggraph_parser.feed(record)
+      return record
+
+    def _get_loggraph_parser(self):
+      '''The parser of all of the output - which will need to be made
+      afresh if output has been added other than through output().'''
+
+      if self._loggraph_parser.n_records != \
+          len(self._standard_output_records):
+        self._loggraph_parser = loggraph_parser()
+        for record in self.get_all_output():
+          self._loggraph_parser.feed(record)
+      return self._loggraph_parser
+
     def check_ccp4_errors(self):
       '''Look through the standard output for a few "usual" CCP4
       errors, for instance incorrect file formats &c.'''
@@ -312,7 +338,9 @@ def check_ccp4_errors(self):
       if not self.finished():
         raise RuntimeError('program has not finished')
 
-      for line in self.get_all_output():
+      parser = self._get_loggraph_parser()
+
+      for line in parser.library_signals:
         if 'CCP4 library signal' in line:
           error = line.split(':')[1].strip()
 
@@ -325,7 +353,7 @@ def check_ccp4_errors(self):
 
           if 'Write failed' in error:
             # work out why...
-            for l in self.get_all_output():
+            for l in parser.system_signals:
               if '>>>>>> System signal' in l:
                 cause = l.split(':')[1].split('(')[0]
                 raise RuntimeError('%s:%s' % (error, cause))
@@ -360,7 +388,7 @@ def get_ccp4_status(self):
       if program_name == 'fft':
         program_name = 'fftbig'
 
-      for line in self.get_all_output()[-10:]:
+      for line in self._standard_output_records.tail(10):
         l = line.split()
         if len(l) > 1:
           if l[0][:-1].lower() == program_name:
@@ -380,72 +408,7 @@ def parse_ccp4_loggraph(self):
       CCP4 loggraph text. When this is found store it in a
       local dictionary to allow exploration.'''
 
-      # reset the loggraph store
-      self._loggraph = {}
-
-      output = self.get_all_output()
-
-      for i in range(len(output)):
-        line = output[i]
-        if '$TABLE' in line:
-
-          n_dollar = line.count('$$')
-
-          current = line.split(':')[1].replace('>', '').strip()
-          self._loggraph[current] = {}
-          self._loggraph[current]['columns'] = []
-          self._loggraph[current]['data'] = []
-
-          loggraph_info = ''
-
-          # FIXME 09/FEB/07 this is assumed to represent the
-          # end of a loggraph but really it isn't
-
-          # almost exactly one year later this has come back to
-          # bite me - with chef! indeed... OK, in Smartie the
-          # way this worked was to count the number of $$
-          # following the $TABLE spell - when this was equal to
-          # 4 this table is complete. Good idea.
-
-          # while not 'inline graphs' in line and not 'FONT' in line:
-          while n_dollar < 4:
-            n_dollar += line.count('$$')
-            loggraph_info += line
-
-            if n_dollar == 4:
-              break
-
-            i += 1
-            line = output[i]
-
-          # at this stage I should have the whole 9 yards in
-          # a single string...
-
-          tokens = loggraph_info.split('$$')
-          self._loggraph[current]['columns'] = tokens[1].split()
-
-          if len(tokens) < 4:
-            raise RuntimeError('loggraph "%s" broken' % current)
-
-          data = tokens[3].split('\n')
-
-          # pop takes the data off the end so...
-          # data.reverse()
-
-          columns = len(self._loggraph[current]['columns'])
-
-          # while len(data) > 0:
-          # record = []
-          # for i in range(columns):
-          # record.append(data.pop())
-          # self._loggraph[current]['data'].append(record)
-
-          # code around cases where columns merge together...
-
-          for j in range(len(data)):
-            record = data[j].split()
-            if len(record) == columns:
-              self._loggraph[current]['data'].append(record)
+      self._loggraph = self._get_loggraph_parser().finish()
 
       return self._loggraph
 
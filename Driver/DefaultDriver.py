@@ -44,9 +44,16 @@
 
 from __future__ import absolute_import, division, print_function
 
+import array
+import collections
 import os
 import time
 
+try:
+  from collections.abc import Sequence
+except ImportError: # Python 2
+  from collections import Sequence
+
 from xia2.Driver.DriverHelper import (check_return_code, error_abrt, error_fp,
                                       error_kill, error_library_not_loaded,
                                       error_missing_library, error_no_program,
@@ -59,6 +66,149 @@
 
 timing_db = []
 
+class LogRecords(Sequence):
+  '''A read-only sequence of the records written to a log file, read back
+  from the file as they are needed: only where each record ends in the
+  file is held in memory, along with any records which came after the log
+  file was closed, so the records are as they were when this was made for
+  as long as the log file is not rewritten.'''
+
+  _block_size = 1 << 16
+
+  def __init__(self, log_file_name, log_ends, encoding, records=()):
+    self._log_file_name = log_file_name
+    # log_ends is only appended to, so the first n are those in the file now
+    self._log_ends = log_ends
+    self._n = len(log_ends)
+    self._encoding = encoding
+    self._records = tuple(records)
+
+    # the part of the log file last read, in which the next record is
+    # most likely to be
+    self._block_start = 0
+    self._block = b''
+
+  def __len__(self):
+    return self._n + len(self._records)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[j] for j in range(*index.indices(len(self)))]
+
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('record index out of range')
+    if index >= self._n:
+      return self._records[index - self._n]
+
+    start = self._log_ends[index - 1] if index else 0
+    return self._read(start, self._log_ends[index])
+
+  def _read(self, start, end):
+    '''The record from byte start to end of the log file.'''
+
+    if start < self._block_start or \
+        end > self._block_start + len(self._block):
+      with open(self._log_file_name, 'rb') as fh:
+        fh.seek(start)
+        self._block = fh.read(max(end - start, self._block_size))
+      self._block_start = start
+
+    record = self._block[start - self._block_start:end - self._block_start]
+    if not isinstance(record, str):
+      record = record.decode(self._encoding)
+    return record
+
+class OutputRecords(object):
+  '''The standard output records of a job. Until a log file is attached
+  these are all held in memory; after that they are written (buffered)
+  to the log file, with only the last few kept in memory for error
+  checking, and the full output is read back from the log file on
+  request.'''
+
+  def __init__(self, tail=50):
+    self._records = []
+    self._tail = collections.deque(maxlen=tail)
+
+    self._log_file = None
+    self._log_file_name = None
+    self._encoding = None
+    # where (in bytes) each record written to the log file ends, so that
+    # they can be read back as they came whether or not they end in a
+    # newline
+    self._log_ends = array.array('L')
+    self._log_size = 0
+    self._last_flush = time.time()
+
+  def __len__(self):
+    return len(self._log_ends) + len(self._records)
+
+  def append(self, record):
+    self._tail.append(record)
+
+    if self._log_file is None:
+      self._records.append(record)
+      return
+
+    self._log_file.write(record)
+    if isinstance(record, bytes):
+      self._log_size += len(record)
+    else:
+      self._log_size += len(record.encode(self._encoding))
+    self._log_ends.append(self._log_size)
+
+    # keep the log file reasonably current without flushing every line
+    if time.time() - self._last_flush > 1.0:
+      self.flush()
+
+  def tail(self, n):
+    '''The last n (up to the tail length) records.'''
+
+    return list(self._tail)[-n:]
+
+  def get(self):
+    '''All of the records so far: as a tuple until a log file is attached,
+    then as a LogRecords sequence reading them back from the log file.'''
+
+    if self._log_file_name is None:
+      return tuple(self._records)
+
+    self.flush()
+    return LogRecords(self._log_file_name, self._log_ends, self._encoding,
+                      self._records)
+
+  def attach(self, log_file):
+    '''Write all records so far to the open file log_file, and all
+    subsequent records as they arrive.'''
+
+    records = list(self.get())
+
+    self.close()
+
+    self._records = []
+    self._log_file = log_file
+    self._log_file_name = log_file.name
+    self._encoding = getattr(log_file, 'encoding', None) or 'utf-8'
+    self._log_ends = array.array('L')
+    self._log_size = 0
+
+    for record in records:
+      self.append(record)
+
+  def flush(self):
+    if self._log_file is not None:
+      self._log_file.flush()
+      self._last_flush = time.time()
+
+  def close(self):
+    '''Stop writing to the log file - the records written so far can
+    still be read back from it.'''
+
+    if self._log_file is not None:
+      self._log_file.close()
+      self._log_file = None
+
 class DefaultDriver(object):
   '''A class to run other programs, specifically from the CCP4 suite
   but also others, to achieve crystallographic processes. This will also
@@ -83,8 +233,9 @@ def __init__(self):
     # usually small
     self._standard_input_records = []
 
-    # this will be bigger but that is ok...
-    self._standard_output_records = []
+    # this can be very much bigger so is written to the log file once
+    # there is one
+    self._standard_output_records = OutputRecords()
 
     # optional - possibly useful if using a batch submission
     # system or wanting to describe better what the job is doing
@@ -115,9 +266,7 @@ def __init__(self):
   def __del__(self):
     # the destructor - close the log file etc.
 
-    if self._log_file is not None:
-      self._log_file.flush()
-      self._log_file.close()
+    self._standard_output_records.close()
 
   # getter and setter methods
 
@@ -171,6 +320,26 @@ def get_working_environment(self):
     '''Return the additional elements for the working environment.'''
     return self._working_environment
 
+  def get_child_environment(self):
+    '''Return the environment for the child process - a copy of this
+    environment with the working environment applied.'''
+
+    environment = dict(os.environ)
+
+    for name in self._working_environment:
+      added = self._working_environment[name][0]
+      for value in self._working_environment[name][1:]:
+        added += '%s%s' % (os.pathsep, value)
+
+      if name in environment and \
+             not name in self._working_environment_exclusive:
+        environment[name] = '%s%s%s' % (added, os.pathsep,
+                                        environment[name])
+      else:
+        environment[name] = added
+
+    return environment
+
   def add_scratch_directory(self, directory):
     '''Add a scratch directory.'''
 
@@ -194,7 +363,7 @@ def _add_input_file(self, input_file):
     self._input_files.append(input_file)
 
   def add_input_file(self, input_file):
-    return self.add_input_file(input_file)
+    return self._add_input_file(input_file)
 
   def _add_output_file(self, output_file):
     '''Add an output file to the job. This may be overloaded by versions
@@ -255,7 +424,8 @@ def reset(self):
     '''Reset the output things.'''
 
     self._standard_input_records = []
-    self._standard_output_records = []
+    self._standard_output_records.close()
+    self._standard_output_records = OutputRecords()
 
     self._command_line = []
 
@@ -265,9 +435,6 @@ def reset(self):
     self._input_files = []
     self._output_files = []
     self._scratch_directories = []
-    if self._log_file is not None:
-      self._log_file.flush()
-      self._log_file.close()
     self._log_file = None
 
     # reset the name to a new value...
@@ -314,7 +481,7 @@ def check_for_errors(self):
     # only look for errors in the last 30 lines of the standard
     # output - if something went wrong, it went wrong in there...
 
-    self.check_for_error_text(self._standard_output_records[-30:])
+    self.check_for_error_text(self._standard_output_records.tail(30))
     # next check the status
 
     check_return_code(self.status())
@@ -349,18 +516,9 @@ def output(self):
 
     record = self._output()
 
-    # copy record somehow
+    # copy record somehow - this also writes it to the log file
     self._standard_output_records.append(record)
 
-    if self._log_file is not None:
-      self._log_file.write(record)
-
-      # FIXME 07/NOV/06 I have noticed that sometimes
-      # information is missed from the log files - perhaps
-      # flushing here will help??
-
-      self._log_file.flush()
-
     # presume if there is no output that the program has finished
     if not record:
       self._finished = True
@@ -376,17 +534,10 @@ def finished(self):
 
   def write_log_file(self, filename):
 
-    if self._log_file:
-      # close the existing log file
-      self._log_file.close()
-      self._log_file = None
-
-    # should have bufsize = 0 here... won't work on mac!
+    # the output records will close any existing log file
 
     self._log_file = open(filename, 'w')
-    if self._standard_output_records:
-      for s in self._standard_output_records:
-        self._log_file.write(s)
+    self._standard_output_records.attach(self._log_file)
 
     self._log_file_name = self._log_file.name
 
@@ -404,9 +555,11 @@ def get_all_input(self):
     return self._standard_input_records
 
   def get_all_output(self):
-    '''Return all of the output of the job.'''
+    '''Return all of the output of the job, as a sequence of records - if
+    this was written to a log file they are read back from there as they
+    are used.'''
 
-    return self._standard_output_records
+    return self._standard_output_records.get()
 
   def close(self):
     '''Close the standard input channel.'''
@@ -432,25 +585,28 @@ def close_wait(self):
       command_line = '%s ' % os.path.split(self._executable)[-1]
       for c in self._command_line:
         command_line += ' \'%s\'' % c.replace(self._working_directory + os.sep, '')
-      self._log_file.write('# command line:\n')
-      self._log_file.write('# %s\n' % command_line)
+      trailer = ['# command line:\n', '# %s\n' % command_line]
       if hasattr(self, '_runtime_log') and self._runtime_log:
-        self._log_file.write('#\n# timing information:\n')
+        trailer.append('#\n# timing information:\n')
         endtime = time.time()
         for k in self._runtime_log:
-          self._log_file.write('#   time since {name}: {time:.1f} seconds\n'.format(name=k, time=endtime-self._runtime_log[k]))
+          trailer.append('#   time since {name}: {time:.1f} seconds\n'.format(name=k, time=endtime-self._runtime_log[k]))
         timing_db.append({
           'command': command_line,
           'timing': { k: endtime - self._runtime_log[k] for k in self._runtime_log },
         })
-      self._log_file.close()
+      for line in trailer:
+        self._log_file.write(line)
+      self._standard_output_records.close()
       self._log_file = None
-      with open(self._log_file_name, 'rb') as f:
-        lines = f.readlines()
-        n = min(50, len(lines))
-        Debug.write('Last %i lines of %s:' %(n, self._log_file_name))
-        for line in lines[-n:]:
-          Debug.write(line.rstrip('\n'), strip=False)
+
+      # the end of the log file, without reading it back
+      lines = [line for line in self._standard_output_records.tail(50)
+               if line] + trailer
+      n = min(50, len(lines))
+      Debug.write('Last %i lines of %s:' %(n, self._log_file_name))
+      for line in lines[-n:]:
+        Debug.write(line.rstrip('\n'), strip=False)
 
     self.cleanup()
 
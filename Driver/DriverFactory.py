@@ -12,9 +12,11 @@
 #
 # At the moment this will instantiate
 #
-# SimpleDriver, ScriptDriver, QSubDriver, InteractiveDriver
+# SimpleDriver, ScriptDriver, QSubDriver, InteractiveDriver,
+# MultiplexedDriver
 #
-# instances only.
+# instances only. If a run cache is set, SimpleDriver instances replay the
+# results of runs from it (see RunCache.py).
 #
 
 from __future__ import absolute_import, division, print_function
@@ -24,7 +26,9 @@
 # another factory to delegate to
 from xia2.Driver.ClusterDriverFactory import ClusterDriverFactory
 from xia2.Driver.InteractiveDriver import InteractiveDriver
+from xia2.Driver.MultiplexedDriver import MultiplexedDriver
 from xia2.Driver.QSubDriver import QSubDriver
+from xia2.Driver.RunCache import RunCache, cached_driver_class
 from xia2.Driver.ScriptDriver import ScriptDriver
 from xia2.Driver.SimpleDriver import SimpleDriver
 
@@ -35,7 +39,7 @@ def __init__(self):
     self._driver_type = 'simple'
 
     self._implemented_types = ['simple', 'script', 'interactive',
-                               'qsub', 'cluster.sge']
+                               'qsub', 'cluster.sge', 'multiplexed']
 
     # should probably write a message or something explaining
     # that the following Driver implementation is being used
@@ -43,6 +47,11 @@ def __init__(self):
     if 'XIA2CORE_DRIVERTYPE' in os.environ:
       self.set_driver_type(os.environ['XIA2CORE_DRIVERTYPE'])
 
+    self._cached_driver_class = None
+
+    if 'XIA2_RUN_CACHE' in os.environ:
+      self.set_run_cache(os.environ['XIA2_RUN_CACHE'])
+
   def set_driver_type(self, type):
     '''Set the kind of driver this factory should produce.'''
     if not type in self._implemented_types:
@@ -53,6 +62,17 @@ def set_driver_type(self, type):
   def get_driver_type(self):
     return self._driver_type
 
+  def set_run_cache(self, directory, max_size=10 * 1024 ** 3):
+    '''Replay the results of runs by simple drivers from a cache of up to
+    max_size bytes in directory, or stop doing so if directory is None.'''
+
+    if directory is None:
+      self._cached_driver_class = None
+      return
+
+    self._cached_driver_class = cached_driver_class(
+      SimpleDriver, RunCache(directory, max_size))
+
   def Driver(self, type=None):
     '''Create a new Driver instance, optionally providing the
     type of Driver we want.'''
@@ -64,6 +84,8 @@ def Driver(self, type=None):
       return ClusterDriverFactory.Driver(type)
 
     if type == 'simple':
+      if self._cached_driver_class is not None:
+        return self._cached_driver_class()
       return SimpleDriver()
 
     if type == 'script':
@@ -75,6 +97,9 @@ def Driver(self, type=None):
     if type == 'qsub':
       return QSubDriver()
 
+    if type == 'multiplexed':
+      return MultiplexedDriver()
+
     raise RuntimeError('Driver class "%s" unknown' % type)
 
 DriverFactory = _DriverFactory()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# MultiplexedDriver.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# A Driver implementation where the output of all running child processes
+# is read by one multiplexer, in large chunks as it becomes available, so
+# that many programs may be run at once from one thread: start() them
+# all, then poll() or wait() - or wait_all() - for them to finish.
+#
+# Applicability: UNIX/OS X (select() does not work on pipes on Windows)
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import errno
+import os
+import select
+import threading
+import time
+
+from xia2.Driver.SimpleDriver import SimpleDriver
+
+class _LineBuffer(object):
+  '''Split a stream of bytes into lines with universal newlines, as
+  readline() on a pipe opened with universal_newlines would.'''
+
+  def __init__(self):
+    self._partial = b''
+    self.lines = collections.deque()
+
+  def feed(self, data):
+    data = self._partial + data
+
+    # hold back a trailing carriage return, which may be half of \r\n
+    if data.endswith(b'\r'):
+      data, self._partial = data[:-1], b'\r'
+    else:
+      self._partial = b''
+
+    lines = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(b'\n')
+    self._partial = lines.pop() + self._partial
+    self.lines.extend(self._decode(line + b'\n') for line in lines)
+
+  def close(self):
+    if self._partial:
+      partial = self._partial.replace(b'\r', b'\n')
+      self.lines.append(self._decode(partial))
+      self._partial = b''
+
+  @staticmethod
+  def _decode(line):
+    if str is bytes:
+      return line
+    return line.decode('utf-8', 'replace')
+
+class ProcessMultiplexer(object):
+  '''Read the output of all registered child processes, buffering it as
+  lines for the drivers which started them.'''
+
+  def __init__(self, chunk_size=1 << 16):
+    self._chunk_size = chunk_size
+    self._buffers = { }
+    self._lock = threading.Lock()
+
+  def register(self, fd):
+    buffer = _LineBuffer()
+    with self._lock:
+      self._buffers[fd] = buffer
+    return buffer
+
+  def is_registered(self, fd):
+    return fd in self._buffers
+
+  def service(self, timeout=None):
+    '''Wait up to timeout seconds (forever if None) for output from any
+    registered process, then read all which is available. Returns the
+    number of pipes read from.'''
+
+    with self._lock:
+      fds = list(self._buffers)
+      if not fds:
+        return 0
+
+      while True:
+        try:
+          readable = select.select(fds, [], [], timeout)[0]
+          break
+        except (OSError, select.error) as e:
+          if e.args[0] != errno.EINTR:
+            raise
+
+      for fd in readable:
+        data = os.read(fd, self._chunk_size)
+        if data:
+          self._buffers[fd].feed(data)
+        else:
+          # end of file
+          self._buffers.pop(fd).close()
+
+      return len(readable)
+
+_multiplexer = ProcessMultiplexer()
+
+class MultiplexedDriver(SimpleDriver):
+  def __init__(self):
+    super(MultiplexedDriver, self).__init__()
+
+    self._fd = None
+    self._lines = None
+
+  def start(self):
+    if self._executable is None:
+      raise RuntimeError('no executable is set.')
+
+    command_line = [self._executable] + list(self._command_line)
+
+    self._runtime_log['process start'] = time.time()
+    self._popen = self._open_process(command_line,
+                                     bufsize = 0,
+                                     close_fds = True)
+    self._popen_status = None
+
+    self._fd = self._popen.stdout.fileno()
+    buffer = _multiplexer.register(self._fd)
+    self._lines = buffer.lines
+
+    return self
+
+  def _input(self, record):
+
+    if not self.check():
+      raise RuntimeError('child process has termimated')
+
+    if not str is bytes:
+      record = record.encode('utf-8')
+    self._popen.stdin.write(record)
+
+  def _output(self):
+    # other processes' output is read while waiting for this one's
+
+    while not self._lines and _multiplexer.is_registered(self._fd):
+      _multiplexer.service(timeout=1.0)
+
+    if self._lines:
+      return self._lines.popleft()
+
+    return ''
+
+  def running(self):
+    '''True if the child process may still produce output.'''
+
+    return bool(self._lines) or _multiplexer.is_registered(self._fd)
+
+  def poll(self):
+    '''Read any output available now, without waiting; return the exit
+    status of the child process, or None if it is still running.'''
+
+    _multiplexer.service(timeout=0)
+    if _multiplexer.is_registered(self._fd):
+      return None
+    return self._popen.poll()
+
+  def wait(self):
+    '''Close the input to the child process and collect all of its output,
+    returning the exit status.'''
+
+    self.close_wait()
+    return self.status()
+
+  def close(self):
+
+    if not self.check():
+      raise RuntimeError('child process has termimated')
+
+    if not self._popen.stdin.closed:
+      self._popen.stdin.close()
+
+  def cleanup(self):
+    self._popen_status = self._popen.wait()
+    self._popen.stdout.close()
+    self._popen = None
+
+def wait_all(drivers):
+  '''Close the input to all of the drivers and wait for them to finish,
+  reading the output of each as it arrives. Returns the exit statuses.'''
+
+  for driver in drivers:
+    driver.close()
+
+  while any(_multiplexer.is_registered(driver._fd) for driver in drivers):
+    _multiplexer.service(timeout=1.0)
+
+  return [driver.wait() for driver in drivers]
@@ -11,7 +11,6 @@
 
 from __future__ import absolute_import, division, print_function
 
-import copy
 import os
 import subprocess
 import sys
@@ -33,34 +32,9 @@ def start(self):
     if self._executable is None:
       raise RuntimeError('no executable is set.')
 
-    if os.name == 'nt':
-      # pass in CL as a list of tokens
-      command_line = [sys.executable]
-      command_line.append(self._executable)
-      for c in self._command_line:
-        command_line.append(c)
-    else:
-      # now pass in the command line as a string and allow the
-      # shell to parse it - note well though that the tokens
-      # on the command line are quoted..
-
-      command_line = '%s %s' % (sys.executable, self._executable)
-      for c in self._command_line:
-        command_line += ' \'%s\'' % c
-
-    environment = copy.deepcopy(os.environ)
-
-    for name in self._working_environment:
-      added = self._working_environment[name][0]
-      for value in self._working_environment[name][1:]:
-        added += '%s%s' % (os.pathsep, value)
-
-      if name in environment and \
-             not name in self._working_environment_exclusive:
-        environment[name] = '%s%s%s' % (added, os.pathsep,
-                                        environment[name])
-      else:
-        environment[name] = added
+    # pass in CL as a list of tokens - no need for a shell to parse it
+    command_line = [sys.executable, self._executable] + \
+                   list(self._command_line)
 
     self._popen = subprocess.Popen(command_line,
                                    bufsize = 1,
@@ -69,8 +43,7 @@ def start(self):
                                    stderr = subprocess.STDOUT,
                                    cwd = self._working_directory,
                                    universal_newlines = True,
-                                   env = environment,
-                                   shell = True)
+                                   env = self.get_child_environment())
 
   def check(self):
     '''Overload the default check method.'''
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# RunCache.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# A cache of the results of program runs - the standard output and the
+# output files - keyed by everything which went into them: the executable,
+# the command line, the standard input and the contents of the input files.
+# A Driver which declares its output files (with add_output_file) and is
+# run again with the same inputs then replays the cached results rather
+# than running the program, so that reprocessing the same images skips the
+# expensive early stages.
+#
+# Paths under the working directory are keyed relative to it, so results
+# may be replayed in a different working directory. Data read by the
+# program but not declared (e.g. the images named in XDS.INP) are taken
+# not to change.
+#
+# The cache is limited in size, the least recently used results being
+# removed first.
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from xia2.Handlers.Artifacts import ArtifactStore, copy_file
+from xia2.Handlers.Streams import Debug
+
+_WORKING_DIRECTORY = '${WORKING_DIRECTORY}'
+
+class RunCache(object):
+  '''Results of program runs, stored in directory by key, up to a total
+  of max_size bytes.'''
+
+  def __init__(self, directory, max_size=10 * 1024 ** 3):
+    self._directory = directory
+    self._max_size = max_size
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  def _entry(self, key):
+    return os.path.join(self._directory, key[:2], key)
+
+  def key(self, executable, command_line, input_records, input_files,
+          working_directory):
+    '''The key for a run, from the executable (by path, size and
+    modification time), command line, standard input and the contents of
+    the input files.'''
+
+    def relative(text):
+      return text.replace(working_directory, _WORKING_DIRECTORY)
+
+    st = os.stat(executable)
+    description = {
+      'executable': [os.path.realpath(executable), st.st_size, st.st_mtime],
+      'command_line': [relative(token) for token in command_line],
+      'input': [relative(record) for record in input_records],
+      'files': sorted([relative(filename), ArtifactStore.digest(filename)]
+                      for filename in set(input_files)),
+    }
+    return hashlib.sha1(
+      json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+  def get(self, key, working_directory):
+    '''Put the output files of the run with key in place, returning its
+    standard output, or None if the run is not in the cache.'''
+
+    entry = self._entry(key)
+    meta_file = os.path.join(entry, 'meta.json')
+    if not os.path.exists(meta_file):
+      return None
+
+    with open(meta_file) as fh:
+      meta = json.load(fh)
+
+    for j, filename in enumerate(meta['files']):
+      filename = filename.replace(_WORKING_DIRECTORY, working_directory)
+      if os.path.lexists(filename):
+        os.remove(filename)
+      copy_file(os.path.join(entry, 'file_%d' % j), filename)
+
+    with open(os.path.join(entry, 'output.txt')) as fh:
+      records = fh.readlines()
+
+    # record the use, for eviction
+    os.utime(meta_file, None)
+
+    Debug.write('Replaying cached run %s' % key)
+    return records
+
+  def put(self, key, output_records, output_files, working_directory):
+    '''Store the standard output and the output files of the run with key,
+    then make room for it by evicting the least recently used runs.'''
+
+    entry = self._entry(key)
+    if os.path.exists(entry):
+      shutil.rmtree(entry)
+    os.makedirs(entry)
+
+    size = 0
+    files = []
+    for j, filename in enumerate(output_files):
+      copy_file(filename, os.path.join(entry, 'file_%d' % j))
+      size += os.path.getsize(filename)
+      files.append(filename.replace(working_directory, _WORKING_DIRECTORY))
+
+    with open(os.path.join(entry, 'output.txt'), 'w') as fh:
+      fh.write(''.join(output_records))
+    size += os.path.getsize(os.path.join(entry, 'output.txt'))
+
+    # meta.json is written last: an entry without it is incomplete
+    with open(os.path.join(entry, 'meta.json'), 'w') as fh:
+      json.dump({'files': files, 'size': size, 'time': time.time()}, fh)
+
+    self.evict()
+
+  def evict(self):
+    '''Remove the least recently used runs until the cache is no larger
+    than max_size.'''
+
+    entries = []
+    total = 0
+    for prefix in os.listdir(self._directory):
+      for key in os.listdir(os.path.join(self._directory, prefix)):
+        meta_file = os.path.join(self._directory, prefix, key, 'meta.json')
+        if not os.path.exists(meta_file):
+          continue
+        with open(meta_file) as fh:
+          size = json.load(fh)['size']
+        entries.append((os.stat(meta_file).st_mtime, size, key))
+        total += size
+
+    for last_used, size, key in sorted(entries):
+      if total <= self._max_size:
+        break
+      Debug.write('Evicting cached run %s' % key)
+      shutil.rmtree(self._entry(key))
+      total -= size
+
+def cached_driver_class(driver_class, run_cache):
+  '''A version of driver_class which replays the results of runs from
+  run_cache: a run is deferred until its standard input is closed, by
+  when everything which goes into it is known. Runs with no declared
+  output files, or whose output is read before the input is closed, are
+  run as usual.'''
+
+  class CachedDriver(driver_class):
+
+    def __init__(self):
+      super(CachedDriver, self).__init__()
+      self._deferred = False
+      self._replay = None
+      self._cache_key = None
+      self._records = []
+
+    def _path(self, filename):
+      return os.path.join(self._working_directory, filename)
+
+    def start(self):
+      self._replay = None
+      self._cache_key = None
+      self._records = []
+      self._deferred = bool(self._output_files)
+      if not self._deferred:
+        super(CachedDriver, self).start()
+
+    def _launch(self):
+      self._deferred = False
+      super(CachedDriver, self).start()
+      for record in self._standard_input_records:
+        super(CachedDriver, self)._input(record)
+
+    def _input(self, record):
+      # deferred input is in self._standard_input_records already
+      if not self._deferred:
+        super(CachedDriver, self)._input(record)
+
+    def close(self):
+      if self._deferred:
+        # files named on the command line are read, unless declared as
+        # written
+        input_files = [self._path(f) for f in self._input_files]
+        input_files.extend(
+          self._path(token) for token in self._command_line
+          if os.path.isfile(self._path(token)) and
+          not token in self._output_files)
+        self._cache_key = run_cache.key(
+          self._executable, self._command_line, self._standard_input_records,
+          input_files, self._working_directory)
+        records = run_cache.get(self._cache_key, self._working_directory)
+        if records is not None:
+          self._deferred = False
+          self._replay = collections.deque(records)
+          return
+        self._launch()
+      super(CachedDriver, self).close()
+
+    def _output(self):
+      if self._replay is not None:
+        if self._replay:
+          return self._replay.popleft()
+        return ''
+      if self._deferred:
+        # output wanted before the input is complete - just run it
+        self._launch()
+      record = super(CachedDriver, self)._output()
+      self._records.append(record)
+      return record
+
+    def _status(self):
+      if self._replay is not None:
+        return 0
+      return super(CachedDriver, self)._status()
+
+    def kill(self):
+      if self._replay is None and not self._deferred:
+        super(CachedDriver, self).kill()
+
+    def cleanup(self):
+      if self._replay is not None:
+        return
+      super(CachedDriver, self).cleanup()
+
+      output_files = [self._path(f) for f in self._output_files]
+      if self._cache_key is not None and self.status() == 0 and \
+         all(os.path.isfile(f) for f in output_files):
+        run_cache.put(self._cache_key, self._records, output_files,
+                      self._working_directory)
+
+  CachedDriver.__name__ = 'Cached%s' % driver_class.__name__
+  return CachedDriver
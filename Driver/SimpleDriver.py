@@ -17,7 +17,7 @@
 
 from __future__ import absolute_import, division, print_function
 
-import copy
+import errno
 import os
 import subprocess
 import time
@@ -36,47 +36,34 @@ def start(self):
     if self._executable is None:
       raise RuntimeError('no executable is set.')
 
-    if os.name == 'nt':
-      # pass in CL as a list of tokens
-      command_line = []
-      command_line.append(self._executable)
-      for c in self._command_line:
-        command_line.append(c)
-    else:
-      # now pass in the command line as a string and allow the
-      # shell to parse it - note well though that the tokens
-      # on the command line are quoted..
-
-      command_line = self._executable
-      for c in self._command_line:
-        command_line += ' \'%s\'' % c
-
-    environment = copy.deepcopy(os.environ)
-
-    for name in self._working_environment:
-      added = self._working_environment[name][0]
-      for value in self._working_environment[name][1:]:
-        added += '%s%s' % (os.pathsep, value)
-
-      if name in environment and \
-             not name in self._working_environment_exclusive:
-        environment[name] = '%s%s%s' % (added, os.pathsep,
-                                        environment[name])
-      else:
-        environment[name] = added
+    # pass in CL as a list of tokens - no need for a shell to parse it
+    command_line = [self._executable] + list(self._command_line)
 
     self._runtime_log['process start'] = time.time()
-    self._popen = subprocess.Popen(command_line,
-                                   bufsize = 1,
-                                   stdin = subprocess.PIPE,
-                                   stdout = subprocess.PIPE,
-                                   stderr = subprocess.STDOUT,
-                                   cwd = self._working_directory,
-                                   universal_newlines = True,
-                                   env = environment,
-                                   shell = True)
+    self._popen = self._open_process(command_line,
+                                     bufsize = 1,
+                                     universal_newlines = True)
     self._popen_status = None
 
+  def _open_process(self, command_line, **kwargs):
+    '''Start command_line as the child process, with its standard input
+    and (merged) output as pipes. As there is no shell to report that the
+    executable is missing, this raises the error error_no_program would
+    for the shell's message.'''
+
+    try:
+      return subprocess.Popen(command_line,
+                              stdin = subprocess.PIPE,
+                              stdout = subprocess.PIPE,
+                              stderr = subprocess.STDOUT,
+                              cwd = self._working_directory,
+                              env = self.get_child_environment(),
+                              **kwargs)
+    except OSError as e:
+      if e.errno == errno.ENOENT and os.path.isdir(self._working_directory):
+        raise RuntimeError('executable "%s" does not exist' % command_line[0])
+      raise
+
   def _input(self, record):
 
     if not self.check():
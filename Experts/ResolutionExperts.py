@@ -20,7 +20,10 @@
 import tempfile
 import time
 
+import numpy as np
+
 from xia2.Handlers.Streams import Debug
+from xia2.Modules.XDS_ASCII import XDSReflectionFile
 from xia2.Wrappers.CCP4.Pointless import Pointless
 
 # global parameters
@@ -335,12 +338,22 @@ def __init__(self, a, b, c, alpha, beta, gamma):
 
     self._A, self._B, self._C = B(_a, _b, _c, _alpha, _beta, _gamma)
 
+    # reciprocal metric tensor, so that s = h^T G h
+    abc = np.array([self._A, self._B, self._C])
+    self._G = np.dot(abc, abc.T)
+
     return
 
   def resolution(self, h, k, l):
     s = resolution(h, k, l, self._A, self._B, self._C)
     return s, 1.0 / math.sqrt(s)
 
+  def resolutions(self, h, k, l):
+    '''Compute s = 1 / d^2 and d for arrays of h, k, l.'''
+    hkl = np.column_stack((h, k, l)).astype(np.float64)
+    s = (np.dot(hkl, self._G) * hkl).sum(axis=1)
+    return s, 1.0 / np.sqrt(s)
+
 class ResolutionGeometry(object):
   '''A class for calculating the resolution of a reflection from the
   position on the detector, wavelength, beam centre and distance.'''
@@ -365,6 +378,21 @@ def resolution(self, x, y):
 
     return s, r
 
+  def resolutions(self, x, y):
+    '''Compute s = 1 / d^2 and d for arrays of pixel positions x, y.'''
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    d = np.sqrt((x - self._beam_x) * (x - self._beam_x) +
+                (y - self._beam_y) * (y - self._beam_y))
+
+    t = 0.5 * np.arctan(d / self._distance)
+
+    r = self._wavelength / (2.0 * np.sin(t))
+
+    return 1.0 / (r * r), r
+
 def xds_integrate_header_read(xds_hkl):
   '''Read the contents of an XDS INTEGRATE.HKL file to get the header
   information, namely the detector origin, cell constants, wavelength
@@ -379,11 +407,14 @@ def xds_integrate_header_read(xds_hkl):
   origin = None
   beam = None
 
-  for record in open(xds_hkl, 'r').readlines():
-    if not record[0] == '!':
-      break
+  with XDSReflectionFile(xds_hkl) as xds_file:
+    header = xds_file.header_records()
 
-    lst = record[1:].split()
+  for record in header:
+    lst = record.split()
+
+    if not lst:
+      continue
 
     if lst[0] == 'UNIT_CELL_CONSTANTS=':
       cell = tuple(map(float, lst[1:]))
@@ -446,8 +477,8 @@ def xds_integrate_header_read(xds_hkl):
   return cell, pixel, origin, distance, wavelength
 
 def xds_integrate_hkl_to_list(xds_hkl):
-  '''Convert the output from XDS INTEGRATE to a list of (s, i, sigma)
-  records. Check the s calculations as an aside.'''
+  '''Convert the output from XDS INTEGRATE to an array of (s, i, sigma)
+  records, reading the file a chunk at a time.'''
 
   cell, pixel, origin, distance, wavelength = xds_integrate_header_read(
       xds_hkl)
@@ -458,24 +489,15 @@ def xds_integrate_hkl_to_list(xds_hkl):
 
   result = []
 
-  for record in open(xds_hkl, 'r').readlines():
-    if record[:1] == '!':
-      continue
-
-    lst = record.split()
-
-    if not lst:
-      continue
-
-    h, k, l = tuple(map(int, lst[:3]))
-
-    i, sigma, x, y = tuple(map(float, lst[3:7]))
-
-    s, r = rc.resolution(h, k, l)
+  with XDSReflectionFile(xds_hkl) as xds_file:
+    for columns in xds_file.columns([0, 1, 2, 3, 4]):
+      h, k, l, i, sigma = columns.T
+      s, r = rc.resolutions(h, k, l)
+      result.append(np.column_stack((s, i, sigma)))
 
-    result.append((s, i, sigma))
-
-  return result
+  if not result:
+    return np.zeros((0, 3))
+  return np.concatenate(result)
 
 def mosflm_mtz_to_list(mtz):
   '''Run pointless to convert mtz to list of h k l ... and give the
@@ -502,23 +524,12 @@ def pointless_summedlist_to_list(summedlist, cell):
 
   rc = ResolutionCell(a, b, c, alpha, beta, gamma)
 
-  result = []
-
-  for record in open(summedlist, 'r').readlines():
-    lst = record.split()
-
-    if not lst:
-      continue
-
-    h, k, l = tuple(map(int, lst[:3]))
+  h, k, l, i, sigma = np.loadtxt(
+      summedlist, usecols=(0, 1, 2, 4, 5), ndmin=2).T
 
-    i, sigma = tuple(map(float, lst[4:6]))
+  s, r = rc.resolutions(h, k, l)
 
-    s, r = rc.resolution(h, k, l)
-
-    result.append((s, i, sigma))
-
-  return result
+  return np.column_stack((s, i, sigma))
 
 def find_blank(hklin):
 
@@ -587,32 +598,44 @@ def remove_blank(hklin, hklout):
 
   return hklout
 
-def bin_o_tron0(sisigma):
-  '''Bin the incoming list of (s, i, sigma) and return a list of bins
-  of width _scale_bins in S.'''
+def _nint(a):
+  '''Vectorised nint().'''
+  i = np.trunc(a).astype(np.int64)
+  return i + (a - i > 0.5) - (a - i < -0.5)
 
-  bins = {}
+def _as_sisigma(sisigma):
+  return np.asarray(sisigma, dtype=np.float64).reshape(-1, 3)
 
-  for j in range(_number_bins):
-    bins[j + 1] = []
+def binned_meansd(s, values, number_bins):
+  '''Compute meansd() of values in bins nint(0.5 * number_bins * s) from 1
+  to number_bins, returned as arrays of mean and sd for each bin.'''
 
-  for sis in sisigma:
-    s, i, sigma = sis
+  qs = _nint(0.5 * number_bins * np.asarray(s, dtype=np.float64)) - 1
+  sel = (qs >= 0) & (qs < number_bins)
+  qs = qs[sel]
+  values = np.asarray(values, dtype=np.float64)[sel]
 
-    qs = nint(0.5 * _number_bins * s)
+  count = np.bincount(qs, minlength=number_bins)
+  total = np.bincount(qs, weights=values, minlength=number_bins)
+  mean = np.where(count > 0, total / np.maximum(count, 1), 0.0)
+  deviation = values - mean[qs]
+  var = np.bincount(qs, weights=deviation * deviation, minlength=number_bins)
+  sd = np.sqrt(var / np.maximum(count, 1))
 
-    if qs in bins:
-      bins[qs].append((i / sigma))
+  return mean, sd
+
+def bin_o_tron0(sisigma):
+  '''Bin the incoming (s, i, sigma) records and return a list of bins
+  of width _scale_bins in S.'''
+
+  s, i, sigma = _as_sisigma(sisigma).T
+
+  mean, sd = binned_meansd(s, i / sigma, _number_bins)
 
   result = {}
 
   for j in range(_number_bins):
-    result[_scale_bins * (j + 1)] = meansd(bins[j + 1])
-
-    if False:
-      print(result[_scale_bins * (j + 1)][0], \
-            result[_scale_bins * (j + 1)][1], \
-            len(bins[j + 1]))
+    result[_scale_bins * (j + 1)] = mean[j], sd[j]
 
   return result
 
@@ -621,189 +644,94 @@ def outlier(sisigma):
   if these are found, remove the reflections in that region from
   the list, then return the edited list.'''
 
-  # first bin the measurements
-
-  t0 = time.time()
-
-  bins = {}
+  # first bin the measurements and calculate the mean in each bin
 
-  for j in range(500):
-    bins[j + 1] = []
+  sisigma = _as_sisigma(sisigma)
+  s, i, sigma = sisigma.T
 
-  for sis in sisigma:
-    s, i, sigma = sis
+  mean, sd = binned_meansd(s, i / sigma, 500)
+  keys = 0.004 * np.arange(1, 501)
 
-    qs = nint(0.5 * 500 * s)
-
-    if qs in bins:
-      bins[qs].append((i / sigma))
-
-  # then look for outliers... first calculate the mean in each bin...
-
-  result = {}
-  keys = []
-
-  fout = open('q.txt', 'w')
-
-  for j in range(500):
-    result[0.004 * (j + 1)] = meansd(bins[j + 1])
-    keys.append(0.004 * (j + 1))
-
-    fout.write('%f %f %f\n' % (0.004 * (j + 1),
-                               result[0.004 * (j + 1)][0],
-                               result[0.004 * (j + 1)][1]))
-
-  fout.close()
+  with open('q.txt', 'w') as fout:
+    for j in range(500):
+      fout.write('%f %f %f\n' % (keys[j], mean[j], sd[j]))
 
   # then look to see which bins don't fit
 
-  outliers = []
-
-  for j in range(4, 500 - 4):
-    k_m2 = keys[j - 2]
-    k_m1 = keys[j - 1]
-    k_p1 = keys[j + 1]
-    k_p2 = keys[j + 2]
-
-    k = keys[j]
-
-    m_m2 = result[k_m2][0]
-    m_m1 = result[k_m1][0]
-    m_p1 = result[k_p1][0]
-    m_p2 = result[k_p2][0]
-
-    if result[k][0] > 5 * (0.5 * (m_m1 + m_p1)):
-    # if result[k][0] > 5 * min([m_m2, m_m1, m_p1, m_p2]):
-      if not k in outliers:
-        outliers.append(k)
+  j = np.arange(4, 500 - 4)
+  outliers = keys[j[mean[j] > 5 * (0.5 * (mean[j - 1] + mean[j + 1]))]]
 
   # now remove these from the list - brutal - just excise completely!
 
-  sisigma_new = []
-
   limit = min(outliers)
 
-  for sis in sisigma:
-    s = sis[0]
-    keep = True
-    # for o in outliers:
-    # if math.fabs(s - o) < 0.004:
-    # keep = False
-
-    if s > limit:
-      keep = False
-
-    if keep:
-      sisigma_new.append(sis)
-
-  return sisigma_new
+  return sisigma[s <= limit]
 
 def bin_o_tron(sisigma):
-  '''Bin the incoming list of (s, i, sigma) and return a list of bins
+  '''Bin the incoming (s, i, sigma) records and return a list of bins
   of width _scale_bins in S.'''
 
   # first reject the outliers - nope, let's not...
 
   # sisigma = outlier(sisigma)
 
-  bins_i = {}
-  bins_s = {}
-
-  for j in range(_number_bins):
-    bins_i[j + 1] = []
-    bins_s[j + 1] = []
+  s, i, sigma = _as_sisigma(sisigma).T
 
-  for sis in sisigma:
-    s, i, sigma = sis
-
-    qs = nint(0.5 * _number_bins * s)
-
-    if qs in bins_i:
-      bins_i[qs].append(i)
-      bins_s[qs].append(sigma)
+  mean_i, sd_i = binned_meansd(s, i, _number_bins)
+  mean_sigma, sd_sigma = binned_meansd(s, sigma, _number_bins)
 
   result = {}
 
   for j in range(_number_bins):
-    msd = meansd(bins_i[j + 1])
-    result[_scale_bins * (j + 1)] = (msd[0], msd[1], meansd(bins_s[j + 1])[0])
-
-    if False:
-      print(result[_scale_bins * (j + 1)][0], \
-            result[_scale_bins * (j + 1)][1], \
-            len(bins[j + 1]))
+    result[_scale_bins * (j + 1)] = (mean_i[j], sd_i[j], mean_sigma[j])
 
   return result
 
 def linear(x, y):
 
-  _x = sum(x) / len(x)
-  _y = sum(y) / len(y)
+  x = np.asarray(x, dtype=np.float64)
+  y = np.asarray(y, dtype=np.float64)
 
-  sumxx = 0.0
-  sumxy = 0.0
+  m = ((x - x.mean()) * (y - y.mean())).sum() / \
+      ((x - x.mean()) * (x - x.mean())).sum()
 
-  for j in range(len(x)):
+  c = y.mean() - x.mean() * m
 
-    sumxx += (x[j] - _x) * (x[j] - _x)
-    sumxy += (x[j] - _x) * (y[j] - _y)
+  return m, c
 
-  m = sumxy / sumxx
+# ranges of s likely to be affected by ice rings, from XDS example input
 
-  c = _y - _x * m
-
-  return m, c
+_ice_rings = ((0.065, 0.067), (0.073, 0.075), (0.083, 0.086), (0.137, 0.143),
+              (0.192, 0.203), (0.226, 0.240), (0.264, 0.281))
 
 def ice(s):
   '''Could the reflection with inverse resolution s be in an ice ring?
-  calculated from XDS example input...'''
-
-  if s >= 0.065 and s <= 0.067:
-    return True
-  if s >= 0.073 and s <= 0.075:
-    return True
-  if s >= 0.083 and s <= 0.086:
-    return True
-  if s >= 0.137 and s <= 0.143:
-    return True
-  if s >= 0.192 and s <= 0.203:
-    return True
-  if s >= 0.226 and s <= 0.240:
-    return True
-  if s >= 0.264 and s <= 0.281:
-    return True
-
-  return False
+  Works on a single s or an array.'''
 
-def digest(bins, isigma_limit=1.0):
-  '''Digest a list of bins to calculate a sensible resolution limit.'''
+  s = np.asarray(s)
+  result = np.zeros(s.shape, dtype=bool)
 
-  # print 'Debugging! isigma_limit = %f' % isigma_limit
+  for s_min, s_max in _ice_rings:
+    result |= (s >= s_min) & (s <= s_max)
 
-  ss = sorted(bins.keys())
+  if result.ndim == 0:
+    return bool(result)
+  return result
 
-  for j in range(_number_bins):
-    s = ss[j]
-    mean, sdm, sd = bins[s]
+def digest(bins, isigma_limit=1.0):
+  '''Digest a list of bins to calculate a sensible resolution limit.'''
 
-    if False:
-      print(s, 1.0 / math.sqrt(s), mean, sd)
+  ss = np.array(sorted(bins.keys()))
+  mean, sdm, sd = np.array([bins[s] for s in ss]).T
 
   # ok, really the first thing I need to do is see if the reflections
   # fall off the edge of the detector - i.e. this is a close-in low
   # resolution set with I/sig >> 1 at the edge...
 
-  _mean = []
-  _s = []
-
-  for j in range(_number_bins):
-    s = ss[j]
-    mean, sdm, sd = bins[s]
-
-    if mean > 0:
-      _mean.append(mean / sd)
-      _s.append(s)
-      smax = s
+  positive = mean > 0
+  _mean = mean[positive] / sd[positive]
+  _s = ss[positive]
+  smax = _s[-1]
 
   # allow a teeny bit of race - ignore the last resolution bin
   # in this calculation...
@@ -820,28 +748,16 @@ def digest(bins, isigma_limit=1.0):
 
   # panic - fixme - this should be SPREAD not mean error.
 
-  for j in range(nint(0.01 * _number_bins), _number_bins):
-    s = ss[j]
-    mean, sdm, sd = bins[s]
-
-    if sdm > 0.9 * mean:
-      j0 = j
-      s0 = s
-      break
+  j = np.arange(nint(0.01 * _number_bins), _number_bins)
+  j0 = j[sdm[j] > 0.9 * mean[j]][0]
+  s0 = ss[j0]
 
   # now wade through until we get the first point where mean(I/s) ~ 1
 
-  for j in range(j0, _number_bins):
-    s = ss[j]
-    mean, sdm, sd = bins[s]
-
-    if sd == 0.0:
-      continue
-
-    if (mean / sd) <= isigma_limit:
-      s1 = s
-      j1 = j
-      break
+  j = np.arange(j0, _number_bins)
+  j = j[sd[j] != 0.0]
+  j1 = j[mean[j] / sd[j] <= isigma_limit][0]
+  s1 = ss[j1]
 
   Debug.write('Selected resolution range: %.2f to %.2f for Wilson fit' %
               (1.0 / math.sqrt(s0), 1.0 / math.sqrt(s1)))
@@ -851,9 +767,6 @@ def digest(bins, isigma_limit=1.0):
 
   # then actually do the fit... excluding ice rings of course
 
-  x = []
-  y = []
-
   if j0 + 1 >= j1:
     # we need to do this differently... just count down the bins
     # until I/sigma < 1 - actually this is already s1
@@ -861,26 +774,13 @@ def digest(bins, isigma_limit=1.0):
 
     return s1, r1
 
-  for j in range(j0, j1):
-    s = ss[j]
+  j = np.arange(j0, j1)
+  j = j[~ice(ss[j])]
 
-    if ice(s):
-      continue
-
-    mean, sdm, sd = bins[s]
-
-    x.append(s)
-    y.append(math.log10(mean / sd))
-
-  m, c = linear(x, y)
+  m, c = linear(ss[j], np.log10(mean[j] / sd[j]))
 
   L = math.log10(isigma_limit)
 
-  if False:
-    for isigma in 1.0, 2.0, 3.0, 4.0, 5.0:
-      s = (math.log10(isigma) - c) / m
-      print('Debugging again... %.1f %.2f' % (isigma, 1.0 / math.sqrt(s)))
-
   s = (L - c) / m
 
   # logic really - limit the resolution limit estimate to the
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# Artifacts.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# A store of the data files passed between program runs, kept by the hash
+# of their contents, from which they are placed in working directories with
+# links rather than copies where the file system allows - so that the same
+# large files (e.g. X-CORRECTIONS.cbf, BKGPIX.cbf) are not copied again for
+# every pass of every sweep.
+#
+# A placed file may share its storage with other copies of it, so it must
+# not be changed in place: anything about to write a file which may have
+# been placed should release() it first.
+
+from __future__ import absolute_import, division, print_function
+
+import errno
+import hashlib
+import os
+import shutil
+
+from xia2.Handlers.Streams import Debug
+
+# from linux/fs.h
+_FICLONE = 0x40049409
+
+def _temporary_name(dst):
+  '''A new, empty file beside dst, created exclusively so that nothing
+  else can be writing to it.'''
+
+  import uuid
+  tmp = '%s.%s.tmp' % (dst, uuid.uuid4().hex[:8])
+  os.close(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+  return tmp
+
+def _reflink(src, dst):
+  '''Make dst a copy-on-write clone of src, if the file system can. The
+  clone is made under a new name and renamed into place, so that an
+  existing dst - which may share its storage with other files - is
+  replaced, never written to.'''
+
+  try:
+    import fcntl
+  except ImportError:
+    return False
+
+  try:
+    tmp = _temporary_name(dst)
+  except OSError:
+    return False
+
+  cloned = False
+  try:
+    with open(src, 'rb') as fin:
+      with open(tmp, 'r+b') as fout:
+        try:
+          fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+          cloned = True
+        except (IOError, OSError):
+          pass
+    if cloned:
+      os.rename(tmp, dst)
+  finally:
+    if not cloned:
+      os.remove(tmp)
+  return cloned
+
+def _hardlink(src, dst):
+  try:
+    os.link(src, dst)
+    return True
+  except (AttributeError, OSError):
+    return False
+
+def _copy(src, dst):
+  '''Copy src to dst under a new name, renamed into place as for
+  _reflink.'''
+
+  tmp = _temporary_name(dst)
+  try:
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, dst)
+  except Exception:
+    os.remove(tmp)
+    raise
+
+def copy_file(src, dst):
+  '''Copy src to dst, as a clone sharing its storage if the file system
+  can - unlike a link, either may then be written in place.'''
+
+  if not _reflink(src, dst):
+    _copy(src, dst)
+
+def _is_shared(path):
+  return os.path.islink(path) or os.stat(path).st_nlink > 1
+
+class _ArtifactStore(object):
+  '''A singleton store of files by the hash of their contents.'''
+
+  def __init__(self):
+    self._directory = None
+
+    # the identity of the contents and digest of each file seen, by path
+    self._digests = { }
+
+    self.bytes_copied = 0
+    self.bytes_saved = 0
+    self.placements = { 'reflink': 0, 'hardlink': 0, 'copy': 0,
+                        'unchanged': 0 }
+
+  def _get_directory(self):
+    if self._directory is None:
+      from xia2.Handlers.Environment import Environment
+      self._directory = Environment.generate_directory('Artifacts')
+    return self._directory
+
+  def digest(self, filename):
+    '''The SHA-1 of the contents of filename, computed only once for each
+    version of each file.'''
+
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    # the change time is updated by any write, even one which restores
+    # the size and modification time
+    identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+    known = self._digests.get(path)
+    if known is not None and known[0] == identity:
+      return known[1]
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fh:
+      for block in iter(lambda: fh.read(1 << 20), b''):
+        sha1.update(block)
+    self._digests[path] = (identity, sha1.hexdigest())
+    return self._digests[path][1]
+
+  def _link(self, src, dst):
+    '''Make dst a copy of src, by the cheapest means available; returns
+    how.'''
+
+    for how, link in (('reflink', _reflink), ('hardlink', _hardlink)):
+      if link(src, dst):
+        return how
+    _copy(src, dst)
+    return 'copy'
+
+  def put(self, filename):
+    '''Add filename to the store if its contents are not already there,
+    returning the path of the stored copy.'''
+
+    digest = self.digest(filename)
+    stored = os.path.join(self._get_directory(), digest[:2], digest)
+    if not os.path.exists(stored):
+      if not os.path.exists(os.path.dirname(stored)):
+        try:
+          os.makedirs(os.path.dirname(stored))
+        except OSError as e:
+          if e.errno != errno.EEXIST:
+            raise
+      self._link(filename, stored)
+    return stored
+
+  def place(self, src, dst):
+    '''Put a copy of src at dst, sharing the stored copy of the contents
+    of src where the file system allows. Returns how it was placed.'''
+
+    if os.path.abspath(src) == os.path.abspath(dst):
+      return 'unchanged'
+
+    size = os.path.getsize(src)
+
+    if os.path.exists(dst) and not os.path.islink(dst) and \
+       os.path.getsize(dst) == size and self.digest(dst) == self.digest(src):
+      how = 'unchanged'
+
+    else:
+      stored = self.put(src)
+      if os.path.lexists(dst):
+        os.remove(dst)
+      how = self._link(stored, dst)
+
+    self.placements[how] += 1
+    if how == 'copy':
+      self.bytes_copied += size
+    else:
+      self.bytes_saved += size
+
+    Debug.write('Placed %s as %s (%s)' % (src, dst, how))
+    return how
+
+  def release(self, directory, file_names, keep=()):
+    '''Make sure that the named files in directory may be written in place
+    without changing any other copy of them: those to keep are given
+    storage of their own, the rest are removed.'''
+
+    for file_name in file_names:
+      path = os.path.join(directory, file_name)
+      # whatever is written there next is not what was digested
+      self._digests.pop(os.path.abspath(path), None)
+      if not os.path.lexists(path) or not _is_shared(path):
+        continue
+      if file_name in keep:
+        private = path + '.private'
+        shutil.copyfile(path, private)
+        os.rename(private, path)
+      else:
+        os.remove(path)
+
+  def summary(self):
+    return 'Artifact store: %d reflinked, %d hardlinked, %d copied, ' \
+           '%d unchanged; %.1f MB not copied, %.1f MB copied' % (
+      self.placements['reflink'], self.placements['hardlink'],
+      self.placements['copy'], self.placements['unchanged'],
+      self.bytes_saved / 1e6, self.bytes_copied / 1e6)
+
+ArtifactStore = _ArtifactStore()
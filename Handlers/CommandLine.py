@@ -210,9 +210,19 @@ def setup(self):
     from xia2.Handlers.Environment import get_number_cpus
     if mp_params.mode == 'parallel':
       if mp_params.type == 'qsub':
+        if mp_params.in_process:
+          raise Sorry('multiprocessing.in_process=True processes the sweeps'
+                      ' on this computer: it cannot be used with'
+                      ' multiprocessing.type=qsub')
         if which('qsub') is None:
           raise Sorry('qsub not available')
-      if mp_params.njob is Auto:
+      if mp_params.ncores is not None:
+        from xia2.Modules.TaskScheduler import split_core_budget
+        mp_params.njob, mp_params.nproc = split_core_budget(
+          mp_params.ncores,
+          njob=None if mp_params.njob is Auto else mp_params.njob,
+          nproc=None if mp_params.nproc is Auto else mp_params.nproc)
+      elif mp_params.njob is Auto:
         mp_params.njob = get_number_cpus()
         if mp_params.nproc is Auto:
           mp_params.nproc = 1
@@ -232,6 +242,12 @@ def setup(self):
     params = PhilIndex.get_python_object()
     mp_params = params.xia2.settings.multiprocessing
 
+    run_cache = params.xia2.settings.run_cache
+    if run_cache.directory is not None:
+      from xia2.Driver.DriverFactory import DriverFactory
+      DriverFactory.set_run_cache(os.path.abspath(run_cache.directory),
+                                  int(run_cache.max_size * 1024 ** 3))
+
     if params.xia2.settings.indexer is not None:
       add_preference("indexer", params.xia2.settings.indexer)
     if params.xia2.settings.refiner is not None:
@@ -807,6 +807,18 @@
       .type = int(value_min=1)
       .help = "The number of sweeps to process simultaneously."
       .expert_level = 1
+    ncores = None
+      .type = int(value_min=1)
+      .help = "In parallel mode, the total number of processors to share"
+              " between njob sweeps processed at once and nproc processors"
+              " for each."
+      .expert_level = 1
+    in_process = False
+      .type = bool
+      .help = "In parallel mode, process each sweep directly in a worker"
+              " process rather than by running xia2.integrate for each sweep."
+              " Not available with type=qsub."
+      .expert_level = 1
     type = *simple qsub
       .type = choice
       .help = "How to run the parallel processing jobs, e.g. over a cluster"
@@ -816,6 +828,21 @@
       .help = "The command to use to submit qsub jobs"
       .expert_level = 1
   }
+  run_cache
+    .short_caption = "Run cache"
+  {
+    directory = None
+      .type = path
+      .help = "Keep the results of expensive program runs (spot finding,"
+              " indexing, symmetry determination) here, and replay them when"
+              " a program is run again with the same inputs."
+      .expert_level = 2
+    max_size = 10
+      .type = float(value_min=0)
+      .help = "The size limit of the run cache in GB: the least recently"
+              " used results are removed beyond this."
+      .expert_level = 2
+  }
   report
     .expert_level = 1
   {
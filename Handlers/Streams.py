@@ -83,6 +83,13 @@ def cache(self):
     self._cachelines = []
     return
 
+  def discard_cache(self):
+    '''Stop caching, returning the cached records without writing them.'''
+    records = [record for record, forward in self._cachelines]
+    self._cache = False
+    self._cachelines = []
+    return records
+
   def filter(self, filter):
     self._filter = filter
     return
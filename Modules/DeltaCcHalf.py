@@ -3,10 +3,12 @@
 import sys
 
 import iotbx.phil
+import numpy as np
 from cctbx import crystal, miller, sgtbx, uctbx
 from cctbx.array_family import flex
 from libtbx.phil import command_line
 from xia2.Modules.MultiCrystalAnalysis import separate_unmerged
+from xia2.lib.bits import hkl_keys, miller_indices_as_numpy
 
 master_phil_scope = iotbx.phil.parse("""\
 cc_one_half_method = half_dataset *sigma_tau
@@ -28,6 +30,199 @@
 include scope xia2.Modules.MultiCrystalAnalysis.batch_phil_scope
 """, process_includes=True)
 
+class leave_one_out_cc_half(object):
+  '''CC1/2 of the data from all of the datasets bar one, for each dataset
+  in turn, in the resolution bins of the data from all of the datasets.
+  The sums over the observations of each unique reflection are accumulated
+  once for all of the data and once for the observations of each dataset,
+  and the sums over the reflections of each bin once for all of the data.
+  The data without any one dataset differ from all of the data only in the
+  reflections that dataset measured, so the sums without it follow from
+  these by subtraction, without going back over the other observations.
+
+  The half dataset method needs the observations split in two at random:
+  the split of all of the data is made once, so that it is the same for
+  every dataset left out. self.half records it as the half (0 or 1) of
+  each observation of the datasets in turn, or -1 for any outside the
+  bins.'''
+
+  def __init__(self, intensities, unmerged_intensities, n_bins=20,
+               cc_one_half_method='sigma_tau'):
+    self._n_bins = n_bins
+    self._cc_one_half_method = cc_one_half_method
+
+    indices = flex.miller_index()
+    data = flex.double()
+    sigmas = flex.double()
+    dataset = flex.int()
+    for i, unmerged in enumerate(intensities):
+      indices.extend(unmerged.indices())
+      data.extend(unmerged.data())
+      sigmas.extend(unmerged.sigmas())
+      dataset.extend(flex.int(unmerged.size(), i))
+    self._n_datasets = len(intensities)
+
+    # as cctbx, the half dataset CC1/2 merges Friedel mates and the
+    # sigma-tau CC1/2 follows the anomalous flag of the data
+
+    unmerged = unmerged_intensities.customized_copy(
+      indices=indices, data=data, sigmas=sigmas)
+    if cc_one_half_method != 'sigma_tau':
+      unmerged = unmerged.customized_copy(anomalous_flag=False)
+    unmerged.setup_binner_counting_sorted(n_bins=n_bins)
+
+    # only the observations in the bins between the two outer (empty)
+    # bins count, as in the binned CC1/2
+
+    bins = unmerged.binner().bin_indices().as_numpy_array().astype(np.int64)
+    self._selection = selection = (bins >= 1) & (bins <= n_bins)
+    self._dataset = dataset.as_numpy_array()[selection]
+    self._i = unmerged.data().as_numpy_array()[selection]
+    self._sigi = unmerged.sigmas().as_numpy_array()[selection]
+
+    # the unique reflection of each observation and the bin of each
+    # reflection, then the (dataset, reflection) pair of each observation
+
+    keys = hkl_keys(miller_indices_as_numpy(
+      unmerged.map_to_asu().indices()))[selection]
+    _, self._reflection = np.unique(keys, return_inverse=True)
+    self._n_reflections = int(self._reflection.max()) + 1 \
+                          if self._reflection.size else 0
+    self._reflection_bin = np.zeros(self._n_reflections, dtype=np.int64)
+    self._reflection_bin[self._reflection] = bins[selection] - 1
+
+    n = max(self._n_reflections, 1)
+    pairs, self._pair = np.unique(self._dataset * n + self._reflection,
+                                  return_inverse=True)
+    self._pair_dataset = pairs // n
+    self._pair_reflection = pairs % n
+
+    self.half = None
+    if cc_one_half_method != 'sigma_tau':
+      self.half = np.full(selection.size, -1, dtype=np.int64)
+      self.half[selection] = self._split_halves()
+
+  def _split_halves(self):
+    '''Assign the observations of each unique reflection to the two halves
+    alternately, in a random order, starting from a random half.'''
+
+    random = np.random.RandomState(0)
+    order = np.lexsort((random.random_sample(self._reflection.size),
+                        self._reflection))
+    first = np.searchsorted(self._reflection[order],
+                            np.arange(self._n_reflections))
+    rank = np.empty(order.size, dtype=np.int64)
+    rank[order] = np.arange(order.size) - first[self._reflection[order]]
+    start = random.randint(2, size=self._n_reflections)
+    return (rank + start[self._reflection]) % 2
+
+  def _leave_one_out_totals(self, values, columns):
+    '''Sum per-reflection columns over the reflections in each bin, without
+    each dataset in turn. The columns are computed by
+    columns(reflections, sums...) from the sums of the values over the
+    observations of the reflections, and returned as (valid, column...)
+    with only valid reflections counted. Returns the number of valid
+    reflections and the sums of the columns, as (datasets, bins) arrays.'''
+
+    n_pairs = self._pair_dataset.size
+    totals = [np.bincount(self._reflection, weights=v,
+                          minlength=self._n_reflections) for v in values]
+    pair_sums = [np.bincount(self._pair, weights=v, minlength=n_pairs)
+                 for v in values]
+
+    def bin_sums(index, size, valid, *columns):
+      return np.array([
+        np.bincount(index, weights=np.where(valid, c, 0.0), minlength=size)
+        for c in (np.ones(valid.size), ) + columns])
+
+    r = self._pair_reflection
+    pair_bin = self._pair_dataset * self._n_bins + self._reflection_bin[r]
+    size = self._n_datasets * self._n_bins
+
+    all_data = bin_sums(self._reflection_bin, self._n_bins,
+                        *columns(np.arange(self._n_reflections), *totals))
+    removed = bin_sums(pair_bin, size, *columns(r, *[t[r] for t in totals]))
+    added = bin_sums(pair_bin, size, *columns(
+      r, *[t[r] - p for t, p in zip(totals, pair_sums)]))
+
+    shape = (-1, self._n_datasets, self._n_bins)
+    return all_data[:, np.newaxis, :] - removed.reshape(shape) + \
+           added.reshape(shape)
+
+  def _reflection_mean(self):
+    '''The unweighted mean intensity of each unique reflection, from which
+    the deviations are summed so as not to be swamped by the intensities.'''
+
+    n = np.bincount(self._reflection, minlength=self._n_reflections)
+    return np.bincount(self._reflection, weights=self._i,
+                       minlength=self._n_reflections) / np.maximum(n, 1)
+
+  def _cc_sigma_tau(self):
+    '''CC1/2 in each bin by the sigma-tau method, as
+    cctbx.miller.array.cc_one_half_sigma_tau: from the variance of the
+    unweighted mean intensities of the reflections with more than one
+    observation and the mean of their internal variances.'''
+
+    mean = self._reflection_mean()
+    delta = self._i - mean[self._reflection]
+
+    def columns(reflections, n, sum_delta, sum_delta_sq):
+      valid = n > 1
+      n = np.where(valid, n, 2)
+      y = mean[reflections] + sum_delta / n
+      variance = (sum_delta_sq - sum_delta * sum_delta / n) / (n - 1)
+      internal_variance = np.maximum(variance, 1) / n
+      return valid, y, y * y, internal_variance
+
+    n, sum_y, sum_y_sq, sum_iv = self._leave_one_out_totals(
+      (np.ones(self._i.size), delta, delta * delta), columns)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      var_y = (sum_y_sq - sum_y * sum_y / n) / (n - 1)
+      mean_iv = sum_iv / n
+      cc = (var_y - mean_iv) / (var_y + mean_iv)
+    return np.where(n > 1, cc, 0.0), n
+
+  def _cc_half_dataset(self):
+    '''CC1/2 in each bin as cctbx.miller.array.cc_one_half: the correlation
+    of the weighted mean intensities of the two halves, for the reflections
+    with observations in both.'''
+
+    mean = self._reflection_mean()
+    w = 1.0 / (self._sigi * self._sigi)
+    wd = w * (self._i - mean[self._reflection])
+    half = self.half[self._selection]
+    values = []
+    for h in (0, 1):
+      in_half = (half == h).astype(np.float64)
+      values.extend((in_half, w * in_half, wd * in_half))
+
+    def columns(reflections, n_1, w_1, wd_1, n_2, w_2, wd_2):
+      valid = (n_1 > 0) & (n_2 > 0)
+      a = mean[reflections] + wd_1 / np.where(valid, w_1, 1)
+      b = mean[reflections] + wd_2 / np.where(valid, w_2, 1)
+      return valid, a, b, a * a, b * b, a * b
+
+    n, sum_a, sum_b, sum_a_sq, sum_b_sq, sum_ab = self._leave_one_out_totals(
+      values, columns)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      s_aa = sum_a_sq - sum_a * sum_a / n
+      s_bb = sum_b_sq - sum_b * sum_b / n
+      s_ab = sum_ab - sum_a * sum_b / n
+      cc = s_ab / np.sqrt(s_aa * s_bb)
+    return np.where((n > 1) & (s_aa * s_bb > 0), cc, 0.0), n
+
+  def run(self):
+    '''CC1/2 without each dataset in turn, the mean over the bins weighted
+    by the number of reflections in each.'''
+
+    if self._cc_one_half_method == 'sigma_tau':
+      cc, n = self._cc_sigma_tau()
+    else:
+      cc, n = self._cc_half_dataset()
+    return ((cc * n).sum(axis=1) / n.sum(axis=1)).tolist()
+
 class delta_cc_half(object):
   def __init__(self, unmerged_intensities, batches_all, n_bins=20, d_min=None,
                cc_one_half_method='sigma_tau', id_to_batches=None):
@@ -62,34 +257,11 @@ def __init__(self, unmerged_intensities, batches_all, n_bins=20, d_min=None,
       cc_overall = self.merging_statistics.cc_one_half_overall
     self.merging_statistics.show()
 
-    self.delta_cc = flex.double()
-    for test_k in self.intensities.keys():
-      #print test_k
-      indices_i = flex.miller_index()
-      data_i = flex.double()
-      sigmas_i = flex.double()
-      for k, unmerged in self.intensities.iteritems():
-        if k == test_k: continue
-        indices_i.extend(unmerged.indices())
-        data_i.extend(unmerged.data())
-        sigmas_i.extend(unmerged.sigmas())
-
-      unmerged_i = unmerged_intensities.customized_copy(
-        indices=indices_i, data=data_i, sigmas=sigmas_i).set_info(
-          unmerged_intensities.info())
-
-      unmerged_i.setup_binner_counting_sorted(n_bins=n_bins)
-      if cc_one_half_method == 'sigma_tau':
-        cc_bins = unmerged_i.cc_one_half_sigma_tau(
-          use_binning=True, return_n_refl=True)
-      else:
-        cc_bins = unmerged_i.cc_one_half(use_binning=True, return_n_refl=True)
-      cc_i = flex.mean_weighted(
-          flex.double(b[0] for b in cc_bins.data[1:-1]),
-          flex.double(b[1] for b in cc_bins.data[1:-1]))
-
-      delta_cc_i = cc_i - cc_overall
-      self.delta_cc.append(delta_cc_i)
+    leave_one_out = leave_one_out_cc_half(
+      list(self.intensities.values()), unmerged_intensities, n_bins=n_bins,
+      cc_one_half_method=cc_one_half_method)
+    self.delta_cc = flex.double(
+      [cc_i - cc_overall for cc_i in leave_one_out.run()])
 
   def _labels(self):
     if self.run_id_to_batch_id is not None:
@@ -21,22 +21,14 @@
 import sys
 
 from xia2.Handlers.Streams import Debug
-from xia2.Wrappers.XIA.Diffdump import Diffdump
+from xia2.Modules.ImageHeaders import header_columns
 
 def epocher(images):
   '''Get a list of epochs for each image in this list, returning as
   a list of tuples.'''
 
-  result = []
-  for i in images:
-    dd = Diffdump()
-    dd.set_image(i)
-    header = dd.readheader()
-
-    e = header['epoch']
-    result.append((i, e))
-
-  return result
+  epochs = header_columns(images, keys=['epoch'])['epoch']
+  return list(zip(images, epochs))
 
 def accumulate_dose(imagesets):
   from scitbx.array_family import flex
@@ -63,18 +55,10 @@ def accumulate_dose(imagesets):
 def accumulate(images):
   '''Accumulate dose as a function of image epoch.'''
 
-  dose = {}
   integrated_dose = {}
 
-  for i in images:
-    dd = Diffdump()
-    dd.set_image(i)
-    header = dd.readheader()
-
-    d = header['exposure_time']
-    e = header['epoch']
-
-    dose[e] = d
+  columns = header_columns(images, keys=['epoch', 'exposure_time'])
+  dose = dict(zip(columns['epoch'], columns['exposure_time']))
 
   keys = sorted(dose.keys())
 
@@ -17,22 +17,18 @@
 import os
 import sys
 
-from xia2.Wrappers.XIA.Diffdump import Diffdump
+from xia2.Modules.ImageHeaders import read_gains
 
 def gain(image):
   '''Get the gain from an image.'''
 
-  dd = Diffdump()
-  dd.set_image(image)
-  return dd.gain()
+  return read_gains([image])[0]
 
 def generate_gain(image_list):
   '''Get the mean and standard deviation in gain from a list
   of images.'''
 
-  gains = []
-  for image in image_list:
-    gains.append(gain(image))
+  gains = list(read_gains(image_list))
 
   sum = 0.0
   for g in gains:
@@ -0,0 +1,109 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+from xia2.Handlers.Streams import Debug
+from xia2.Wrappers.XIA.Diffdump import Diffdump, HeaderCache, failover_dxtbx
+
+def read_header(image):
+  '''Read the header of one image in process with the dxtbx, only running
+  diffdump if the dxtbx cannot read it.'''
+
+  try:
+    return failover_dxtbx(image)
+  except Exception:
+    pass
+
+  dd = Diffdump()
+  dd.set_image(image)
+  header = dd.readheader()
+  if header is None:
+    raise RuntimeError('could not read header of %s' % image)
+  return header
+
+def read_gain(image):
+  dd = Diffdump()
+  dd.set_image(image)
+  return dd.gain()
+
+_readers = { 'header': read_header, 'gain': read_gain }
+
+def _read_chunk(job):
+  kind, images = job
+  return [_readers[kind](image) for image in images]
+
+def attach_header_index():
+  '''Keep the header cache in the Headers directory of the xia2 working
+  directory, so that it is shared between the processes of this run and
+  any later run in the same place - or in the file named by
+  $XIA2_HEADER_INDEX, to share it more widely - unless it is kept
+  somewhere already.'''
+
+  if HeaderCache.get_filename() is not None:
+    return
+
+  filename = os.environ.get('XIA2_HEADER_INDEX')
+  if filename is None:
+    from xia2.Handlers.Environment import Environment
+    filename = os.path.join(
+      Environment.generate_directory('Headers'), 'headers.json')
+  HeaderCache.attach(filename)
+
+def read_all(images, kind='header', nproc=None):
+  '''Read the headers (or gains, with kind='gain') of all of the images,
+  from the header cache where it is up to date for the image, otherwise
+  sharing the images between nproc processes. Returns them in the order
+  of the images.'''
+
+  attach_header_index()
+
+  missing = [image for image in images if not HeaderCache.check(image, kind)]
+
+  if missing:
+    if nproc is None:
+      from xia2.Handlers.Environment import get_number_cpus
+      nproc = get_number_cpus()
+    nproc = max(1, min(nproc, len(missing)))
+
+    Debug.write('Reading %s for %d images with %d processes' % (
+      kind, len(missing), nproc))
+
+    # a few chunks for each process, so that none is left idle for long
+    n_chunks = min(len(missing), 4 * nproc)
+    jobs = [(kind, missing[j::n_chunks]) for j in range(n_chunks)]
+
+    if nproc == 1:
+      results = [_read_chunk(job) for job in jobs]
+    else:
+      from libtbx import easy_mp
+      results = easy_mp.parallel_map(
+        _read_chunk, jobs,
+        processes=nproc,
+        method='multiprocessing',
+        preserve_order=True,
+        preserve_exception_message=True)
+
+    for (_, chunk), values in zip(jobs, results):
+      for image, value in zip(chunk, values):
+        HeaderCache.put(image, value, kind)
+    HeaderCache.save()
+
+  return [HeaderCache.get(image, kind) for image in images]
+
+def header_columns(images, keys=('epoch', 'exposure_time'), nproc=None):
+  '''The header values named by keys for all of the images, as a
+  dictionary of flex.double arrays in the order of the images.'''
+
+  from scitbx.array_family import flex
+
+  headers = read_all(images, nproc=nproc)
+  return dict((key, flex.double([header[key] for header in headers]))
+              for key in keys)
+
+def read_gains(images, nproc=None):
+  '''The gains estimated by diffdump for all of the images, as a
+  flex.double array.'''
+
+  from scitbx.array_family import flex
+
+  return flex.double(read_all(images, kind='gain', nproc=nproc))
@@ -5,10 +5,12 @@
 from collections import OrderedDict
 
 import iotbx.phil
+import numpy as np
 from cctbx import crystal, miller, sgtbx, uctbx
 from libtbx.phil import command_line
 from scitbx.array_family import flex
 from xia2.Handlers.Streams import Chatter, Debug
+from xia2.lib.bits import hkl_keys, miller_indices_as_numpy
 
 def get_scipy():
   # make sure we can get scipy, if not try failing over to version in CCP4
@@ -63,23 +65,31 @@ def get_scipy():
   raise Sorry("matplotlib must be installed to generate a plot.")
 
 class separate_unmerged(object):
+  '''Separate unmerged intensities into runs of batches, either found
+  from the gaps in the batch numbers or given as id_to_batches. The
+  observations are sorted by run once, so that each run is selected by the
+  indices of its own observations rather than by a selection over all of
+  them; run_offsets gives the extent of each run in this order.'''
+
   def __init__(self, unmerged_intensities, batches_all, id_to_batches=None):
 
     intensities = OrderedDict()
     batches = OrderedDict()
 
+    batch_values = batches_all.data().as_numpy_array()
+
+    # the (id, first batch, last batch) of each run
+    runs = []
+
     if id_to_batches is None:
       run_id_to_batch_id = None
       run_id = 0
-      unique_batches = sorted(set(batches_all.data()))
+      unique_batches = np.unique(batch_values).tolist()
       last_batch = None
       run_start = unique_batches[0]
       for i, batch in enumerate(unique_batches):
         if last_batch is not None and batch > (last_batch + 1) or (i+1) == len(unique_batches):
-          batch_sel = (batches_all.data() >= run_start) & (batches_all.data() <= last_batch)
-          batches[run_id] = batches_all.select(batch_sel)
-          intensities[run_id] = unmerged_intensities.select(batch_sel)
-          Debug.write("run %i batch %i to %i" %(run_id+1, run_start, last_batch))
+          runs.append((run_id, run_start, last_batch))
           run_id += 1
           run_start = batch
         last_batch = batch
@@ -90,16 +100,191 @@ def __init__(self, unmerged_intensities, batches_all, id_to_batches=None):
       for batch_id, batch_range in id_to_batches.iteritems():
         run_id_to_batch_id[run_id] = batch_id
         run_start, last_batch = batch_range
-        batch_sel = (batches_all.data() >= run_start) & (batches_all.data() <= last_batch)
-        batches[run_id] = batches_all.select(batch_sel)
-        intensities[run_id] = unmerged_intensities.select(batch_sel)
-        Debug.write("run %i batch %i to %i" %(run_id+1, run_start, last_batch))
+        runs.append((run_id, run_start, last_batch))
         run_id += 1
 
+    for selection, (run_id, run_start, last_batch) in zip(
+        self._run_selections(batch_values, runs), runs):
+      batches[run_id] = batches_all.select(selection)
+      intensities[run_id] = unmerged_intensities.select(selection)
+      Debug.write("run %i batch %i to %i" %(run_id+1, run_start, last_batch))
+
     self.run_id_to_batch_id = run_id_to_batch_id
     self.intensities = intensities
     self.batches = batches
 
+  def _run_selections(self, batch_values, runs):
+    '''The indices of the observations in each run, in their original
+    order.'''
+
+    starts = np.array([run[1] for run in runs])
+    ends = np.array([run[2] for run in runs])
+
+    # the runs need not be given in order of batch
+    order = np.argsort(starts, kind='mergesort')
+    sorted_starts = starts[order]
+    sorted_ends = ends[order]
+
+    if np.any(sorted_starts[1:] <= sorted_ends[:-1]):
+      # overlapping batch ranges, so an observation may belong to more
+      # than one run: select each run separately
+      self.run_offsets = None
+      for run_id, run_start, last_batch in runs:
+        yield flex.size_t(np.flatnonzero(
+          (batch_values >= run_start) & (batch_values <= last_batch)).tolist())
+      return
+
+    # the run of each observation, or len(runs) if it is in none of them
+    position = np.searchsorted(sorted_starts, batch_values, side='right') - 1
+    inside = position >= 0
+    inside[inside] = batch_values[inside] <= sorted_ends[position[inside]]
+    run = np.full(batch_values.size, len(runs), dtype=np.int64)
+    run[inside] = order[position[inside]]
+
+    perm = np.argsort(run, kind='mergesort')
+    self.run_offsets = np.concatenate(
+      [[0], np.cumsum(np.bincount(run, minlength=len(runs) + 1))])
+
+    for i in range(len(runs)):
+      yield flex.size_t(
+        perm[self.run_offsets[i]:self.run_offsets[i + 1]].tolist())
+
+class pairwise_correlation(object):
+  '''The correlation coefficients between every pair of a growing list of
+  merged datasets over the reflections each pair has in common, as from
+  ma_i.correlation(ma_j). All of the datasets are placed in one table of
+  every reflection seen, held as a sparse matrix with a row per dataset,
+  so that the sums making up the coefficients for all of the pairs - or
+  for a new dataset against all those already added - come from a few
+  sparse matrix products, and adding a dataset leaves the coefficients
+  for the existing pairs as they are.'''
+
+  def __init__(self):
+    # the reflections seen so far, as sorted keys and the table column of
+    # each
+    self._keys = np.zeros(0, dtype=np.int64)
+    self._key_columns = np.zeros(0, dtype=np.int64)
+
+    # the table columns and values of each dataset
+    self._columns = []
+    self._values = []
+
+    self.matrix = np.zeros((0, 0))
+
+  def __len__(self):
+    return len(self._columns)
+
+  def _add_row(self, merged):
+    keys = hkl_keys(miller_indices_as_numpy(merged.indices()))
+    values = merged.data().as_numpy_array()
+
+    # correlation coefficients do not depend on the origin of the values,
+    # so take the mean from each to keep the sums small
+    if values.size:
+      values = values - values.mean()
+
+    position = np.searchsorted(self._keys, keys)
+    found = position < self._keys.size
+    found[found] = self._keys[position[found]] == keys[found]
+
+    columns = np.empty(keys.size, dtype=np.int64)
+    columns[found] = self._key_columns[position[found]]
+
+    new_keys = np.unique(keys[~found])
+    if new_keys.size:
+      new_columns = np.arange(new_keys.size) + self._key_columns.size
+      columns[~found] = new_columns[np.searchsorted(new_keys, keys[~found])]
+      keys = np.concatenate([self._keys, new_keys])
+      perm = np.argsort(keys, kind='mergesort')
+      self._keys = keys[perm]
+      self._key_columns = np.concatenate(
+        [self._key_columns, new_columns])[perm]
+
+    self._columns.append(columns)
+    self._values.append(values)
+
+  def _table(self, rows):
+    '''The values and the mask of the reflections present for the given
+    rows, as sparse matrices.'''
+
+    from scipy import sparse
+
+    shape = (len(rows), self._key_columns.size)
+    counts = [self._columns[i].size for i in rows]
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    if len(rows):
+      columns = np.concatenate([self._columns[i] for i in rows])
+      values = np.concatenate([self._values[i] for i in rows])
+    else:
+      columns = np.zeros(0, dtype=np.int64)
+      values = np.zeros(0)
+    x = sparse.csr_matrix((values, columns, indptr), shape=shape)
+    m = sparse.csr_matrix((np.ones(values.size), columns, indptr), shape=shape)
+    return x, m
+
+  def _correlation(self, rows_a, rows_b):
+    '''The correlation coefficients of each of rows_a with each of rows_b
+    over the reflections common to both, zero where this is not defined.'''
+
+    xa, ma = self._table(rows_a)
+    xb, mb = self._table(rows_b)
+
+    def product(a, b):
+      return np.asarray((a * b.T).todense(), dtype=float)
+
+    n = product(ma, mb)
+    sa = product(xa, mb)
+    sb = product(ma, xb)
+    saa = product(xa.multiply(xa), mb)
+    sbb = product(ma, xb.multiply(xb))
+    sab = product(xa, xb)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      cov = sab - sa * sb / n
+      var_a = saa - sa * sa / n
+      var_b = sbb - sb * sb / n
+      denominator = np.sqrt(var_a * var_b)
+      well_defined = (n > 0) & (var_a > 0) & (var_b > 0) & (denominator > 0)
+      return np.where(well_defined, cov / denominator, 0.0)
+
+  def add_datasets(self, merged_arrays):
+    '''Add datasets, computing their correlation coefficients with those
+    already present and each other. Returns the full matrix.'''
+
+    n_old = len(self)
+    for merged in merged_arrays:
+      self._add_row(merged)
+    n = len(self)
+    if n == n_old:
+      return self.matrix
+
+    new_rows = self._correlation(list(range(n_old, n)), list(range(n)))
+
+    matrix = np.zeros((n, n))
+    matrix[:n_old, :n_old] = self.matrix
+    matrix[n_old:, :] = new_rows
+    matrix[:n_old, n_old:] = new_rows[:, :n_old].T
+    self.matrix = matrix
+    return self.matrix
+
+  def add_dataset(self, merged):
+    return self.add_datasets([merged])
+
+  def linkage(self, method='average'):
+    '''Hierarchical clustering of the datasets on 1 - CC, from the
+    coefficients computed so far.'''
+
+    from scipy.cluster import hierarchy
+    import scipy.spatial.distance as ssd
+
+    # clip values of correlation matrix to account for floating point errors
+    dist_mat = 1 - np.clip(self.matrix, -1, 1)
+    np.fill_diagonal(dist_mat, 0)
+
+    # convert the redundant n*n square matrix form into a condensed nC2 array
+    dist_mat = ssd.squareform(dist_mat, checks=False)
+    return hierarchy.linkage(dist_mat, method=method)
+
 class multi_crystal_analysis(object):
   def __init__(self, unmerged_intensities, batches_all, n_bins=20, d_min=None,
                id_to_batches=None):
@@ -198,36 +383,23 @@ def plot_relative_anomalous_cc(self, racc, labels=None):
     fig.savefig("racc.png")
 
   def compute_correlation_coefficient_matrix(self):
-    from scipy.cluster import hierarchy
-    import scipy.spatial.distance as ssd
+    # all of the merged datasets extend to the lowest d_min of any of them,
+    # so filtering them to this resolution keeps every reflection
 
-    correlation_matrix = flex.double(
-      flex.grid(len(self.intensities), len(self.intensities)))
+    self.correlation = pairwise_correlation()
+    self.correlation.add_datasets(self.individual_merged_intensities.values())
 
-    d_min = min([ma.d_min() for ma in self.intensities.values()])
-
-    for i_wedge in self.individual_merged_intensities.keys():
-      for j_wedge in self.individual_merged_intensities.keys():
-        if j_wedge < i_wedge: continue
-        ma_i = self.individual_merged_intensities[i_wedge].resolution_filter(d_min=d_min)
-        ma_j = self.individual_merged_intensities[j_wedge].resolution_filter(d_min=d_min)
-        cc_ij = ma_i.correlation(ma_j).coefficient()
-        correlation_matrix[(i_wedge,j_wedge)] = cc_ij
-        correlation_matrix[j_wedge,i_wedge] = cc_ij
+    n = len(self.correlation)
+    correlation_matrix = flex.double(self.correlation.matrix.ravel().tolist())
+    correlation_matrix.reshape(flex.grid(n, n))
 
     # clip values of correlation matrix to account for floating point errors
     correlation_matrix.set_selected(correlation_matrix < -1, -1)
     correlation_matrix.set_selected(correlation_matrix > 1, 1)
-    diffraction_dissimilarity = 1-correlation_matrix
-
-    dist_mat = diffraction_dissimilarity.as_numpy_array()
-
-    # convert the redundant n*n square matrix form into a condensed nC2 array
-    dist_mat = ssd.squareform(dist_mat) # distArray[{n choose 2}-{n-i choose 2} + (j-i-1)] is the distance between points i and j
 
     method = ['single', 'complete', 'average', 'weighted'][2]
 
-    linkage_matrix = hierarchy.linkage(dist_mat, method=method)
+    linkage_matrix = self.correlation.linkage(method=method)
 
     return correlation_matrix, linkage_matrix
 
@@ -0,0 +1,86 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+class pixel_histogram(object):
+  '''Exact counts of the integer pixel values from 0 to max_value, from any
+  number of chunks of pixels. Counts are kept densely for values below
+  dense_limit, grown only as far as values are seen, and sparsely above it
+  where few distinct values are found - so the histogram stays small even
+  when max_value is in the billions. Histograms of parts of the data may
+  be merged.'''
+
+  def __init__(self, max_value, dense_limit=1 << 16):
+    self.max_value = max_value
+    self.n_out_of_range = 0
+    self._dense_limit = dense_limit
+    self._dense = np.zeros(0, dtype=np.int64)
+    self._sparse_values = np.zeros(0, dtype=np.int64)
+    self._sparse_counts = np.zeros(0, dtype=np.int64)
+
+  def _add_dense(self, counts):
+    if counts.size > self._dense.size:
+      dense = np.zeros(counts.size, dtype=np.int64)
+      dense[:self._dense.size] = self._dense
+      self._dense = dense
+    self._dense[:counts.size] += counts
+
+  def _add_sparse(self, values, counts):
+    if not values.size:
+      return
+    values, inverse = np.unique(
+      np.concatenate([self._sparse_values, values]), return_inverse=True)
+    self._sparse_counts = np.bincount(
+      inverse, weights=np.concatenate([self._sparse_counts, counts]),
+      minlength=values.size).astype(np.int64)
+    self._sparse_values = values
+
+  def add(self, values):
+    '''Count the pixel values in the array values.'''
+
+    values = np.asarray(values).ravel()
+    in_range = (values >= 0) & (values <= self.max_value)
+    self.n_out_of_range += int(values.size - np.count_nonzero(in_range))
+    values = values[in_range].astype(np.int64)
+
+    low = values < self._dense_limit
+    self._add_dense(np.bincount(values[low]))
+    self._add_sparse(*np.unique(values[~low], return_counts=True))
+
+  def merge(self, other):
+    '''Add the counts from the histogram other.'''
+
+    self._add_dense(other._dense)
+    self._add_sparse(other._sparse_values, other._sparse_counts)
+    self.n_out_of_range += other.n_out_of_range
+
+  def values_counts(self):
+    '''The values seen and their counts, as numpy arrays in order of
+    value.'''
+
+    dense_values = np.flatnonzero(self._dense)
+    return (np.concatenate([dense_values, self._sparse_values]),
+            np.concatenate([self._dense[dense_values], self._sparse_counts]))
+
+  def counts(self):
+    '''The counts of the values seen, as a dictionary.'''
+
+    values, counts = self.values_counts()
+    return dict(zip(values.tolist(), counts.tolist()))
+
+  def log_binned(self, bins_per_decade=10):
+    '''The counts in bins of value [0, 1), [1, e1), [e1, e2) ... where the
+    edges e increase by a factor of 10 every bins_per_decade bins up to
+    max_value + 1. Returns the edges and the counts in each bin.'''
+
+    n_decades = np.log10(self.max_value + 1)
+    n_bins = max(1, int(np.ceil(n_decades * bins_per_decade)))
+    edges = np.unique(np.floor(
+      np.logspace(0, n_decades, n_bins + 1)).astype(np.int64))
+    edges = np.concatenate([[0], edges])
+    edges[-1] = self.max_value + 1
+
+    values, counts = self.values_counts()
+    binned = np.bincount(np.searchsorted(edges, values, side='right') - 1,
+                         weights=counts, minlength=edges.size - 1)
+    return edges, binned[:edges.size - 1].astype(np.int64)
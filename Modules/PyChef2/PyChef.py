@@ -1,11 +1,12 @@
 from __future__ import absolute_import, division, print_function
 
-import math
 from collections import Mapping
 
+import numpy as np
 from cctbx.array_family import flex
 from iotbx.data_plots import table_data
 from libtbx import phil
+from xia2.lib.bits import hkl_keys, miller_indices_as_numpy
 
 dose_phil_str = """\
 dose {
@@ -87,65 +88,159 @@ def is_centric(self):
     return self._centric
 
 class unmerged_observations(Mapping):
+  '''Observations grouped by unique reflection.
+
+  The grouping is held in arrays: a permutation sorting the observations by
+  ASU index, the offset of each group within that permutation and a
+  PLUS/MINUS/CENTRIC flag per observation. observation_group objects are
+  only created when accessed through the Mapping interface.
+  '''
+
   def __init__(self, unmerged_intensities):
     self._intensities_original_index = unmerged_intensities
 
-    self._observations = {}
-    from cctbx import miller, sgtbx
-    sg = self._intensities_original_index.space_group()
-    sg_type = sg.type()
-    asu = sgtbx.reciprocal_space_asu(sg_type)
-    anomalous_flag = self._intensities_original_index.anomalous_flag()
-
+    from cctbx import miller
     ma = self._intensities_original_index
-    original_indices = ma.indices()
-    unique_indices = original_indices.deep_copy()
-    isym = flex.int(unique_indices.size())
-
-    miller.map_to_asu_isym(sg_type, anomalous_flag, unique_indices, isym)
-
-    n_plus, n_minus = 0, 0
-
-    for iref in range(len(original_indices)):
-      h_orig = original_indices[iref]
-      h_uniq = unique_indices[iref]
-      h_isym = isym[iref]
-
-      h_eq = miller.sym_equiv_indices(sg, h_uniq)
-      if h_eq.is_centric():
-        flag = observation_group.CENTRIC
-      else:
-        asu_which = asu.which(h_uniq)
-        assert asu_which != 0
-        if asu_which == 1:
-          flag = observation_group.PLUS
-        else:
-          flag = observation_group.MINUS
-          h_uniq = tuple(-1*h for h in h_uniq)
-
-      group = self._observations.get(h_uniq)
-      if group is None:
-        group = observation_group(
-          h_uniq, is_centric=(flag == observation_group.CENTRIC))
-        self._observations[h_uniq] = group
-      if flag == observation_group.MINUS:
-        n_minus += 1
-        group.add_iminus(iref)
-      else:
-        n_plus += 1
-        group.add_iplus(iref)
+    sg_type = ma.space_group().type()
+
+    # the group of an observation is its non-anomalous ASU index; acentric
+    # observations whose anomalous ASU index differs from it are I-
+    asu_indices = ma.indices().deep_copy()
+    miller.map_to_asu(sg_type, False, asu_indices)
+    hkl = miller_indices_as_numpy(asu_indices)
+
+    centric = ma.centric_flags().data().as_numpy_array()
+    flags = np.where(centric, observation_group.CENTRIC,
+                     observation_group.PLUS).astype(np.int8)
+    if ma.anomalous_flag():
+      anom_indices = ma.indices().deep_copy()
+      miller.map_to_asu(sg_type, True, anom_indices)
+      minus = np.any(miller_indices_as_numpy(anom_indices) != hkl, axis=1)
+      flags[minus & ~centric] = observation_group.MINUS
+
+    self._keys, self._group_index = np.unique(
+      hkl_keys(hkl), return_inverse=True)
+    self._group_index = self._group_index.reshape(-1)
+    self._perm = np.argsort(self._group_index, kind='mergesort')
+    self._offsets = np.append(
+      0, np.cumsum(np.bincount(self._group_index, minlength=self._keys.size)))
+    self._flags = flags
+    self._unique_hkl = hkl[self._perm[self._offsets[:-1]]]
+
+  def _group(self, i_group):
+    irefs = self._perm[self._offsets[i_group]:self._offsets[i_group+1]]
+    flags = self._flags[irefs]
+    minus = flags == observation_group.MINUS
+    h_uniq = tuple(int(h) for h in self._unique_hkl[i_group])
+    return observation_group(
+      h_uniq, is_centric=bool(flags[0] == observation_group.CENTRIC),
+      iplus=flex.size_t(irefs[~minus].tolist()),
+      iminus=flex.size_t(irefs[minus].tolist()))
+
+  def _find(self, hkl):
+    key = hkl_keys(np.array([hkl], dtype=np.int64))[0]
+    i_group = np.searchsorted(self._keys, key)
+    if i_group < self._keys.size and self._keys[i_group] == key:
+      return i_group
+    return None
 
   def __iter__(self):
-    return self._observations.iteritems()
+    for i_group in range(len(self)):
+      group = self._group(i_group)
+      yield group.asu_index, group
 
   def __getitem__(self, hkl):
-    return self._observations[hkl]
+    i_group = self._find(hkl)
+    if i_group is None:
+      raise KeyError(hkl)
+    return self._group(i_group)
 
   def __len__(self):
-    return len(self._observations)
+    return self._keys.size
 
   def __contains__(self, hkl):
-    return hkl in self._observations
+    return self._find(hkl) is not None
+
+  @property
+  def group_index(self):
+    '''Index of the unique reflection each observation belongs to, in order
+    of increasing ASU index.'''
+    return self._group_index
+
+  @property
+  def flags(self):
+    '''observation_group.PLUS, MINUS or CENTRIC for each observation.'''
+    return self._flags
+
+
+class pair_accumulator(object):
+  '''Enumerate all pairs of observations within groups without looping over
+  the pairs in Python.
+
+  Observations are sorted by group and then by dose, so that in every pair
+  (i, j) generated the second observation j has the later (or equal) dose.
+  Pairs are generated for all groups of the same multiplicity at once, in
+  chunks of at most max_pairs pairs. Observations with a negative group
+  index are ignored.
+  '''
+
+  def __init__(self, group, dose, max_pairs=2**22):
+    group = np.asarray(group)
+    dose = np.asarray(dose)
+    perm = np.lexsort((dose, group))
+    perm = perm[group[perm] >= 0]
+    sorted_group = group[perm]
+    is_start = np.ones(perm.size, dtype=bool)
+    is_start[1:] = sorted_group[1:] != sorted_group[:-1]
+    self._n = group.size
+    self._perm = perm
+    self._starts = np.flatnonzero(is_start)
+    self._sizes = np.diff(np.append(self._starts, perm.size))
+    self._max_pairs = max_pairs
+
+  def pairs(self):
+    '''Yield (i, j) arrays of observation indices for all pairs, with
+    dose[i] <= dose[j].'''
+    for m in np.unique(self._sizes):
+      if m < 2:
+        continue
+      starts = self._starts[self._sizes == m]
+      a, b = np.triu_indices(m, 1)
+      chunk = max(1, self._max_pairs // a.size)
+      for k in range(0, starts.size, chunk):
+        s = starts[k:k+chunk, np.newaxis]
+        yield self._perm[(s + a).ravel()], self._perm[(s + b).ravel()]
+
+  def pair_sums(self, values):
+    '''For each observation j, the sum of (v_i + v_j) over all pairs in which
+    j is the later observation, computed with cumulative sums over the
+    dose-sorted groups. Returned in the original observation order.'''
+    v = np.asarray(values, dtype=np.float64)[self._perm]
+    group_start = np.repeat(self._starts, self._sizes)
+    rank = np.arange(self._perm.size) - group_start
+    cumulative = np.cumsum(v)
+    earlier = cumulative - v - (cumulative - v)[group_start]
+    result = np.zeros(self._n, dtype=np.float64)
+    result[self._perm] = earlier + rank * v
+    return result
+
+  def pair_counts(self):
+    '''For each observation, the number of pairs in which it is the later
+    observation.'''
+    rank = np.arange(self._perm.size) - np.repeat(self._starts, self._sizes)
+    result = np.zeros(self._n, dtype=np.int64)
+    result[self._perm] = rank
+    return result
+
+
+def _as_flex_double(a):
+  return flex.double(a.tolist())
+
+
+def _round_half_away_from_zero(x):
+  '''Python 2 round() semantics, as opposed to numpy's round half to even.'''
+  return np.copysign(np.floor(np.abs(x) + 0.5), x)
+
 
 class PyStatistics(object):
   def __init__(self, intensities, dose, n_bins=8, range_min=None,
@@ -180,210 +275,157 @@ def __init__(self, intensities, dose, n_bins=8, range_min=None,
     self._calc_rcp_scp()
     self._calc_rd()
 
-  def _calc_completeness_vs_dose(self):
-
-    iplus_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
-    iminus_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
-    ieither_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
-    iboth_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
-
-    for h_uniq, observed in self.observations:
-      #if observed.is_minus():
-        #continue
-
-      #irefs = list(observed.irefs)
-      dose_min_iplus = self.range_max + self.range_width
-      dose_min_iminus = self.range_max + self.range_width
-
-      if observed.iplus.size():
-        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iplus[0]]) - 1
-      else:
-        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iminus[0]]) - 1
-
-      if i_bin < 0:
-        continue
-
-      for i, i_ref in enumerate(observed.iplus):
-        dose_i = self.dose[i_ref]
-        dose_min_iplus = min(dose_i, dose_min_iplus)
-        if observed.is_centric():
-          dose_min_iminus = min(dose_i, dose_min_iminus)
-
-      for i, i_ref in enumerate(observed.iminus):
-        assert i_ref not in observed.iplus
-        dose_i = self.dose[i_ref]
-        dose_min_iminus = min(dose_i, dose_min_iminus)
-
-      start_iplus = int((dose_min_iplus - self.range_min)/self.range_width)
-      start_iminus = int((dose_min_iminus - self.range_min)/self.range_width)
-
-      if start_iplus < self.n_steps:
-        iplus_count[i_bin][start_iplus] += 1
-      if start_iminus < self.n_steps:
-        iminus_count[i_bin][start_iminus] += 1
-      if min(start_iplus, start_iminus) < self.n_steps:
-        ieither_count[i_bin][min(start_iplus, start_iminus)] += 1
-      if max(start_iplus, start_iminus) < self.n_steps:
-        iboth_count[i_bin][max(start_iplus, start_iminus)] += 1
-
-    # now accumulate as a function of time
-
-    for i_bin in xrange(self.n_bins):
-      for j in range(1, self.n_steps):
-        iplus_count[i_bin][j] += iplus_count[i_bin][j - 1]
-        iminus_count[i_bin][j] += iminus_count[i_bin][j - 1]
-        ieither_count[i_bin][j] += ieither_count[i_bin][j - 1]
-        iboth_count[i_bin][j] += iboth_count[i_bin][j - 1]
+  def _observation_bins(self):
+    '''Zero-based resolution bin of each observation, -1 if outside.'''
+    i_bin = self.binner.bin_indices().as_numpy_array().astype(np.int64) - 1
+    i_bin[i_bin >= self.n_bins] = -1
+    return i_bin
 
-    # accumulate as a function of dose and resolution
+  def _calc_completeness_vs_dose(self):
 
-    iplus_comp_overall = flex.double(self.n_steps, 0)
-    iminus_comp_overall = flex.double(self.n_steps, 0)
-    ieither_comp_overall = flex.double(self.n_steps, 0)
-    iboth_comp_overall = flex.double(self.n_steps, 0)
+    dose = self.dose.as_numpy_array().astype(np.float64)
+    group = self.observations.group_index
+    flags = self.observations.flags
+    n_groups = len(self.observations)
+
+    group_bin = np.full(n_groups, -1, dtype=np.int64)
+    group_bin[group] = self._observation_bins()
+
+    # first dose at which I+ and I- of each unique reflection were observed,
+    # where centric observations count towards both
+    never = self.range_max + self.range_width
+    dose_min_iplus = np.full(n_groups, never, dtype=np.float64)
+    dose_min_iminus = np.full(n_groups, never, dtype=np.float64)
+    plus = flags != observation_group.MINUS
+    minus = flags != observation_group.PLUS
+    np.minimum.at(dose_min_iplus, group[plus], dose[plus])
+    np.minimum.at(dose_min_iminus, group[minus], dose[minus])
+
+    start_iplus = (
+      (dose_min_iplus - self.range_min)/self.range_width).astype(np.int64)
+    start_iminus = (
+      (dose_min_iminus - self.range_min)/self.range_width).astype(np.int64)
+
+    def cumulative_count(start):
+      sel = (group_bin >= 0) & (start < self.n_steps)
+      count = np.bincount(group_bin[sel] * self.n_steps + start[sel],
+                          minlength=self.n_bins * self.n_steps)
+      return np.cumsum(
+        count.reshape(self.n_bins, self.n_steps), axis=1).astype(np.float64)
+
+    # accumulated as a function of dose and resolution
+
+    iplus_count = cumulative_count(start_iplus)
+    iminus_count = cumulative_count(start_iminus)
+    ieither_count = cumulative_count(np.minimum(start_iplus, start_iminus))
+    iboth_count = cumulative_count(np.maximum(start_iplus, start_iminus))
 
     binner_non_anom = self.intensities.as_non_anomalous_array().use_binning(
       self.binner)
-    n_complete = binner_non_anom.counts_complete()[1:-1]
-
-    for i_bin in xrange(self.n_bins):
-      iplus_comp_overall += iplus_count[i_bin]
-      iminus_comp_overall += iminus_count[i_bin]
-      ieither_comp_overall += ieither_count[i_bin]
-      iboth_comp_overall += iboth_count[i_bin]
-
-      iplus_count[i_bin] /= n_complete[i_bin]
-      iminus_count[i_bin] /= n_complete[i_bin]
-      ieither_count[i_bin] /= n_complete[i_bin]
-      iboth_count[i_bin] /= n_complete[i_bin]
-
-    tot_n_complete = sum(n_complete)
-    iplus_comp_overall /= tot_n_complete
-    iminus_comp_overall /= tot_n_complete
-    ieither_comp_overall /= tot_n_complete
-    iboth_comp_overall /= tot_n_complete
-
-    self.iplus_comp_bins = iplus_count
-    self.iminus_comp_bins = iminus_count
-    self.ieither_comp_bins = ieither_count
-    self.iboth_comp_bins = iboth_count
-    self.iplus_comp_overall = iplus_comp_overall
-    self.iminus_comp_overall = iminus_comp_overall
-    self.ieither_comp_overall = ieither_comp_overall
-    self.iboth_comp_overall = iboth_comp_overall
+    n_complete = np.array(
+      list(binner_non_anom.counts_complete()[1:-1]), dtype=np.float64)
+    tot_n_complete = n_complete.sum()
+
+    def per_bin(count):
+      return [_as_flex_double(row) for row in count / n_complete[:, np.newaxis]]
+
+    self.iplus_comp_bins = per_bin(iplus_count)
+    self.iminus_comp_bins = per_bin(iminus_count)
+    self.ieither_comp_bins = per_bin(ieither_count)
+    self.iboth_comp_bins = per_bin(iboth_count)
+    self.iplus_comp_overall = _as_flex_double(
+      iplus_count.sum(axis=0) / tot_n_complete)
+    self.iminus_comp_overall = _as_flex_double(
+      iminus_count.sum(axis=0) / tot_n_complete)
+    self.ieither_comp_overall = _as_flex_double(
+      ieither_count.sum(axis=0) / tot_n_complete)
+    self.iboth_comp_overall = _as_flex_double(
+      iboth_count.sum(axis=0) / tot_n_complete)
 
   def _calc_rcp_scp(self):
 
-    A = [[0] * self.n_steps for i in xrange(self.n_bins)]
-    B = [[0] * self.n_steps for i in xrange(self.n_bins)]
-    isigma = [[0] * self.n_steps for i in xrange(self.n_bins)]
-    count = [[0] * self.n_steps for i in xrange(self.n_bins)]
-
-    intensities_data = self.intensities.data()
-    sigmas = self.intensities.sigmas()
-
-    def accumulate(irefs, i_bin):
-      if i_bin < 0:
-        return
-      for i, i_ref in enumerate(irefs):
-        dose_i = self.dose[i_ref]
-        I_i = intensities_data[i_ref]
-        sigi_i = sigmas[i_ref]
-        for j, j_ref in enumerate(irefs[i+1:]):
-          I_j = intensities_data[j_ref]
-          sigi_j = sigmas[j_ref]
-          A_part = math.fabs(I_i - I_j)
-          B_part = 0.5 * math.fabs(I_i + I_j)
-          dose_j = self.dose[j_ref]
-          dose_0 = int((max(dose_i, dose_j) - self.range_min)/self.range_width)
-          A[i_bin][dose_0] += A_part
-          B[i_bin][dose_0] += B_part
-          isigma[i_bin][dose_0] += ((I_i/sigi_i) + (I_j/sigi_j))
-          count[i_bin][dose_0] += 2
-
-    for h_uniq, observed in self.observations:
-      if len(observed.iplus) > 1:
-        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iplus[0]]) - 1
-        accumulate(list(observed.iplus), i_bin)
-      if len(observed.iminus) > 1:
-        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iminus[0]]) - 1
-        accumulate(list(observed.iminus), i_bin)
+    dose = self.dose.as_numpy_array().astype(np.float64)
+    intensities = self.intensities.data().as_numpy_array()
+    sigmas = self.intensities.sigmas().as_numpy_array()
+    i_bin = self._observation_bins()
+
+    # pairs are formed separately within I+ and I- of each unique reflection
+    group = 2 * self.observations.group_index + (
+      self.observations.flags == observation_group.MINUS)
+    group[i_bin < 0] = -1
+    accumulator = pair_accumulator(group, dose)
+
+    # every pair is accumulated at the dose of its later observation
+    size = self.n_bins * self.n_steps
+    dose_bin = i_bin * self.n_steps + (
+      (dose - self.range_min)/self.range_width).astype(np.int64)
+
+    A = np.zeros(size, dtype=np.float64)
+    B = np.zeros(size, dtype=np.float64)
+    for i, j in accumulator.pairs():
+      A += np.bincount(dose_bin[j], minlength=size,
+                       weights=np.abs(intensities[i] - intensities[j]))
+      B += np.bincount(dose_bin[j], minlength=size,
+                       weights=0.5 * np.abs(intensities[i] + intensities[j]))
+
+    sel = group >= 0
+    isigma = np.bincount(
+      dose_bin[sel], minlength=size,
+      weights=accumulator.pair_sums(intensities / sigmas)[sel])
+    count = 2 * np.bincount(
+      dose_bin[sel], minlength=size, weights=accumulator.pair_counts()[sel])
 
     # now accumulate as a function of time
 
-    for i_bin in xrange(self.n_bins):
-      for j in xrange(1, self.n_steps):
-        A[i_bin][j] += A[i_bin][j-1]
-        B[i_bin][j] += B[i_bin][j-1]
-        isigma[i_bin][j] += isigma[i_bin][j-1]
-        count[i_bin][j] += count[i_bin][j-1]
+    shape = (self.n_bins, self.n_steps)
+    A = np.cumsum(A.reshape(shape), axis=1)
+    B = np.cumsum(B.reshape(shape), axis=1)
+    isigma = np.cumsum(isigma.reshape(shape), axis=1)
+    count = np.cumsum(count.reshape(shape), axis=1)
 
     # accumulate as a function of dose and resolution
 
-    rcp_overall = flex.double(self.n_steps, 0)
-    rcp_bins = [flex.double(self.n_steps, 0) for i in range(self.n_bins)]
-    scp_overall = flex.double(self.n_steps, 0)
-    scp_bins = [flex.double(self.n_steps, 0) for i in range(self.n_bins)]
-
-    for j in xrange(self.n_steps):
-
-      for i_bin in xrange(self.n_bins):
-        top = A[i_bin][j]
-        bottom = B[i_bin][j]
-
-        rcp = 0.0
-        scp = 0.
-
-        if bottom > 0:
-          rcp = top / bottom
-          if count[i_bin][j] > 100:
-            isig = isigma[i_bin][j] / count[i_bin][j]
-            scp = rcp / (1.1284 / isig)
-
-          rcp_bins[i_bin][j] = rcp
-          scp_bins[i_bin][j] = scp
-
-      ot = sum(A[i_bin][j] for i_bin in xrange(self.n_bins))
-      ob = sum(B[i_bin][j] for i_bin in xrange(self.n_bins))
-
-      if ob > 0:
-        overall = ot / ob
-      else:
-        overall = 0.
-      rcp_overall[j] = overall
-
-      scp_overall[j] = sum(scp_bins[i_bin][j] for i_bin in xrange(self.n_bins))/self.n_bins
-
-    self.rcp_bins = rcp_bins
-    self.rcp = rcp_overall
-    self.scp_bins = scp_bins
-    self.scp = scp_overall
+    with np.errstate(divide='ignore', invalid='ignore'):
+      rcp_bins = np.where(B > 0, A / B, 0.)
+      isig = isigma / count
+      scp_bins = np.where(
+        (B > 0) & (count > 100), rcp_bins / (1.1284 / isig), 0.)
+      ot = A.sum(axis=0)
+      ob = B.sum(axis=0)
+      rcp_overall = np.where(ob > 0, ot / ob, 0.)
+    scp_overall = scp_bins.sum(axis=0) / self.n_bins
+
+    self.rcp_bins = [_as_flex_double(row) for row in rcp_bins]
+    self.rcp = _as_flex_double(rcp_overall)
+    self.scp_bins = [_as_flex_double(row) for row in scp_bins]
+    self.scp = _as_flex_double(scp_overall)
 
   def _calc_rd(self):
 
-    rd_top = [0] * self.n_steps
-    rd_bottom = [0] * self.n_steps
-
-    intensities_data = self.intensities.data()
-
-    for h_uniq, observed in self.observations:
-      irefs = list(observed.iplus) + list(observed.iminus)
-      if len(irefs) == 1:
-        # lone observation, no pairs
-        continue
-      for i, i_ref in enumerate(irefs):
-        dose_i = self.dose[i_ref]
-        I_i = intensities_data[i_ref]
-        for j, j_ref in enumerate(irefs[i+1:]):
-          I_j = intensities_data[j_ref]
-          dose_j = self.dose[j_ref]
-          d_dose = int(
-            round(math.fabs(dose_i - dose_j) - self.range_min)/self.range_width)
-          rd_top[d_dose] += math.fabs(I_i - I_j)
-          rd_bottom[d_dose] += 0.5 * (I_i + I_j)
-
-    self.rd = flex.double(rd_top[i]/rd_bottom[i] if rd_bottom[i] > 0 else 0
-                          for i in xrange(self.n_steps))
+    dose = self.dose.as_numpy_array().astype(np.float64)
+    intensities = self.intensities.data().as_numpy_array()
+    accumulator = pair_accumulator(self.observations.group_index, dose)
+
+    rd_top = np.zeros(self.n_steps, dtype=np.float64)
+    rd_bottom = np.zeros(self.n_steps, dtype=np.float64)
+
+    for i, j in accumulator.pairs():
+      d_dose = np.trunc(_round_half_away_from_zero(
+        np.abs(dose[i] - dose[j]) - self.range_min) / self.range_width
+      ).astype(np.int64)
+      # negative dose differences index from the end, as they always have
+      d_dose[d_dose < 0] += self.n_steps
+      # and dose differences beyond the steps are left out
+      sel = (d_dose >= 0) & (d_dose < self.n_steps)
+      d_dose, i, j = d_dose[sel], i[sel], j[sel]
+      rd_top += np.bincount(d_dose, minlength=self.n_steps,
+                            weights=np.abs(intensities[i] - intensities[j]))
+      rd_bottom += np.bincount(d_dose, minlength=self.n_steps,
+                               weights=0.5 * (intensities[i] + intensities[j]))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      self.rd = _as_flex_double(
+        np.where(rd_bottom > 0, rd_top / rd_bottom, 0.))
 
   def print_completeness_vs_dose(self):
 
@@ -0,0 +1,118 @@
+from __future__ import absolute_import, division, print_function
+
+import copy
+import os
+
+from xia2.Handlers.Streams import Debug
+
+# the resolution criteria, as the name of the limit in the resolution
+# parameters, the resolutionizer method which applies it and the reasoning
+# reported when it determines the resolution
+criteria = (
+  ('completeness', 'resolution_completeness', 'completeness > %s'),
+  ('cc_half', 'resolution_cc_half', 'cc_half > %s'),
+  ('rmerge', 'resolution_rmerge', 'rmerge > %s'),
+  ('isigma', 'resolution_unmerged_isigma', 'unmerged <I/sigI> > %s'),
+  ('misigma', 'resolution_merged_isigma', 'merged <I/sigI> > %s'),
+)
+
+class scaled_unmerged_data(object):
+  '''The unmerged intensities from a scaled MTZ file, with the batch of
+  each, from which the data for any batch range may be selected.'''
+
+  def __init__(self, hklin):
+    import iotbx.merging_statistics
+    from iotbx.reflection_file_reader import any_reflection_file
+
+    self._hklin = hklin
+    self.i_obs = iotbx.merging_statistics.select_data(hklin, data_labels=None)
+    self.batches = None
+    for ma in any_reflection_file(hklin).as_miller_arrays(
+        merge_equivalents=False):
+      if ma.info().labels == ['BATCH']:
+        self.batches = ma.data()
+
+  def select(self, batch_range=None):
+    if batch_range is None:
+      return self.i_obs
+
+    if self.batches is None or self.batches.size() != self.i_obs.size():
+      raise RuntimeError('no batches for reflections in %s' % self._hklin)
+
+    start, end = batch_range
+    sel = (self.batches >= start) & (self.batches <= end)
+    return self.i_obs.select(sel).set_info(self.i_obs.info())
+
+# the estimator being run, for the worker processes forked from this one
+_estimator = None
+
+def _estimate(job):
+  return _estimator.estimate(*job)
+
+class resolution_estimator(object):
+  '''Estimate resolution limits in process for any number of (hklin,
+  batch range) pairs, reading each reflection file only once however many
+  batch ranges are taken from it and sharing the work between nproc
+  processes.'''
+
+  def __init__(self, params, nproc=1):
+    self._params = copy.deepcopy(params)
+    self._params.batch_range = None
+    self._nproc = nproc
+    self._data = { }
+
+  def load(self, hklin):
+    hklin = os.path.abspath(hklin)
+    if not hklin in self._data:
+      self._data[hklin] = scaled_unmerged_data(hklin)
+    return self._data[hklin]
+
+  def estimate(self, hklin, batch_range=None):
+    '''Return the resolution limit from each of the criteria which are
+    set, keyed by the name of the criterion.'''
+
+    from dials.util.Resolutionizer import resolutionizer
+
+    i_obs = self.load(hklin).select(batch_range)
+    m = resolutionizer(i_obs, self._params)
+
+    limits = { }
+    for name, method, reasoning in criteria:
+      if getattr(self._params, name) is not None:
+        limits[name] = getattr(m, method)()
+    return limits
+
+  def estimate_all(self, jobs):
+    '''Estimate the limits for each of a list of (hklin, batch_range),
+    returning them in the same order.'''
+
+    global _estimator
+
+    jobs = [(os.path.abspath(hklin), batch_range)
+            for hklin, batch_range in jobs]
+    for hklin, batch_range in jobs:
+      Debug.write('Resolution analysis: %s%s' % (hklin,
+        '' if batch_range is None else ' batch_range=%i,%i' % batch_range))
+
+    nproc = min(self._nproc, len(jobs))
+    if nproc <= 1:
+      return [self.estimate(*job) for job in jobs]
+
+    # read any file shared between jobs here so that each worker inherits
+    # it, while files used for one job only are read by that job's worker
+    hklins = [hklin for hklin, batch_range in jobs]
+    for hklin in set(hklins):
+      if hklins.count(hklin) > 1:
+        self.load(hklin)
+
+    from libtbx import easy_mp
+    _estimator = self
+    try:
+      return easy_mp.parallel_map(
+        _estimate, jobs,
+        processes=nproc,
+        method='multiprocessing',
+        preserve_order=True,
+        preserve_exception_message=True)
+    finally:
+      _estimator = None
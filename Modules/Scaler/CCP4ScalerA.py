@@ -137,6 +137,22 @@ def _updated_aimless(self):
   def _pointless_indexer_jiffy(self, hklin, refiner):
     return self._helper.pointless_indexer_jiffy(hklin, refiner)
 
+  def _sweep_pointgroup(self, si, hklin, refiner):
+    '''Analyse the pointgroup of the integrated intensities hklin of one
+    sweep, unless this was done already when the sweep was integrated.'''
+
+    integrater = si.get_integrater()
+    analysis = integrater.get_integrater_pointgroup_analysis(hklin)
+    if analysis is not None:
+      pointgroup, reindex_op, pt = analysis
+      Debug.write('Using pointgroup analysis of %s from integration' % \
+                  si.get_sweep_name())
+      return pointgroup, reindex_op, False, pt
+
+    pointless_hklin = self._prepare_pointless_hklin(
+      hklin, integrater.get_phi_width())
+    return self._pointless_indexer_jiffy(pointless_hklin, refiner)
+
   def _pointless_indexer_multisweep(self, hklin, refiners):
     return self._helper.pointless_indexer_multisweep(hklin, refiners)
 
@@ -324,12 +340,8 @@ def _scale_prepare(self):
             ntr = False
 
           else:
-            pointless_hklin = self._prepare_pointless_hklin(
-              hklin, si.get_integrater().get_phi_width())
-
-            pointgroup, reindex_op, ntr, pt = \
-                        self._pointless_indexer_jiffy(
-                pointless_hklin, refiner)
+            pointgroup, reindex_op, ntr, pt = self._sweep_pointgroup(
+              si, hklin, refiner)
 
             Debug.write('X1698: %s: %s' % (pointgroup, reindex_op))
 
@@ -502,12 +514,8 @@ def _scale_prepare(self):
 
         else:
 
-          pointless_hklin = self._prepare_pointless_hklin(
-              hklin, si.get_integrater().get_phi_width())
-
-          pointgroup, reindex_op, ntr, pt = \
-                      self._pointless_indexer_jiffy(
-              pointless_hklin, refiner)
+          pointgroup, reindex_op, ntr, pt = self._sweep_pointgroup(
+            si, hklin, refiner)
 
           Debug.write('X1698: %s: %s' % (pointgroup, reindex_op))
 
@@ -924,6 +932,25 @@ def _scale(self):
     if len(resolution_info) == 0:
       raise RuntimeError('no resolution info')
 
+    # estimate the resolution limits for all of the sweeps which need them
+    # at once, reading the scaled reflections only once
+
+    hklin = sc.get_unmerged_reflection_file()
+    estimate_for = []
+
+    for epoch in epochs:
+      si = self._sweep_handler.get_sweep_information(epoch)
+      pname, xname, dname = si.get_project_info()
+      sname = si.get_sweep_name()
+      if not (dname, sname) in self._scalr_resolution_limits and \
+         not (dname, sname) in user_resolution_limits:
+        estimate_for.append(((dname, sname), tuple(si.get_batch_range())))
+
+    estimates = dict(zip(
+      [key for key, batch_range in estimate_for],
+      self._estimate_resolution_limits(
+        [(hklin, batch_range) for key, batch_range in estimate_for])))
+
     for epoch in epochs:
 
       si = self._sweep_handler.get_sweep_information(epoch)
@@ -944,9 +971,7 @@ def _scale(self):
                       (dname, limit))
         continue
 
-      hklin = sc.get_unmerged_reflection_file()
-      limit, reasoning = self._estimate_resolution_limit(
-        hklin, batch_range=(start, end))
+      limit, reasoning = estimates[(dname, sname)]
 
       if PhilIndex.params.xia2.settings.resolution.keep_all_reflections == True:
         suggested = limit
@@ -9,6 +9,7 @@
 
 from __future__ import absolute_import, division, print_function
 
+import copy
 import os
 
 from iotbx import mtz
@@ -21,8 +22,6 @@
     CCP4InterRadiationDamageDetector
 from xia2.Modules.Scaler.CCP4ScalerHelpers import anomalous_signals
 from xia2.Schema.Interfaces.Scaler import Scaler
-# new resolution limit code
-from xia2.Wrappers.XIA.Merger import Merger
 
 def clean_reindex_operator(reindex_operator):
   return reindex_operator.replace('[', '').replace(']', '')
@@ -38,6 +37,9 @@ def __init__(self):
     self._scalr_twinning_conclusion = None
     self._spacegroup_reindex_operator = None
 
+    # the unmerged data last read for the merging statistics
+    self._merging_statistics_data = None
+
   def _sort_together_data_ccp4(self):
     '''Sort together in the right order (rebatching as we go) the sweeps
     we want to scale together.'''
@@ -902,65 +904,52 @@ def _scale_finish_chunk_8_raddam(self):
       Debug.write('Local scaling failed')
 
   def _estimate_resolution_limit(self, hklin, batch_range=None):
-    params = PhilIndex.params.xia2.settings.resolution
-    m = Merger()
-    m.set_working_directory(self.get_working_directory())
-    from xia2.lib.bits import auto_logfiler
-    auto_logfiler(m)
-    m.set_hklin(hklin)
-    m.set_limit_rmerge(params.rmerge)
-    m.set_limit_completeness(params.completeness)
-    m.set_limit_cc_half(params.cc_half)
-    m.set_cc_half_significance_level(params.cc_half_significance_level)
-    m.set_limit_isigma(params.isigma)
-    m.set_limit_misigma(params.misigma)
+    return self._estimate_resolution_limits([(hklin, batch_range)])[0]
+
+  def _estimate_resolution_limits(self, jobs):
+    '''Estimate the resolution limit for each of a list of (hklin,
+    batch_range) at once, returning a list of (resolution, reasoning).'''
+
+    from xia2.Modules.ResolutionEstimator import criteria, \
+      resolution_estimator
+
+    params = copy.deepcopy(PhilIndex.params.xia2.settings.resolution)
     if PhilIndex.params.xia2.settings.small_molecule == True:
-      m.set_nbins(20)
-    if batch_range is not None:
-      start, end = batch_range
-      m.set_batch_range(start, end)
-    m.run()
-
-    resolution_limits = []
-    reasoning = []
-
-    if params.completeness is not None:
-      r_comp = m.get_resolution_completeness()
-      resolution_limits.append(r_comp)
-      reasoning.append('completeness > %s' % params.completeness)
-
-    if params.cc_half is not None:
-      r_cc_half = m.get_resolution_cc_half()
-      resolution_limits.append(r_cc_half)
-      reasoning.append('cc_half > %s' % params.cc_half)
-
-    if params.rmerge is not None:
-      r_rm = m.get_resolution_rmerge()
-      resolution_limits.append(r_rm)
-      reasoning.append('rmerge > %s' % params.rmerge)
-
-    if params.isigma is not None:
-      r_uis = m.get_resolution_isigma()
-      resolution_limits.append(r_uis)
-      reasoning.append('unmerged <I/sigI> > %s' % params.isigma)
-
-    if params.misigma is not None:
-      r_mis = m.get_resolution_misigma()
-      resolution_limits.append(r_mis)
-      reasoning.append('merged <I/sigI> > %s' % params.misigma)
-
-    if len(resolution_limits):
-      resolution = max(resolution_limits)
-      reasoning = [
-          reason for limit, reason in zip(resolution_limits, reasoning)
-          if limit >= resolution
-      ]
-      reasoning = ', '.join(reasoning)
+      params.nbins = 20
     else:
-      resolution = 0.0
-      reasoning = None
+      params.nbins = 100
+
+    nproc = PhilIndex.params.xia2.settings.multiprocessing.nproc
+    if not isinstance(nproc, int):
+      from xia2.Handlers.Environment import get_number_cpus
+      nproc = get_number_cpus()
+
+    results = []
+
+    for limits in resolution_estimator(params, nproc=nproc).estimate_all(jobs):
+      resolution_limits = []
+      reasoning = []
+
+      for name, method, reason in criteria:
+        if name in limits:
+          # to the precision reported by xia2.resolutionizer
+          resolution_limits.append(float('%.2f' % limits[name]))
+          reasoning.append(reason % getattr(params, name))
+
+      if len(resolution_limits):
+        resolution = max(resolution_limits)
+        reasoning = [
+            reason for limit, reason in zip(resolution_limits, reasoning)
+            if limit >= resolution
+        ]
+        reasoning = ', '.join(reasoning)
+      else:
+        resolution = 0.0
+        reasoning = None
+
+      results.append((resolution, reasoning))
 
-    return resolution, reasoning
+    return results
 
   def _compute_scaler_statistics(self, scaled_unmerged_mtz, selected_band=None, wave=None):
     ''' selected_band = (d_min, d_max) with None for automatic determination. '''
@@ -1069,47 +1058,131 @@ def _compute_scaler_statistics(self, scaled_unmerged_mtz, selected_band=None, wa
     return stats
 
   def _iotbx_merging_statistics(self, scaled_unmerged_mtz, anomalous=False, d_min=None, d_max=None, n_bins=None):
+    self._merging_statistics_data = merging_statistics_data.from_file(
+      scaled_unmerged_mtz, previous=self._merging_statistics_data)
+    return self._merging_statistics_data.dataset_statistics(
+      anomalous=anomalous, d_min=d_min, d_max=d_max, n_bins=n_bins)
+
+class merging_statistics_data(object):
+  '''The unmerged intensities from a scaled MTZ file, read once and shared
+  between all of the merging statistics calculations made from them (overall,
+  selected band, anomalous, and again with fewer bins if these fail), along
+  with the results of each of these and the anomalous probability plot. The
+  observations are mapped to the asymmetric unit and sorted into groups of
+  equivalents once, and this grouping is shared by all of the calculations,
+  each of which would otherwise map and sort all of the observations.'''
+
+  def __init__(self, scaled_unmerged_mtz):
+    import iotbx.merging_statistics
+
+    self._filename = os.path.abspath(scaled_unmerged_mtz)
+    self._file_key = self._key(self._filename)
+
+    i_obs = iotbx.merging_statistics.select_data(
+      scaled_unmerged_mtz, data_labels=None)
+    self._i_obs = i_obs.customized_copy(anomalous_flag=True, info=i_obs.info())
+    self._results = { }
+    self._anomalous_np_slopes = { }
+    self._asu_observations = { }
+
+  @staticmethod
+  def _key(filename):
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+
+  @classmethod
+  def from_file(cls, scaled_unmerged_mtz, previous=None):
+    '''Return the data for scaled_unmerged_mtz - previous, if this was
+    read from the same file and it has not changed since, else the data
+    read afresh.'''
+
+    filename = os.path.abspath(scaled_unmerged_mtz)
+    if previous is not None and previous._filename == filename and \
+        previous._file_key == cls._key(filename):
+      return previous
+    return cls(filename)
+
+  def dataset_statistics(self, anomalous=False, d_min=None, d_max=None,
+                         n_bins=None):
     import iotbx.merging_statistics
 
     params = PhilIndex.params.xia2.settings.merging_statistics
+    n_bins = n_bins or params.n_bins
+
+    key = (anomalous, d_min, d_max, n_bins, params.use_internal_variance,
+           params.eliminate_sys_absent)
+    if key in self._results:
+      return self._results[key]
 
-    i_obs = iotbx.merging_statistics.select_data(scaled_unmerged_mtz, data_labels=None)
-    i_obs = i_obs.customized_copy(anomalous_flag=True, info=i_obs.info())
+    # the systematic absences are already gone from the observations if
+    # they are to be eliminated
 
     result = iotbx.merging_statistics.dataset_statistics(
-        i_obs=i_obs,
+        i_obs=self.asu_observations(
+          eliminate_sys_absent=params.eliminate_sys_absent),
         d_min=d_min,
         d_max=d_max,
-        n_bins=n_bins or params.n_bins,
+        n_bins=n_bins,
         anomalous=anomalous,
         use_internal_variance=params.use_internal_variance,
-        eliminate_sys_absent=params.eliminate_sys_absent,
+        eliminate_sys_absent=False,
         assert_is_not_unique_set_under_symmetry=False,
     )
 
     if anomalous:
-      merged_intensities = i_obs.merge_equivalents(
-        use_internal_variance=params.use_internal_variance).array()
-      slope, intercept, n_pairs = anomalous_probability_plot(merged_intensities)
+      result.anomalous_np_slope = self.anomalous_np_slope()
+    else:
+      result.anomalous_np_slope = None
 
-      Debug.write('Anomalous difference normal probability plot:')
-      Debug.write('Slope: %.2f' % slope)
-      Debug.write('Intercept: %.2f' % intercept)
-      Debug.write('Number of pairs: %i' % n_pairs)
+    self._results[key] = result
+    return result
 
-      slope, intercept, n_pairs = anomalous_probability_plot(
-        merged_intensities, expected_delta=0.9)
-      result.anomalous_np_slope = slope
+  def asu_observations(self, eliminate_sys_absent=False):
+    '''The observations mapped to the asymmetric unit with Friedel mates
+    apart, and sorted into groups of equivalents with Friedel mates merged,
+    without systematically absent reflections if eliminate_sys_absent:
+    computed once for each. The sort is stable, so that the observations of
+    each reflection - with or without Friedel mates merged - keep the order
+    they had in the file, and the statistics from these are those from the
+    observations in the order in which they were read.'''
+
+    if eliminate_sys_absent not in self._asu_observations:
+      i_obs = self._i_obs.map_to_asu()
+      i_obs = i_obs.select(i_obs.customized_copy(
+        anomalous_flag=False).map_to_asu().sort_permutation('packed_indices'))
+      if eliminate_sys_absent:
+        i_obs = i_obs.eliminate_sys_absent()
+      self._asu_observations[eliminate_sys_absent] = i_obs.set_info(
+        self._i_obs.info())
+    return self._asu_observations[eliminate_sys_absent]
+
+  def anomalous_np_slope(self):
+    '''The slope of the anomalous difference normal probability plot for
+    the merged intensities (within expected delta 0.9), computed once.'''
 
-      Debug.write('Anomalous difference normal probability plot (within expected delta 0.9):')
-      Debug.write('Slope: %.2f' %slope)
-      Debug.write('Intercept: %.2f' %intercept)
-      Debug.write('Number of pairs: %i' %n_pairs)
+    params = PhilIndex.params.xia2.settings.merging_statistics
+    if params.use_internal_variance in self._anomalous_np_slopes:
+      return self._anomalous_np_slopes[params.use_internal_variance]
 
-    else:
-      result.anomalous_np_slope = None
+    merged_intensities = self.asu_observations().merge_equivalents(
+        use_internal_variance=params.use_internal_variance).array()
+    slope, intercept, n_pairs = anomalous_probability_plot(merged_intensities)
 
-    return result
+    Debug.write('Anomalous difference normal probability plot:')
+    Debug.write('Slope: %.2f' % slope)
+    Debug.write('Intercept: %.2f' % intercept)
+    Debug.write('Number of pairs: %i' % n_pairs)
+
+    slope, intercept, n_pairs = anomalous_probability_plot(
+      merged_intensities, expected_delta=0.9)
+    self._anomalous_np_slopes[params.use_internal_variance] = slope
+
+    Debug.write('Anomalous difference normal probability plot (within expected delta 0.9):')
+    Debug.write('Slope: %.2f' %slope)
+    Debug.write('Intercept: %.2f' %intercept)
+    Debug.write('Number of pairs: %i' %n_pairs)
+
+    return slope
 
 def anomalous_probability_plot(intensities, expected_delta=None):
   from scitbx.math import distributions
@@ -1077,6 +1077,22 @@ def _scale(self):
 
     debug_memory_usage()
 
+    # estimate the resolution limits for all of the sweeps which need them
+    # at once
+
+    estimate_for = []
+    if PhilIndex.params.xia2.settings.resolution.keep_all_reflections != True:
+      for epoch in self._sweep_information.keys():
+        dname = self._sweep_information[epoch]['dname']
+        sname = self._sweep_information[epoch]['sname']
+        if not (dname, sname) in self._scalr_resolution_limits and \
+           not self._user_resolution_limits.get((dname, sname), False):
+          estimate_for.append(epoch)
+
+    estimates = dict(zip(estimate_for, self._estimate_resolution_limits(
+      [(self._sweep_information[epoch]['scaled_reflections'], None)
+       for epoch in estimate_for])))
+
     for epoch in self._sweep_information.keys():
       hklin = self._sweep_information[epoch]['scaled_reflections']
       dname = self._sweep_information[epoch]['dname']
@@ -1105,7 +1121,7 @@ def _scale(self):
           except Exception:
             resolution, reasoning = self._estimate_resolution_limit(hklin)
         else:
-          resolution, reasoning = self._estimate_resolution_limit(hklin)
+          resolution, reasoning = estimates[epoch]
 
       reasoning_str = ''
       if reasoning:
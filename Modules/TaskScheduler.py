@@ -0,0 +1,176 @@
+from __future__ import absolute_import, division, print_function
+
+import multiprocessing
+import time
+import traceback
+
+def split_core_budget(ncores, njob=None, nproc=None, nsweeps=None):
+  '''Share ncores between njob simultaneous jobs with nproc processors
+  each. If one of njob, nproc is given the other is chosen to fit, else
+  run one single processor job per core - but never more jobs than there
+  are sweeps, giving any spare cores to the jobs which are run.'''
+
+  if njob is None:
+    if nproc is None:
+      njob = ncores
+    else:
+      njob = max(1, ncores // nproc)
+
+  if nsweeps:
+    njob = min(njob, nsweeps)
+
+  if nproc is None:
+    nproc = max(1, ncores // njob)
+
+  return njob, nproc
+
+def _run_task(func, args, catch=BaseException):
+  '''Run one task, passing back any exception as text rather than raising
+  it - in a worker this includes SystemExit and KeyboardInterrupt, which
+  would otherwise end the worker without a result.'''
+
+  start_time = time.time()
+  try:
+    return True, func(*args), time.time() - start_time
+  except catch:
+    return False, traceback.format_exc(), time.time() - start_time
+
+def _worker(connection, func, args):
+  '''Run one task in a worker process and send the result back.'''
+
+  result = _run_task(func, args)
+  try:
+    connection.send(result)
+  except BaseException:
+    connection.send((False, 'result could not be returned:\n%s' % \
+                     traceback.format_exc(), result[2]))
+  connection.close()
+
+class TaskScheduler(object):
+  '''Run a graph of named tasks. Each task is started as soon as all of
+  the tasks it depends on have finished, and is called with its own
+  arguments followed by their results. Up to njob tasks run at once, each
+  in a worker process forked from this one, unless added as local in
+  which case they run here (e.g. to update state held in this process).
+  A task which fails in any way - including its worker dying - is
+  recorded in errors, so run() always returns.'''
+
+  def __init__(self, njob):
+    self._njob = njob
+    self._tasks = { }
+    self._order = []
+
+    self.results = { }
+    self.errors = { }
+    self.timings = { }
+
+  def add_task(self, name, func, args=(), depends=(), local=False):
+    for dependency in depends:
+      if not dependency in self._tasks:
+        raise RuntimeError('task %s depends on unknown task %s' % \
+                           (name, dependency))
+    self._tasks[name] = (func, tuple(args), tuple(depends), local)
+    self._order.append(name)
+
+  def _finish(self, name, result):
+    success, value, duration = result
+    self.timings[name] = duration
+    if success:
+      self.results[name] = value
+    else:
+      self.errors[name] = value
+
+  def _ready(self, pending):
+    '''Find the pending tasks which can now be started, dropping those
+    which never will be because something they depend on failed.'''
+
+    ready = []
+    for name in list(pending):
+      depends = self._tasks[name][2]
+      failed = [d for d in depends if d in self.errors]
+      if failed:
+        pending.remove(name)
+        self.errors[name] = 'not run as task %s failed' % (failed[0],)
+      elif all(d in self.results for d in depends):
+        pending.remove(name)
+        ready.append(name)
+    return ready
+
+  def _start(self, name, args):
+    func = self._tasks[name][0]
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+      target=_worker, args=(sender, func, args))
+    process.daemon = True
+    process.start()
+    sender.close()
+    return process, receiver, time.time()
+
+  def _collect(self, running):
+    '''Wait for at least one running task to finish, and record the
+    result of every one which has.'''
+
+    while True:
+      done = []
+      for name, (process, receiver, start_time) in running.items():
+        if receiver.poll():
+          try:
+            result = receiver.recv()
+          except (EOFError, IOError):
+            process.join()
+            result = (False, 'worker process exited with code %s' % \
+                      process.exitcode, time.time() - start_time)
+          done.append((name, result))
+        elif not process.is_alive() and not receiver.poll():
+          result = (False, 'worker process exited with code %s' % \
+                    process.exitcode, time.time() - start_time)
+          done.append((name, result))
+
+      if done:
+        for name, result in done:
+          process, receiver, start_time = running.pop(name)
+          receiver.close()
+          process.join()
+          self._finish(name, result)
+        return
+
+      time.sleep(0.05)
+
+  def run(self):
+    '''Run all of the tasks, returning once every one has finished or
+    been abandoned; results and errors are keyed by task name.'''
+
+    pending = list(self._order)
+    waiting = []
+    running = { }
+
+    try:
+      while True:
+        ready = self._ready(pending)
+        for name in ready:
+          func, args, depends, local = self._tasks[name]
+          args = args + tuple(self.results[d] for d in depends)
+          if local:
+            self._finish(name, _run_task(func, args, catch=Exception))
+          else:
+            waiting.append((name, args))
+
+        if any(self._tasks[name][3] for name in ready):
+          # local tasks finished, so more may now be ready
+          continue
+
+        while waiting and len(running) < self._njob:
+          name, args = waiting.pop(0)
+          running[name] = self._start(name, args)
+
+        if not running:
+          break
+
+        self._collect(running)
+
+    finally:
+      for process, receiver, start_time in running.values():
+        process.terminate()
+        process.join()
+
+    return self.results
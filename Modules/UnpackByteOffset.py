@@ -5,75 +5,141 @@
 import struct
 import sys
 
-def pack_values(data):
-  current = 0
-  packed = ''
-
-  for d in data:
-    delta = d - current
-    if -127 < delta < 127:
-      packed += struct.pack('b', delta)
-      current = d
-      continue
-
-    packed += struct.pack('b', -128)
-    if -32767 < delta < 32767:
-      packed += struct.pack('<h', delta)
-      current = d
-      continue
+import numpy as np
+
+# length in bytes of a byte-offset element whose delta does not fit in the
+# escape levels 8, 16, 32 bit (the 64 bit escape needs no further marker)
+_ELEMENT_BYTES = (1, 3, 7, 15)
+
+def _delta_level(delta):
+  '''Index into _ELEMENT_BYTES of the smallest encoding of each delta.'''
+  level = np.zeros(delta.shape, dtype=np.int64)
+  level[np.abs(delta) >= 127] = 1
+  level[np.abs(delta) >= 32767] = 2
+  level[np.abs(delta) >= 2147483647] = 3
+  return level
+
+def _put_le(out, offsets, values, nbytes):
+  '''Write values as little-endian integers of nbytes bytes at the given
+  offsets of the uint8 array out.'''
+  values = values.astype(np.int64).view(np.uint64)
+  for k in range(nbytes):
+    out[offsets + k] = (values >> np.uint64(8 * k)) & np.uint64(0xff)
+
+def _get_le(buf, offsets, nbytes):
+  '''Read little-endian signed integers of nbytes bytes from the given
+  offsets of the uint8 array buf.'''
+  values = np.zeros(offsets.shape, dtype=np.uint64)
+  for k in range(nbytes):
+    values |= buf[offsets + k].astype(np.uint64) << np.uint64(8 * k)
+  if nbytes < 8:
+    sign = np.uint64(1 << (8 * nbytes - 1))
+    return (values ^ sign).astype(np.int64) - np.int64(1 << (8 * nbytes - 1))
+  return values.view(np.int64)
 
-    packed += struct.pack('<h', -32768)
-    if -2147483647 < delta < 2147483647:
-      packed += struct.pack('<i', delta)
-      current = d
-      continue
-
-    packed += struct.pack('<i', -2147483648)
-    packed += struct.pack('<q', delta)
-    current = d
-
-  return packed
+def pack_values(data):
+  '''Compress a sequence of integer pixel values with the CBF byte-offset
+  algorithm. The encoded stream is written into a preallocated buffer.'''
+
+  values = np.asarray(data, dtype=np.int64)
+  delta = values.copy()
+  delta[1:] -= values[:-1]
+  level = _delta_level(delta)
+  length = np.array(_ELEMENT_BYTES, dtype=np.int64)[level]
+  offsets = np.cumsum(length) - length
+
+  packed = bytearray(int(length.sum()))
+  out = np.frombuffer(packed, dtype=np.uint8)
+
+  # escape markers: -128 then -32768 then -2147483648 as needed
+  _put_le(out, offsets[level == 0], delta[level == 0], 1)
+  out[offsets[level > 0]] = 0x80
+  _put_le(out, offsets[level == 1] + 1, delta[level == 1], 2)
+  _put_le(out, offsets[level > 1] + 1, np.full((level > 1).sum(), -32768), 2)
+  _put_le(out, offsets[level == 2] + 3, delta[level == 2], 4)
+  _put_le(out, offsets[level > 2] + 3,
+          np.full((level > 2).sum(), -2147483648), 4)
+  _put_le(out, offsets[level == 3] + 7, delta[level == 3], 8)
+
+  return bytes(packed)
+
+def _unpack_deltas(data, length):
+  '''Decode the deltas of length pixel values from the start of a CBF
+  byte-offset stream, returning them with the number of bytes used.'''
+
+  # pad so that reading a truncated escape past the end is harmless
+  buf = np.frombuffer(bytes(data[:15 * length]) + b'\0' * 15, dtype=np.uint8)
+
+  # only bytes equal to -128 can start a multi-byte element; work out which
+  # of these candidates are real escapes (rather than part of the payload of
+  # an earlier escape) by following the chain of escapes from the start
+  candidates = np.flatnonzero(buf[:-15] == 0x80)
+  level = np.ones(candidates.shape, dtype=np.int64)
+  level[_get_le(buf, candidates + 1, 2) == -32768] = 2
+  level[(level == 2) & (_get_le(buf, candidates + 3, 4) == -2147483648)] = 3
+  element_end = candidates + np.array(_ELEMENT_BYTES)[level]
+  following = np.searchsorted(candidates, element_end).tolist()
+
+  escapes = []
+  i = 0
+  n_candidates = len(following)
+  while i < n_candidates:
+    escapes.append(i)
+    i = following[i]
+  escapes = np.array(escapes, dtype=np.int64)
+  start = candidates[escapes]
+  level = level[escapes]
+  end = element_end[escapes]
+
+  # every byte outside an escape payload starts an element
+  cover = np.zeros(buf.size + 1, dtype=np.int64)
+  cover[start + 1] += 1
+  cover[end] -= 1
+  element_start = np.flatnonzero(np.cumsum(cover[:-1]) == 0)[:length]
+
+  delta = buf[element_start].view(np.int8).astype(np.int64)
+  is_escape = np.zeros(buf.size, dtype=bool)
+  is_escape[start] = True
+  escaped = is_escape[element_start]
+  n_escaped = int(escaped.sum())
+  delta[escaped] = np.select(
+    [level == 1, level == 2, level == 3],
+    [_get_le(buf, start + 1, 2), _get_le(buf, start + 3, 4),
+     _get_le(buf, start + 7, 8)])[:n_escaped]
+
+  if not element_start.size:
+    used = 0
+  elif escaped[-1]:
+    used = int(end[n_escaped - 1])
+  else:
+    used = int(element_start[-1]) + 1
+
+  return delta, used
 
 def unpack_values(data, length):
-  # unpack data stream
-
-  values = []
+  '''Decode length pixel values from a CBF byte-offset stream, returning a
+  numpy int64 array.'''
 
-  pixel = 0
-  ptr = 0
+  return np.cumsum(_unpack_deltas(data, length)[0])
 
-  while len(values) < length:
+def iter_unpack_values(data, length, chunk_size=1 << 20, offset=0):
+  '''Decode length pixel values from a CBF byte-offset stream starting at
+  offset in data (which may be e.g. a mmap) chunk_size values at a time,
+  yielding each chunk as a numpy int64 array - so that the whole image need
+  never be held.'''
 
-    delta = struct.unpack('b', data[ptr])[0]
-    ptr += 1
-
-    if delta != -128:
-      pixel += delta
-      values.append(pixel)
-      continue
-
-    delta = struct.unpack('<h', data[ptr:ptr + 2])[0]
-    ptr += 2
-
-    if delta != -32768:
-      pixel += delta
-      values.append(pixel)
-      continue
-
-    delta = struct.unpack('<i', data[ptr:ptr + 4])[0]
-    ptr += 4
-
-    if delta != -2147483648:
-      pixel += delta
-      values.append(pixel)
-      continue
-
-    delta = struct.unpack('<q', data[ptr:ptr + 8])[0]
-    ptr += 8
-    pixel += delta
-    values.append(pixel)
-
-  return values
+  position = offset
+  current = 0
+  while length > 0:
+    n = min(chunk_size, length)
+    delta, used = _unpack_deltas(data[position:position + 15 * n], n)
+    if delta.size < n:
+      raise RuntimeError('byte offset data truncated')
+    values = np.cumsum(delta) + current
+    current = int(values[-1])
+    position += used
+    length -= n
+    yield values
 
 def unpack_tiff(filename):
   data = open(filename, 'rb'), read()
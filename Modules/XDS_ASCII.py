@@ -14,8 +14,117 @@
 
 from __future__ import absolute_import, division, print_function
 
+import itertools
+import mmap
 import os
 
+import numpy as np
+
+class XDSReflectionFile(object):
+  '''Memory-mapped reader for XDS reflection files (INTEGRATE.HKL,
+  XDS_ASCII.HKL). The ! header is parsed once; the data records are then
+  returned as arrays of floats a chunk at a time, so the whole file is
+  never held in memory.'''
+
+  def __init__(self, filename):
+    self._filename = filename
+    self._file = open(filename, 'rb')
+    if os.fstat(self._file.fileno()).st_size:
+      self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      self._data = b''
+
+    # the header is every ! record up to the first data record, and the
+    # trailer every ! record after the last one (found only when needed)
+
+    end = 0
+    while self._data[end:end + 1] == b'!':
+      newline = self._data.find(b'\n', end)
+      end = len(self._data) if newline < 0 else newline + 1
+    self._data_start = end
+    self._data_end = None
+    self._header = self._data[:self._data_start].decode('latin-1')
+
+    self._n_columns = None
+    for record in self._header.split('\n'):
+      if record.startswith('!NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD='):
+        self._n_columns = int(record.split('=')[1].split()[0])
+    if self._n_columns is None and self._data_start < len(self._data):
+      first = self._data[self._data_start:self._data.find(
+        b'\n', self._data_start)]
+      self._n_columns = len(first.split())
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if isinstance(self._data, mmap.mmap):
+      self._data.close()
+    self._file.close()
+
+  def _find_data_end(self):
+    if self._data_end is None:
+      trailer = self._data.find(b'\n!', self._data_start)
+      self._data_end = len(self._data) if trailer < 0 else trailer + 1
+      if self._data_start == len(self._data):
+        self._data_end = self._data_start
+    return self._data_end
+
+  def header(self):
+    '''The ! records preceding the data, as a string.'''
+    return self._header
+
+  def header_records(self):
+    '''The header records, with the leading ! removed.'''
+    return [record[1:] for record in self._header.split('\n') if record]
+
+  def trailer(self):
+    '''The ! records following the data (e.g. !END_OF_DATA).'''
+    return self._data[self._find_data_end():].decode('latin-1')
+
+  def n_columns(self):
+    return self._n_columns
+
+  def chunks(self, chunk_size=1 << 24):
+    '''Yield (text, values) for successive blocks of about chunk_size bytes
+    of data records, where values is an array of shape (n, n_columns)
+    holding the n records in the text.'''
+
+    self._find_data_end()
+    start = self._data_start
+    while start < self._data_end:
+      end = min(start + chunk_size, self._data_end)
+      if end < self._data_end:
+        end = self._data.rfind(b'\n', start, end) + 1
+        if end <= start:
+          end = self._data.find(b'\n', start + chunk_size, self._data_end) + 1
+          if end <= start:
+            end = self._data_end
+      text = self._data[start:end]
+      # fromstring may stop quietly at the first value it cannot read, so
+      # make sure that every record was read in full
+      try:
+        values = np.fromstring(text, dtype=np.float64, sep=' ')
+      except ValueError:
+        values = np.zeros(0)
+      n_records = text.count(b'\n') + (not text.endswith(b'\n'))
+      if values.size != n_records * self._n_columns:
+        n_records = len([r for r in text.splitlines() if r.strip()])
+        if values.size != n_records * self._n_columns:
+          raise RuntimeError(
+            'error reading %s: %d values read from %d records of %d' % (
+            self._filename, values.size, n_records, self._n_columns))
+      yield text, values.reshape(-1, self._n_columns)
+      start = end
+
+  def columns(self, indices, chunk_size=1 << 24):
+    '''Yield arrays of the selected columns, a chunk at a time.'''
+    for text, values in self.chunks(chunk_size=chunk_size):
+      yield values[:, indices]
+
 def remove_misfits(xdsin, xdsout):
   '''Read through the XDS_ASCII input file and remove the misfit
   reflections (SD < 0.0) - write out the remains to xdsout.'''
@@ -28,18 +137,15 @@ def remove_misfits(xdsin, xdsout):
 
   ignored = 0
 
-  with open(xdsin, 'r') as fin, open(xdsout, 'w') as fout:
-    for record in fin.readlines():
-      if not record.strip():
-        continue
-      if record[0] == '!':
-        fout.write(record)
-        continue
-      values = map(float, record.split())
-      if values[4] > 0.0:
-        fout.write(record)
-        continue
-      else:
-        ignored += 1
+  with XDSReflectionFile(xdsin) as fin, open(xdsout, 'wb') as fout:
+    fout.write(fin.header().encode('latin-1'))
+    for text, values in fin.chunks():
+      records = text.splitlines(True)
+      if len(records) != values.shape[0]:
+        records = [record for record in records if record.strip()]
+      keep = values[:, 4] > 0.0
+      ignored += int(keep.size - keep.sum())
+      fout.write(b''.join(itertools.compress(records, keep.tolist())))
+    fout.write(fin.trailer().encode('latin-1'))
 
   return ignored
@@ -133,6 +133,10 @@ def __init__(self):
 
     self._intgr_per_image_statistics = None
 
+    # the pointgroup analysis of the integrated intensities, if it has
+    # been made already (e.g. while other sweeps were being integrated)
+    self._intgr_pointgroup_analysis = None
+
   # serialization functions
 
   def to_dict(self):
@@ -704,6 +708,32 @@ def get_integrater_reindex_operator(self):
   def get_integrater_reindex_matrix(self):
     return self._intgr_reindex_matrix
 
+  def set_integrater_pointgroup_analysis(self, hklin, pointgroup, reindex_op,
+                                         probably_twinned):
+    '''Record the pointgroup analysis of the integrated intensities hklin,
+    so that the scaler need not repeat it while hklin is unchanged.'''
+
+    st = os.stat(hklin)
+    self._intgr_pointgroup_analysis = [
+      [hklin, st.st_size, st.st_mtime],
+      pointgroup, reindex_op, probably_twinned]
+
+  def get_integrater_pointgroup_analysis(self, hklin):
+    '''Return the recorded pointgroup, reindex operator and probably
+    twinned flag for hklin, or None if there is none for hklin as it is
+    now.'''
+
+    if self._intgr_pointgroup_analysis is None or not os.path.exists(hklin):
+      return None
+
+    st = os.stat(hklin)
+    state, pointgroup, reindex_op, probably_twinned = \
+      self._intgr_pointgroup_analysis
+    if list(state) != [hklin, st.st_size, st.st_mtime]:
+      return None
+
+    return pointgroup, reindex_op, probably_twinned
+
   # ------------------------------------------------
   # callback methods - overloading these is optional
   # ------------------------------------------------
@@ -0,0 +1,68 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import sys
+
+import mock
+import pytest
+
+def integrated(sweep):
+  '''The cell, wedge and number of reflections integrated for the sweep.'''
+
+  from iotbx.reflection_file_reader import any_reflection_file
+  intensities = sweep.get_integrater_intensities()
+  assert os.path.exists(intensities)
+  mtz_object = any_reflection_file(intensities).file_content()
+  return (sweep.get_integrater_cell(),
+          sweep._get_integrater().get_integrater_wedge(),
+          mtz_object.n_reflections())
+
+@pytest.mark.slow
+def test_process_one_sweep_in_process(ccp4, dials_regression, tmpdir):
+  from libtbx import group_args
+  from xia2.Applications import xia2_helpers
+  from xia2.Applications.xia2_main import get_command_line
+  from xia2.Handlers.CommandLine import CommandLine
+
+  image = os.path.join(dials_regression, 'xia2_demo_data', 'insulin_1_001.img')
+  command_line_args = ['image=%s' % image, 'nproc=1']
+
+  in_process = tmpdir.mkdir('in_process')
+  in_process.chdir()
+  with mock.patch.object(sys, 'argv', ['xia2'] + command_line_args):
+    CommandLine.setup()
+    crystals = get_command_line().get_xinfo().get_crystals()
+
+  xia2_helpers.register_sweeps(crystals)
+  (crystal_id, wavelength_id, sweep_id), sweep = \
+    list(xia2_helpers._sweeps.items())[0]
+  assert len(xia2_helpers._sweeps) == 1
+  assert sweep is \
+    crystals[crystal_id].get_xwavelength(wavelength_id).get_sweeps()[0]
+
+  args = group_args(
+    driver_type='simple', stop_after='integrate', failover=False,
+    command_line_args=command_line_args, nproc=1, crystal_id=crystal_id,
+    wavelength_id=wavelength_id, sweep_id=sweep_id)
+
+  success, output, xsweep_dict, duration = \
+    xia2_helpers.process_one_sweep_in_process((args,))
+  assert success
+  assert xsweep_dict == sweep.to_dict()
+  result = integrated(sweep)
+
+  # the same sweep processed by xia2.integrate, as it is without in_process
+  subprocess = tmpdir.mkdir('subprocess')
+  shutil.copy(in_process.join('xia2-working.phil').strpath,
+              subprocess.strpath)
+  subprocess.chdir()
+  success, output, xsweep_dict, duration = \
+    xia2_helpers.process_one_sweep((args,))
+  assert success
+  xia2_helpers.update_sweep(sweep, xsweep_dict)
+  expected = integrated(sweep)
+
+  assert result[0] == pytest.approx(expected[0], abs=1e-1)
+  assert result[1] == expected[1]
+  assert abs(result[2] - expected[2]) < 300
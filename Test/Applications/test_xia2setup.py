@@ -0,0 +1,185 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import pytest
+
+from xia2.Applications import xia2setup
+
+@pytest.fixture
+def classified(monkeypatch):
+  '''Count the files which are really classified, rather than found in
+  the cache.'''
+  calls = []
+  def classify_file(full_path):
+    calls.append(full_path)
+    return 'template', full_path.replace('_0001.img', '_####.img')
+  monkeypatch.setattr(xia2setup, 'classify_file', classify_file)
+  monkeypatch.setattr(xia2setup, 'target_template', None)
+  return calls
+
+def test_image_scan_cache_hit(tmpdir, classified):
+  image = tmpdir.join('images', 'x_0001.img').ensure()
+  cache_file = tmpdir.join('cache.json').strpath
+
+  cache = xia2setup.ImageScanCache(cache_file)
+  templates = xia2setup.scan_files([image.strpath], cache=cache)
+  cache.save()
+  assert templates == set([image.strpath.replace('_0001', '_####')])
+  assert classified == [image.strpath]
+
+  # a second scan, in a new process, needs only to stat the file
+  cache = xia2setup.ImageScanCache(cache_file)
+  assert xia2setup.scan_files([image.strpath], cache=cache) == templates
+  assert classified == [image.strpath]
+
+def test_image_scan_cache_invalidation(tmpdir, classified):
+  image = tmpdir.join('images', 'x_0001.img').ensure()
+  cache_file = tmpdir.join('cache.json').strpath
+
+  cache = xia2setup.ImageScanCache(cache_file)
+  xia2setup.scan_files([image.strpath], cache=cache)
+  cache.save()
+
+  # a rewritten file is classified again
+  image.write('more data')
+  cache = xia2setup.ImageScanCache(cache_file)
+  xia2setup.scan_files([image.strpath], cache=cache, nproc=2)
+  cache.save()
+  assert classified == [image.strpath] * 2
+
+  # as is one with a new modification time but the same size
+  stat = os.stat(image.strpath)
+  os.utime(image.strpath, (stat.st_atime, stat.st_mtime + 10))
+  cache = xia2setup.ImageScanCache(cache_file)
+  xia2setup.scan_files([image.strpath], cache=cache)
+  assert classified == [image.strpath] * 3
+
+  # and an unreadable cache is simply started again
+  tmpdir.join('cache.json').write('{not json')
+  cache = xia2setup.ImageScanCache(cache_file)
+  xia2setup.scan_files([image.strpath], cache=cache)
+  assert classified == [image.strpath] * 4
+
+def test_image_scan_cache_for_directory(tmpdir, monkeypatch):
+  monkeypatch.setenv('XDG_CACHE_HOME', tmpdir.join('cache').strpath)
+  images = tmpdir.join('images').ensure(dir=True)
+  link = tmpdir.join('link')
+  link.mksymlinkto(images)
+
+  # the same cache whichever way the directory is reached, and from
+  # wherever xia2 is run
+  cache = xia2setup.ImageScanCache.for_directory(images.strpath)
+  with tmpdir.join('elsewhere').ensure(dir=True).as_cwd():
+    assert xia2setup.ImageScanCache.for_directory(link.strpath)._filename \
+      == cache._filename
+  assert cache._filename.startswith(tmpdir.join('cache', 'xia2').strpath)
+  assert xia2setup.ImageScanCache.for_directory(
+    tmpdir.strpath)._filename != cache._filename
+
+def test_image_scan_cache_prune(tmpdir, classified):
+  images = [tmpdir.join('images', 'x_%04d.img' % j).ensure()
+            for j in (1, 2)]
+  cache_file = tmpdir.join('cache.json').strpath
+
+  cache = xia2setup.ImageScanCache(cache_file)
+  xia2setup.scan_files([image.strpath for image in images], cache=cache)
+  cache.save()
+
+  # files which have gone are forgotten, even if not scanned for
+  images[1].remove()
+  cache = xia2setup.ImageScanCache(cache_file)
+  cache.save()
+  assert list(xia2setup.ImageScanCache(cache_file)._entries) == \
+    [images[0].strpath]
+
+def test_image_scan_cache_eviction(tmpdir, monkeypatch):
+  import hashlib
+  import time
+
+  monkeypatch.setenv('XDG_CACHE_HOME', tmpdir.join('cache').strpath)
+  monkeypatch.setattr(xia2setup.ImageScanCache, 'max_files', 3)
+  cache_directory = tmpdir.join('cache', 'xia2', 'image-scan')
+
+  # caches for four directories, used a day apart, and one not used for
+  # longer than the maximum age
+  now = time.time()
+  caches = []
+  for j in range(5):
+    name = '%s.json' % hashlib.sha1(str(j).encode('utf-8')).hexdigest()
+    cache = cache_directory.join(name).ensure()
+    age = xia2setup.ImageScanCache.max_age + 1 if j == 0 else j * 86400
+    os.utime(cache.strpath, (now - age, now - age))
+    caches.append(cache)
+  other = cache_directory.join('other.json').ensure()
+  os.utime(other.strpath, (0, 0))
+
+  cache = xia2setup.ImageScanCache.for_directory(tmpdir.strpath)
+  cache.set(tmpdir.strpath, os.stat(tmpdir.strpath), None, None)
+  cache.save()
+
+  # this one and the next two most recently used are kept
+  assert sorted(os.listdir(cache_directory.strpath)) == sorted(
+    [os.path.basename(cache._filename), 'other.json'] +
+    [c.basename for c in caches[1:3]])
+
+  # a cache which is only read is still used
+  os.utime(cache._filename, (0, 0))
+  xia2setup.ImageScanCache.for_directory(tmpdir.strpath).save()
+  assert os.stat(cache._filename).st_mtime > now - 60
+
+class FakeSweep(object):
+  def __init__(self, template, first_image):
+    self.template = template
+    self.first_image = first_image
+
+  def get_imageset(self):
+    sweep = self
+    class imageset(object):
+      def get_scan(self):
+        class scan(object):
+          def get_image_range(self):
+            return sweep.first_image, sweep.first_image + 9
+        return scan()
+    return imageset()
+
+def test_get_sweeps_cache(tmpdir, monkeypatch):
+  import xia2.Schema
+  from xia2.Applications import xia2setup_helpers
+  from xia2.Handlers.Phil import PhilIndex
+
+  monkeypatch.setattr(
+    PhilIndex.params.xia2.settings.multiprocessing, 'nproc', 1)
+  monkeypatch.setenv('XDG_CACHE_HOME', tmpdir.join('cache').strpath)
+  monkeypatch.setattr(xia2setup, 'known_sweeps', {})
+  monkeypatch.setattr(xia2.Schema, 'imageset_cache', {})
+  master = tmpdir.join('images', 'x_master.h5').ensure()
+
+  # the sweeps are stored as their first images
+  read = []
+  def get_sweep(args):
+    read.append(args[0])
+    return [FakeSweep(args[0], 1), FakeSweep(args[0], 11)]
+  monkeypatch.setattr(xia2setup_helpers, 'get_sweep', get_sweep)
+  monkeypatch.setattr(xia2setup, 'sweeps_as_dict', lambda sweeplist: [
+    sweep.first_image for sweep in sweeplist])
+  monkeypatch.setattr(xia2setup, 'sweeps_from_dict', lambda template, obj: [
+    FakeSweep(template, first_image) for first_image in obj])
+
+  def get_sweeps():
+    xia2setup.known_sweeps.clear()
+    xia2.Schema.imageset_cache.clear()
+    xia2setup.get_sweeps(set([master.strpath]))
+    assert [s.first_image for s in xia2setup.known_sweeps[master.strpath]] \
+      == [1, 11]
+    assert list(xia2.Schema.imageset_cache[master.strpath]) == [1, 11]
+
+  get_sweeps()
+  assert read == [master.strpath]
+
+  # the sweeps are read from the images only once they change
+  get_sweeps()
+  assert read == [master.strpath]
+  master.write('more data')
+  get_sweeps()
+  assert read == [master.strpath] * 2
@@ -0,0 +1,61 @@
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_output_records(tmpdir):
+  from xia2.Driver.DefaultDriver import LogRecords, OutputRecords
+  records = OutputRecords(tail=3)
+  before = ['one\n', 'two\n']
+  for record in before:
+    records.append(record)
+  assert records.get() == tuple(before)
+
+  # once a log file is attached the records are read back from it
+  log_file = open(tmpdir.join('test.log').strpath, 'w')
+  records.attach(log_file)
+  after = ['three\n', 'no newline', u'f\xf6ur\n', '', '']
+  for record in after:
+    records.append(record)
+  output = records.get()
+  assert isinstance(output, LogRecords)
+  assert list(output) == before + after
+  assert records.tail(3) == [u'f\xf6ur\n', '', '']
+
+  # as a sequence, as they were when they were asked for
+  assert len(output) == 7
+  assert output[4] == u'f\xf6ur\n'
+  assert output[-3:] == [u'f\xf6ur\n', '', '']
+  assert 'no newline' in output
+  with pytest.raises(IndexError):
+    output[7]
+  records.append('five\n')
+  assert len(output) == 7
+  assert records.get()[-1] == 'five\n'
+  after.append('five\n')
+
+  # text after the output in the log file is not part of it, while
+  # records after it is closed are held in memory
+  log_file.write('# command line:\n')
+  records.close()
+  records.append('six\n')
+  after.append('six\n')
+  assert list(records.get()) == before + after
+  assert len(records) == 9
+  assert tmpdir.join('test.log').read_text('utf-8') == \
+    u'one\ntwo\nthree\nno newlinef\xf6ur\nfive\n# command line:\n'
+
+def test_log_records_blocks(tmpdir, monkeypatch):
+  from xia2.Driver.DefaultDriver import LogRecords, OutputRecords
+
+  # records read back across several blocks, in any order
+  monkeypatch.setattr(LogRecords, '_block_size', 16)
+  records = OutputRecords()
+  records.attach(open(tmpdir.join('test.log').strpath, 'w'))
+  lines = ['line %d\n' % j + 'x' * (j % 30) for j in range(200)]
+  for line in lines:
+    records.append(line)
+  output = records.get()
+  assert list(output) == lines
+  assert list(reversed(output)) == lines[::-1]
+  assert output[150] == lines[150]
+  assert output[3] == lines[3]
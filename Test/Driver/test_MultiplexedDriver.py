@@ -0,0 +1,134 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+
+import pytest
+
+def make_driver(tmpdir, script):
+  from xia2.Driver.MultiplexedDriver import MultiplexedDriver
+  driver = MultiplexedDriver()
+  driver.set_executable(sys.executable)
+  driver.set_working_directory(tmpdir.strpath)
+  driver.add_command_line('-c')
+  driver.add_command_line(script)
+  return driver
+
+def output_of(driver):
+  return [record for record in driver.get_all_output() if record]
+
+def test_line_buffer():
+  from xia2.Driver.MultiplexedDriver import _LineBuffer
+
+  buffer = _LineBuffer()
+  # a \r\n split between reads is still one line ending
+  for data in (b'one\r', b'\ntwo\rthr', b'ee\n\nfour\r'):
+    buffer.feed(data)
+  assert list(buffer.lines) == ['one\n', 'two\n', 'three\n', '\n']
+  buffer.close()
+  assert list(buffer.lines)[-1] == 'four\n'
+
+  buffer = _LineBuffer()
+  buffer.feed(b'no newline')
+  assert not buffer.lines
+  buffer.close()
+  assert list(buffer.lines) == ['no newline']
+
+def test_several_children(tmpdir):
+  from xia2.Driver.MultiplexedDriver import wait_all
+
+  # more output from each than a pipe will hold, so that all of them
+  # must be read from while they run
+  script = '''
+import sys
+for line in range(5000):
+  print('child %s line %d' % (sys.argv[1], line))
+'''
+  drivers = []
+  for j in range(4):
+    driver = make_driver(tmpdir, script)
+    driver.add_command_line(str(j))
+    driver.start()
+    drivers.append(driver)
+
+  assert wait_all(drivers) == [0] * 4
+  for j, driver in enumerate(drivers):
+    assert output_of(driver) == [
+      'child %d line %d\n' % (j, line) for line in range(5000)]
+
+def test_universal_newlines(tmpdir):
+  driver = make_driver(tmpdir, '''
+import sys
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+out.write(b'crlf\\r\\n')
+out.flush()
+out.write(b'cr\\r')
+out.flush()
+out.write(b'progress 1\\rprogress 2\\r\\nlast')
+''')
+  driver.start()
+  assert driver.wait() == 0
+  assert output_of(driver) == [
+    'crlf\n', 'cr\n', 'progress 1\n', 'progress 2\n', 'last']
+
+def test_input_and_poll(tmpdir):
+  driver = make_driver(tmpdir, '''
+import sys
+for line in sys.stdin:
+  print('read: %s' % line.strip())
+''')
+  driver.start()
+  assert driver.poll() is None
+  driver.input('a')
+  driver.input('b')
+  driver.close_wait()
+  assert output_of(driver) == ['read: a\n', 'read: b\n']
+  assert driver.status() == 0
+
+def test_child_failure(tmpdir):
+  import signal
+  from xia2.Driver.MultiplexedDriver import wait_all
+
+  failing = make_driver(tmpdir, '''
+print('about to fail')
+raise ValueError('failed')
+''')
+  killed = make_driver(tmpdir, '''
+import os, signal, sys
+print('about to be killed')
+sys.stdout.flush()
+os.kill(os.getpid(), signal.SIGKILL)
+''')
+  working = make_driver(tmpdir, 'print("fine")')
+  for driver in failing, killed, working:
+    driver.start()
+
+  # failures do not stop the others being read
+  assert wait_all([failing, killed, working]) == [1, -signal.SIGKILL, 0]
+  assert output_of(failing)[0] == 'about to fail\n'
+  assert 'ValueError: failed\n' in output_of(failing)
+  assert output_of(killed) == ['about to be killed\n']
+  assert output_of(working) == ['fine\n']
+  for driver in failing, killed:
+    with pytest.raises(RuntimeError):
+      driver.check_for_errors()
+  working.check_for_errors()
+
+@pytest.mark.parametrize('driver_class', ['SimpleDriver', 'MultiplexedDriver'])
+def test_missing_executable(tmpdir, driver_class):
+  import importlib
+  import os
+
+  program = tmpdir.join('program')
+  program.write('#!/bin/sh\n')
+  os.chmod(program.strpath, 0o755)
+
+  module = importlib.import_module('xia2.Driver.%s' % driver_class)
+  driver = getattr(module, driver_class)()
+  driver.set_executable(program.strpath)
+  driver.set_working_directory(tmpdir.strpath)
+
+  # the executable is removed after it was found
+  program.remove()
+  with pytest.raises(RuntimeError) as e:
+    driver.start()
+  assert str(e.value) == 'executable "%s" does not exist' % program.strpath
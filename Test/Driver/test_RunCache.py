@@ -0,0 +1,84 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import stat
+import sys
+
+# a program which copies its input file to its output file, records each
+# time it is run and prints its standard input
+program = '''#!%s
+import sys
+runs = open('runs', 'a')
+runs.write('run\\n')
+runs.close()
+open(sys.argv[2], 'w').write(open(sys.argv[1]).read())
+for line in sys.stdin:
+  print('read: %%s' %% line.strip())
+'''
+
+def make_program(tmpdir):
+  executable = tmpdir.join('program')
+  executable.write(program % sys.executable)
+  os.chmod(executable.strpath, os.stat(executable.strpath).st_mode |
+           stat.S_IXUSR)
+  return executable.strpath
+
+def run_program(driver_class, executable, working_directory, records):
+  driver = driver_class()
+  driver.set_executable(executable)
+  driver.set_working_directory(working_directory)
+  driver.add_command_line('input.txt')
+  driver.add_command_line('output.txt')
+  driver.add_output_file('output.txt')
+  driver.start()
+  for record in records:
+    driver.input(record)
+  driver.close_wait()
+  return [record for record in driver.get_all_output() if record]
+
+def test_run_cache(tmpdir):
+  from xia2.Driver.RunCache import RunCache, cached_driver_class
+  from xia2.Driver.SimpleDriver import SimpleDriver
+
+  driver_class = cached_driver_class(
+    SimpleDriver, RunCache(tmpdir.join('cache').strpath))
+  executable = make_program(tmpdir)
+
+  first = tmpdir.mkdir('first')
+  first.join('input.txt').write('one')
+  output = run_program(driver_class, executable, first.strpath, ['a', 'b'])
+  assert output == ['read: a\n', 'read: b\n']
+  assert first.join('output.txt').read() == 'one'
+  assert first.join('runs').read() == 'run\n'
+
+  # the same run elsewhere is replayed - the program is not run
+  second = tmpdir.mkdir('second')
+  second.join('input.txt').write('one')
+  assert run_program(
+    driver_class, executable, second.strpath, ['a', 'b']) == output
+  assert second.join('output.txt').read() == 'one'
+  assert not second.join('runs').check()
+
+  # but is run again if the input records or files change
+  assert run_program(driver_class, executable, second.strpath, ['c']) == \
+    ['read: c\n']
+  second.join('input.txt').write('two')
+  run_program(driver_class, executable, second.strpath, ['c'])
+  assert second.join('output.txt').read() == 'two'
+  assert second.join('runs').read() == 'run\nrun\n'
+
+def test_run_cache_eviction(tmpdir):
+  from xia2.Driver.RunCache import RunCache
+
+  cache = RunCache(tmpdir.join('cache').strpath, max_size=2500)
+  for j in range(3):
+    output = tmpdir.join('output_%d' % j)
+    output.write('x' * 1000)
+    cache.put('%040d' % j, ['output\n'], [output.strpath], tmpdir.strpath)
+    os.utime(os.path.join(cache._entry('%040d' % j), 'meta.json'),
+             (j, j))
+
+  # the least recently used run is removed to make room for the last
+  assert cache.get('%040d' % 0, tmpdir.strpath) is None
+  assert cache.get('%040d' % 1, tmpdir.strpath) == ['output\n']
+  assert cache.get('%040d' % 2, tmpdir.strpath) == ['output\n']
@@ -0,0 +1,11 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+def test_nint():
+  from xia2.Experts.ResolutionExperts import _nint
+  from xia2.lib.bits import nint
+
+  a = np.concatenate([np.arange(-20, 21) * 0.25,
+                      np.random.RandomState(0).uniform(-10, 10, 1000)])
+  assert _nint(a).tolist() == [nint(x) for x in a]
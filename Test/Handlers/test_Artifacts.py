@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+def test_artifact_store(tmpdir):
+  from xia2.Handlers.Artifacts import _ArtifactStore
+
+  store = _ArtifactStore()
+  store._directory = tmpdir.mkdir('Artifacts').strpath
+
+  src = tmpdir.mkdir('index').join('GAIN.cbf')
+  src.write(b'x' * 1000, mode='wb')
+  integrate = tmpdir.mkdir('integrate')
+  dst = integrate.join('GAIN.cbf')
+
+  assert store.place(src.strpath, dst.strpath) in ('reflink', 'hardlink',
+                                                   'copy')
+  assert dst.read(mode='rb') == b'x' * 1000
+  assert store.place(src.strpath, dst.strpath) == 'unchanged'
+  assert store.bytes_saved + store.bytes_copied == 2000
+
+  # the same contents from elsewhere share the stored copy
+  other = tmpdir.mkdir('refine').join('GAIN.cbf')
+  other.write(b'x' * 1000, mode='wb')
+  assert store.put(other.strpath) == store.put(src.strpath)
+
+  # released files may be written without changing the other copies
+  store.release(integrate.strpath, ['GAIN.cbf'], keep=['GAIN.cbf'])
+  assert dst.read(mode='rb') == b'x' * 1000
+  dst.write(b'y' * 10, mode='wb')
+  assert src.read(mode='rb') == b'x' * 1000
+
+  store.place(src.strpath, dst.strpath)
+  store.release(integrate.strpath, ['GAIN.cbf'])
+  assert not dst.check() or os.stat(dst.strpath).st_nlink == 1
+  assert src.read(mode='rb') == b'x' * 1000
+
+def test_copy_file_replaces_shared_destination(tmpdir):
+  from xia2.Handlers.Artifacts import copy_file
+
+  src = tmpdir.join('new.cbf')
+  src.write(b'new' * 100, mode='wb')
+  shared = tmpdir.join('shared.cbf')
+  shared.write(b'old' * 100, mode='wb')
+  dst = tmpdir.join('dst.cbf')
+  os.link(shared.strpath, dst.strpath)
+
+  # the copy replaces dst, leaving the file it was linked to alone
+  copy_file(src.strpath, dst.strpath)
+  assert dst.read(mode='rb') == b'new' * 100
+  assert shared.read(mode='rb') == b'old' * 100
+  assert sorted(p.basename for p in tmpdir.listdir()) == [
+    'dst.cbf', 'new.cbf', 'shared.cbf']
+
+def test_digest_of_rewritten_file(tmpdir):
+  import time
+  from xia2.Handlers.Artifacts import _ArtifactStore
+
+  store = _ArtifactStore()
+  f = tmpdir.join('GAIN.cbf')
+  f.write(b'x' * 1000, mode='wb')
+  st = os.stat(f.strpath)
+  digest = store.digest(f.strpath)
+
+  # rewritten in place with the same size and modification time
+  time.sleep(0.01)
+  f.write(b'y' * 1000, mode='wb')
+  os.utime(f.strpath, (st.st_atime, st.st_mtime))
+  assert store.digest(f.strpath) != digest
+
+  # and forgotten once released
+  digest = store.digest(f.strpath)
+  store.release(tmpdir.strpath, ['GAIN.cbf'])
+  assert f.strpath not in store._digests
+  assert store.digest(f.strpath) == digest
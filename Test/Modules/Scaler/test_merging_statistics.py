@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+
+def test_merging_statistics_data(tmpdir, random_unmerged, write_unmerged_mtz):
+  import iotbx.merging_statistics
+  from xia2.Handlers.Phil import PhilIndex
+  from xia2.Modules.Scaler.CommonScaler import merging_statistics_data
+
+  params = PhilIndex.params.xia2.settings.merging_statistics
+  mtz = tmpdir.join('scaled_unmerged.mtz').strpath
+  write_unmerged_mtz(mtz, *random_unmerged(
+    d_min=3, multiplicity=4, anomalous_flag=True))
+
+  data = merging_statistics_data.from_file(mtz)
+  assert merging_statistics_data.from_file(mtz, previous=data) is data
+  # nothing is kept other than by the caller
+  assert merging_statistics_data.from_file(mtz) is not data
+
+  result = data.dataset_statistics(n_bins=10)
+  assert data.dataset_statistics(n_bins=10) is result
+
+  i_obs = iotbx.merging_statistics.select_data(mtz, data_labels=None)
+  i_obs = i_obs.customized_copy(anomalous_flag=True, info=i_obs.info())
+  for anomalous, d_min, d_max in ((False, None, None), (True, None, None),
+                                  (False, 4, 10), (True, 4, 10)):
+    expected = iotbx.merging_statistics.dataset_statistics(
+      i_obs=i_obs, d_min=d_min, d_max=d_max, n_bins=10, anomalous=anomalous,
+      use_internal_variance=params.use_internal_variance,
+      eliminate_sys_absent=params.eliminate_sys_absent,
+      assert_is_not_unique_set_under_symmetry=False)
+    result = data.dataset_statistics(
+      anomalous=anomalous, d_min=d_min, d_max=d_max, n_bins=10)
+    for attr in ('n_obs', 'n_uniq', 'completeness', 'r_merge', 'cc_one_half',
+                 'anom_completeness', 'anom_half_corr'):
+      assert getattr(result.overall, attr) == getattr(expected.overall, attr)
+    assert (result.anomalous_np_slope is None) == (not anomalous)
+
+  # the data are read again once the file changes
+  write_unmerged_mtz(mtz, *random_unmerged(
+    d_min=3.5, multiplicity=4, anomalous_flag=True))
+  os.utime(mtz, (time.time() + 10, time.time() + 10))
+  changed = merging_statistics_data.from_file(mtz, previous=data)
+  assert changed is not data
+  assert changed.dataset_statistics(n_bins=10).overall.n_obs < \
+    data.dataset_statistics(n_bins=10).overall.n_obs
+
+def test_merging_statistics_data_multiple_sweeps(tmpdir, random_unmerged,
+                                                write_unmerged_mtz):
+  '''The statistics from the shared groupings of the observations are those
+  calculated afresh from the file, for data from several sweeps, each with
+  its own batches, shuffled together.'''
+
+  import iotbx.merging_statistics
+  from xia2.Handlers.Phil import PhilIndex
+  from xia2.Modules.Scaler.CommonScaler import (anomalous_probability_plot,
+                                                merging_statistics_data)
+
+  params = PhilIndex.params.xia2.settings.merging_statistics
+  mtz = tmpdir.join('scaled_unmerged.mtz').strpath
+  write_unmerged_mtz(mtz, *random_unmerged(
+    d_min=2.5, n_datasets=3, multiplicity=3, vary_multiplicity=True,
+    completeness=0.9, anomalous_flag=True, shuffle=True))
+
+  i_obs = iotbx.merging_statistics.select_data(mtz, data_labels=None)
+  i_obs = i_obs.customized_copy(anomalous_flag=True, info=i_obs.info())
+  data = merging_statistics_data.from_file(mtz)
+
+  attrs = ('d_max', 'd_min', 'n_obs', 'n_uniq', 'completeness',
+           'mean_redundancy', 'i_mean', 'i_over_sigma_mean', 'r_merge',
+           'r_meas', 'r_pim', 'cc_one_half', 'cc_one_half_sigma_tau',
+           'cc_anom', 'r_anom', 'anom_completeness')
+  # as _compute_scaler_statistics: overall and in a band, each with and
+  # without Friedel mates merged, then all again with fewer bins
+  for n_bins in (10, 7):
+    for anomalous, d_min, d_max in ((False, None, None), (False, 3, 10),
+                                    (True, None, None), (True, 3, 10)):
+      expected = iotbx.merging_statistics.dataset_statistics(
+        i_obs=i_obs, d_min=d_min, d_max=d_max, n_bins=n_bins,
+        anomalous=anomalous,
+        use_internal_variance=params.use_internal_variance,
+        eliminate_sys_absent=params.eliminate_sys_absent,
+        assert_is_not_unique_set_under_symmetry=False)
+      result = data.dataset_statistics(
+        anomalous=anomalous, d_min=d_min, d_max=d_max, n_bins=n_bins)
+      assert len(result.bins) == len(expected.bins)
+      for r, e in zip([result.overall] + result.bins,
+                      [expected.overall] + expected.bins):
+        for attr in attrs:
+          assert getattr(r, attr) == getattr(e, attr), attr
+
+  merged = i_obs.merge_equivalents(
+    use_internal_variance=params.use_internal_variance).array()
+  assert data.anomalous_np_slope() == anomalous_probability_plot(
+    merged, expected_delta=0.9)[0]
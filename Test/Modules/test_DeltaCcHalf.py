@@ -0,0 +1,70 @@
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def cctbx_leave_one_out(intensities, unmerged_intensities, n_bins,
+                        cc_one_half_method, half=None):
+  '''CC1/2 without each dataset in turn calculated by cctbx, in the bins of
+  all of the data, with the halves of the half dataset method given.'''
+
+  from cctbx import miller
+  from cctbx.array_family import flex
+
+  indices = flex.miller_index()
+  data = flex.double()
+  sigmas = flex.double()
+  dataset = flex.int()
+  for i, unmerged in enumerate(intensities):
+    indices.extend(unmerged.indices())
+    data.extend(unmerged.data())
+    sigmas.extend(unmerged.sigmas())
+    dataset.extend(flex.int(unmerged.size(), i))
+
+  all_data = unmerged_intensities.customized_copy(
+    indices=indices, data=data, sigmas=sigmas)
+  if cc_one_half_method == 'half_dataset':
+    all_data = all_data.customized_copy(anomalous_flag=False)
+  all_data.setup_binner_counting_sorted(n_bins=n_bins)
+
+  result = []
+  for k in range(len(intensities)):
+    without = all_data.select(dataset != k)
+    without.use_binning(miller.binner(all_data.binner(), without))
+
+    if cc_one_half_method == 'sigma_tau':
+      cc_bins = without.cc_one_half_sigma_tau(
+        use_binning=True, return_n_refl=True).data[1:-1]
+    else:
+      half_k = flex.int(half.tolist()).select(dataset != k)
+      cc_bins = []
+      for i_bin in without.binner().range_used():
+        in_bin = without.binner().selection(i_bin)
+        a, b = [without.select(in_bin & (half_k == h)).merge_equivalents(
+          ).array() for h in (0, 1)]
+        a, b = a.common_sets(b)
+        cc_bins.append((flex.linear_correlation(
+          a.data(), b.data()).coefficient(), a.size()))
+
+    result.append(flex.mean_weighted(
+      flex.double(cc for cc, n in cc_bins),
+      flex.double(n for cc, n in cc_bins)))
+  return result
+
+@pytest.mark.parametrize('cc_one_half_method', ['sigma_tau', 'half_dataset'])
+def test_leave_one_out_cc_half(random_unmerged, cc_one_half_method):
+  from xia2.Modules.DeltaCcHalf import leave_one_out_cc_half
+  from xia2.Modules.MultiCrystalAnalysis import separate_unmerged
+
+  unmerged, batches = random_unmerged(n_datasets=5)
+  intensities = list(separate_unmerged(unmerged, batches).intensities.values())
+
+  leave_one_out = leave_one_out_cc_half(
+    intensities, unmerged, n_bins=10, cc_one_half_method=cc_one_half_method)
+  result = leave_one_out.run()
+  assert result == pytest.approx(cctbx_leave_one_out(
+    intensities, unmerged, n_bins=10, cc_one_half_method=cc_one_half_method,
+    half=leave_one_out.half))
+
+  # the data were made noisier dataset by dataset, so leaving out a later
+  # dataset leaves better data
+  assert result == sorted(result)
@@ -0,0 +1,84 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+def test_header_cache(tmpdir):
+  from xia2.Wrappers.XIA.Diffdump import _HeaderCache
+
+  image = tmpdir.join('image_001.img')
+  image.write('header')
+
+  header = { 'epoch': 1.0, 'beam': (105.1, 101.05), 'detector': 'adsc',
+             'size': [(1, 2), [3, 4]], 'empty': () }
+  cache = _HeaderCache()
+  cache.attach(tmpdir.join('headers.json').strpath)
+  cache.put(image.strpath, header)
+  cache.put(image.strpath, 1.5, kind='gain')
+  assert cache.check(image.strpath)
+  assert cache.get(image.strpath, kind='gain') == 1.5
+  cache.save()
+
+  # the saved cache is shared with others, and merged with their entries
+  other = _HeaderCache()
+  other.attach(tmpdir.join('headers.json').strpath)
+  assert other.get(image.strpath) == header
+  # as it was put, not as JSON gives it
+  assert type(other.get(image.strpath)['beam']) is tuple
+  assert type(other.get(image.strpath)['size']) is list
+  assert type(other.get(image.strpath)['size'][0]) is tuple
+  assert type(other.get(image.strpath)['size'][1]) is list
+  assert type(other.get(image.strpath)['detector']) is str
+  assert all(type(key) is str for key in other.get(image.strpath))
+  assert not other.check(tmpdir.join('image_002.img').strpath)
+
+  # until the image changes
+  image.write('new header')
+  os.utime(image.strpath, (0, 0))
+  assert not other.check(image.strpath)
+  assert not other.check(image.strpath, kind='gain')
+
+def test_read_all(tmpdir, monkeypatch):
+  from xia2.Modules import ImageHeaders
+  from xia2.Wrappers.XIA.Diffdump import _HeaderCache
+
+  images = []
+  for j in range(10):
+    image = tmpdir.join('image_%03d.img' % (j + 1))
+    image.write('header')
+    images.append(image.strpath)
+
+  read = []
+  def read_header(image):
+    read.append(image)
+    return { 'epoch': 100.0 + images.index(image), 'exposure_time': 0.1 }
+
+  monkeypatch.setattr(ImageHeaders, 'HeaderCache', _HeaderCache())
+  monkeypatch.setattr(ImageHeaders, '_readers', { 'header': read_header })
+  monkeypatch.setenv('XIA2_HEADER_INDEX', tmpdir.join('headers.json').strpath)
+
+  columns = ImageHeaders.header_columns(images[:5], nproc=1)
+  assert list(columns['epoch']) == [100.0, 101.0, 102.0, 103.0, 104.0]
+  assert list(columns['exposure_time']) == [0.1] * 5
+
+  # only the headers not read already are read
+  headers = ImageHeaders.read_all(images, nproc=1)
+  assert [h['epoch'] for h in headers] == [100.0 + j for j in range(10)]
+  assert sorted(read) == images
+  assert tmpdir.join('headers.json').check()
+
+def test_attach_header_index(tmpdir, monkeypatch):
+  from xia2.Handlers.Environment import Environment
+  from xia2.Modules import ImageHeaders
+  from xia2.Wrappers.XIA.Diffdump import _HeaderCache
+
+  monkeypatch.setattr(ImageHeaders, 'HeaderCache', _HeaderCache())
+  monkeypatch.delenv('XIA2_HEADER_INDEX', raising=False)
+  monkeypatch.setattr(Environment, 'generate_directory',
+                      lambda path: tmpdir.mkdir(path).strpath)
+
+  # kept with the xia2 working files, not wherever xia2 is run from
+  with tmpdir.mkdir('elsewhere').as_cwd():
+    ImageHeaders.attach_header_index()
+  assert ImageHeaders.HeaderCache.get_filename() == \
+    tmpdir.join('Headers', 'headers.json').strpath
+  assert not tmpdir.join('elsewhere').listdir()
@@ -0,0 +1,105 @@
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+
+import pytest
+
+def merged_datasets(random_unmerged, n_datasets):
+  """Merged intensities for n_datasets datasets, each a random part of the
+  same set of reflections with its own level of noise."""
+
+  from xia2.Modules.MultiCrystalAnalysis import separate_unmerged
+
+  unmerged, batches = random_unmerged(
+    n_datasets=n_datasets, multiplicity=1, completeness=0.3,
+    anomalous_flag=True)
+  separate = separate_unmerged(unmerged, batches)
+  return [intensities.merge_equivalents().array()
+          for intensities in separate.intensities.values()]
+
+def test_pairwise_correlation(random_unmerged):
+  from xia2.Modules.MultiCrystalAnalysis import pairwise_correlation
+
+  datasets = merged_datasets(random_unmerged, 8)
+  correlation = pairwise_correlation()
+  matrix = correlation.add_datasets(datasets[:5])
+  assert matrix.shape == (5, 5)
+
+  # adding datasets later gives the same as adding them all at once
+  correlation.add_dataset(datasets[5])
+  matrix = correlation.add_datasets(datasets[6:])
+  assert pairwise_correlation().add_datasets(datasets) == \
+    pytest.approx(matrix, abs=1e-12)
+
+  for i, ma_i in enumerate(datasets):
+    for j, ma_j in enumerate(datasets):
+      assert matrix[i, j] == pytest.approx(
+        ma_i.correlation(ma_j).coefficient(), abs=1e-10)
+
+  assert correlation.linkage().shape == (7, 4)
+
+def unmerged_batches(batches):
+  """Unmerged intensities with the given batches, the data of each
+  observation being its position."""
+
+  from cctbx import crystal, miller
+  from cctbx.array_family import flex
+
+  cs = crystal.symmetry(unit_cell=(57, 57, 150, 90, 90, 90),
+                        space_group_symbol='P 41 21 2')
+  n = len(batches)
+  unmerged = miller.array(
+    miller.set(cs, flex.miller_index([(1, 2, j + 1) for j in range(n)]),
+               anomalous_flag=False),
+    data=flex.double(range(n)), sigmas=flex.double(n, 1))
+  return unmerged, miller.array(unmerged, data=flex.int(batches))
+
+# three runs of batches 1-3, 21-22 and 41-43, out of order
+batches = [21, 1, 41, 2, 22, 43, 3, 42, 1, 21, 43]
+
+@pytest.mark.parametrize('id_to_batches,expected,overlapping', [
+  # the last batch of the last run found is not included
+  (None, [[1, 3, 6, 8], [0, 4, 9], [2, 7]], False),
+  ({'a': (1, 3), 'b': (21, 43)}, [[1, 3, 6, 8], [0, 2, 4, 5, 7, 9, 10]],
+   False),
+  ({'a': (1, 22), 'b': (21, 43)},
+   [[0, 1, 3, 4, 6, 8, 9], [0, 2, 4, 5, 7, 9, 10]], True),
+  (OrderedDict([('c', (41, 43)), ('a', (1, 3)), ('b', (21, 22))]),
+   [[2, 5, 7, 10], [1, 3, 6, 8], [0, 4, 9]], False)])
+def test_separate_unmerged(id_to_batches, expected, overlapping):
+  from xia2.Modules.MultiCrystalAnalysis import separate_unmerged
+
+  unmerged, batches_all = unmerged_batches(batches)
+  separate = separate_unmerged(unmerged, batches_all,
+                               id_to_batches=id_to_batches)
+
+  assert list(separate.intensities.keys()) == list(range(len(expected)))
+  for i, positions in enumerate(expected):
+    assert list(separate.intensities[i].data()) == positions
+    assert list(separate.intensities[i].indices()) == [
+      (1, 2, j + 1) for j in positions]
+    assert list(separate.batches[i].data()) == [batches[j] for j in positions]
+
+  # only runs with overlapping batch ranges are selected one at a time
+  assert (separate.run_offsets is None) == overlapping
+
+@pytest.mark.slow
+def test_separate_unmerged_many_runs(random_unmerged):
+  import numpy as np
+  from xia2.Modules.MultiCrystalAnalysis import separate_unmerged
+
+  unmerged, batches_all = random_unmerged(
+    n_datasets=500, multiplicity=1, completeness=0.5, shuffle=True)
+  separate = separate_unmerged(unmerged, batches_all)
+
+  assert separate.run_offsets is not None
+  assert len(separate.intensities) == 500
+  values = batches_all.data().as_numpy_array()
+  data = unmerged.data().as_numpy_array()
+  for i in range(500):
+    first, last = 20 * i + 1, 20 * i + 10
+    if i == 499:
+      last = values.max() - 1
+    sel = (values >= first) & (values <= last)
+    assert list(separate.batches[i].data()) == values[sel].tolist()
+    assert list(separate.intensities[i].data()) == data[sel].tolist()
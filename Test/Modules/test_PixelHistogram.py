@@ -0,0 +1,30 @@
+from __future__ import absolute_import, division, print_function
+
+import collections
+import random
+
+def test_pixel_histogram():
+  from xia2.Modules.PixelHistogram import pixel_histogram
+
+  rng = random.Random(0)
+  chunks = [[rng.choice((rng.randint(0, 100), rng.randint(-2, 10**7)))
+             for j in range(1000)] for k in range(10)]
+  expected = collections.Counter(
+    v for chunk in chunks for v in chunk if 0 <= v <= 5 * 10**6)
+
+  # in parts, merged - with a dense part too small for most values
+  parts = []
+  for j in range(2):
+    hist = pixel_histogram(5 * 10**6, dense_limit=50)
+    for chunk in chunks[j::2]:
+      hist.add(chunk)
+    parts.append(hist)
+  parts[0].merge(parts[1])
+  assert parts[0].counts() == dict(expected)
+  assert parts[0].n_out_of_range == 10000 - sum(expected.values())
+
+  edges, counts = parts[0].log_binned(bins_per_decade=5)
+  assert edges[0] == 0 and edges[-1] == 5 * 10**6 + 1
+  assert counts.sum() == sum(expected.values())
+  assert counts[0] == expected[0]
+  assert counts[-1] == sum(c for v, c in expected.items() if v >= edges[-2])
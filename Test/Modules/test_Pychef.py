@@ -1,5 +1,7 @@
 from __future__ import absolute_import, division, print_function
 
+import pytest
+
 def test_exercise_observations():
   from xia2.Modules.PyChef2 import Observations
   from cctbx.array_family import flex
@@ -13,6 +15,27 @@ def test_exercise_observations():
   assert list(groups[(1,2,3)].iplus()) == [0]
   assert list(groups[(1,2,3)].iminus()) == [1,2]
 
+def test_exercise_unmerged_observations():
+  from xia2.Modules.PyChef2.PyChef import observation_group
+  from xia2.Modules.PyChef2.PyChef import unmerged_observations
+  from cctbx.array_family import flex
+  from cctbx import crystal, miller
+  miller_indices = flex.miller_index(
+    ((1,2,3),(-1,2,3),(1,-2,3), (4,6,6),(4,6,-6),(2,0,0)))
+  cs = crystal.symmetry(unit_cell=(50,60,70,90,90,90), space_group_symbol="I222")
+  ma = miller.array(
+    miller.set(cs, miller_indices, anomalous_flag=True),
+    data=flex.double(6, 1), sigmas=flex.double(6, 1))
+  observations = unmerged_observations(ma)
+  assert len(observations) == 3
+  assert list(observations[(1,2,3)].iplus) == [0]
+  assert list(observations[(1,2,3)].iminus) == [1,2]
+  assert (4,6,-6) not in observations
+  assert observations[(2,0,0)].is_centric()
+  assert list(observations.flags) == [
+    observation_group.PLUS, observation_group.MINUS, observation_group.MINUS,
+    observation_group.PLUS, observation_group.MINUS, observation_group.CENTRIC]
+
 def test_exercise_accumulators(xia2_regression):
   from xia2.Modules.PyChef2 import PyChef
   from xia2.Modules.PyChef2 import ChefStatistics
@@ -78,3 +101,51 @@ def test_exercise_accumulators(xia2_regression):
   # test Rd
 
   assert approx_equal(chef_stats.rd(), pystats.rd)
+
+def _insulin_intensities_and_batches(xia2_regression):
+  from iotbx.reflection_file_reader import any_reflection_file
+  import os
+
+  f = os.path.join(xia2_regression, "test/insulin_dials_scaled_unmerged.mtz")
+  reader = any_reflection_file(f)
+  for ma in reader.as_miller_arrays(merge_equivalents=False):
+    if ma.info().labels == ['BATCH']:
+      batches = ma
+    elif ma.info().labels in (['I', 'SIGI'],
+                              ['I(+)', 'SIGI(+)', 'I(-)', 'SIGI(-)']):
+      intensities = ma
+  return intensities.as_anomalous_array(), batches
+
+def test_rcp_rd():
+  from cctbx import crystal, miller
+  from cctbx.array_family import flex
+  from xia2.Modules.PyChef2 import PyChef
+
+  # I+ of one reflection as 100, 110 and 90 at doses 1, 2 and 3, and I-
+  # once as 120 at dose 2
+  cs = crystal.symmetry(unit_cell=(50, 60, 70, 90, 90, 90),
+                        space_group_symbol='P 1')
+  intensities = miller.array(
+    miller.set(cs, flex.miller_index(
+      [(1, 2, 3), (1, 2, 3), (1, 2, 3), (-1, -2, -3)]), anomalous_flag=True),
+    data=flex.double([100, 110, 90, 120]), sigmas=flex.double(4, 10))
+  pystats = PyChef.PyStatistics(intensities, flex.int([1, 2, 3, 2]),
+                                n_bins=1)
+  assert pystats.n_steps == 4
+
+  # pairs of I+ are counted at the later dose: |100 - 110| at 2, then
+  # |100 - 90| and |110 - 90| at 3, over half the sums 105, 95 and 100
+  assert list(pystats.rcp) == pytest.approx([0, 0, 10 / 105, 40 / 300])
+
+  # all pairs by dose difference: |110 - 120| for 0; |100 - 110|,
+  # |110 - 90|, |100 - 120| and |90 - 120| for 1; |100 - 90| for 2
+  assert list(pystats.rd) == pytest.approx(
+    [10 / 115, 80 / 420, 10 / 95, 0])
+
+def test_rd_dose_differences_beyond_steps(xia2_regression):
+  from xia2.Modules.PyChef2 import PyChef
+
+  # with a fine range_width, dose differences reach beyond n_steps
+  intensities, batches = _insulin_intensities_and_batches(xia2_regression)
+  pystats = PyChef.PyStatistics(intensities, batches.data(), range_width=0.5)
+  assert pystats.rd.size() == pystats.n_steps
@@ -0,0 +1,29 @@
+from __future__ import absolute_import, division, print_function
+
+def test_resolution_estimator(tmpdir, random_unmerged, write_unmerged_mtz):
+  from dials.util.Resolutionizer import resolutionizer
+  from xia2.Handlers.Phil import PhilIndex
+  from xia2.Modules.ResolutionEstimator import resolution_estimator, \
+    scaled_unmerged_data
+
+  hklin = tmpdir.join('scaled_unmerged.mtz').strpath
+  write_unmerged_mtz(hklin, *random_unmerged(
+    d_min=1.5, multiplicity=4, batches_per_dataset=20, anomalous_flag=True,
+    falloff=True))
+  params = PhilIndex.params.xia2.settings.resolution
+  jobs = [(hklin, None), (hklin, (1, 10)), (hklin, (11, 20))]
+
+  serial = resolution_estimator(params, nproc=1).estimate_all(jobs)
+  parallel = resolution_estimator(params, nproc=3).estimate_all(jobs)
+  assert serial == parallel
+
+  data = scaled_unmerged_data(hklin)
+  assert data.select((1, 10)).size() + data.select((11, 20)).size() == \
+    data.i_obs.size()
+
+  params = resolution_estimator(params)._params
+  m = resolutionizer(data.select((1, 10)), params)
+  if params.cc_half is not None:
+    assert serial[1]['cc_half'] == m.resolution_cc_half()
+  if params.misigma is not None:
+    assert serial[1]['misigma'] == m.resolution_merged_isigma()
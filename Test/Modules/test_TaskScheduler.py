@@ -0,0 +1,62 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+def square(x):
+  return x * x
+
+def add(x, *dependencies):
+  return x + sum(dependencies)
+
+def fail():
+  raise RuntimeError('this task fails')
+
+def parent_pid():
+  return os.getpid()
+
+def exit_task():
+  raise SystemExit(1)
+
+def die():
+  os._exit(1)
+
+def unpicklable():
+  return lambda x: x
+
+def test_split_core_budget():
+  from xia2.Modules.TaskScheduler import split_core_budget
+  assert split_core_budget(16) == (16, 1)
+  assert split_core_budget(16, njob=4) == (4, 4)
+  assert split_core_budget(16, nproc=8) == (2, 8)
+  assert split_core_budget(16, nsweeps=3) == (3, 5)
+  assert split_core_budget(2, njob=4) == (4, 1)
+
+def test_task_scheduler():
+  from xia2.Modules.TaskScheduler import TaskScheduler
+  scheduler = TaskScheduler(njob=2)
+  scheduler.add_task('a', square, (3,))
+  scheduler.add_task('b', square, (4,))
+  scheduler.add_task('c', add, (1,), depends=('a', 'b'))
+  scheduler.add_task('d', parent_pid, local=True)
+  scheduler.add_task('e', fail)
+  scheduler.add_task('f', add, (1,), depends=('c', 'e'))
+  results = scheduler.run()
+  assert results == {'a': 9, 'b': 16, 'c': 26, 'd': os.getpid()}
+  assert 'this task fails' in scheduler.errors['e']
+  assert scheduler.errors['f'] == 'not run as task e failed'
+  assert sorted(scheduler.timings) == ['a', 'b', 'c', 'd', 'e']
+
+def test_task_scheduler_worker_failures():
+  from xia2.Modules.TaskScheduler import TaskScheduler
+  # none of these returns a result from its worker, but run() must return
+  scheduler = TaskScheduler(njob=2)
+  scheduler.add_task('exit', exit_task)
+  scheduler.add_task('die', die)
+  scheduler.add_task('unpicklable', unpicklable)
+  scheduler.add_task('after', square, (2,), depends=('die',))
+  scheduler.add_task('square', square, (5,))
+  assert scheduler.run() == {'square': 25}
+  assert 'SystemExit' in scheduler.errors['exit']
+  assert scheduler.errors['die'] == 'worker process exited with code 1'
+  assert 'could not be returned' in scheduler.errors['unpicklable']
+  assert scheduler.errors['after'] == 'not run as task die failed'
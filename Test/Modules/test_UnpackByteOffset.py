@@ -0,0 +1,63 @@
+from __future__ import absolute_import, division, print_function
+
+import binascii
+import random
+
+import pytest
+
+# pixel values with deltas 0, 5, -7, 127, 0, 32767, 99800 and 2**33 - 132692
+# then -2**33, packed by hand: one byte, or an escape -128 then two bytes,
+# or an escape -32768 then four bytes, or an escape -2147483648 then eight
+values = [0, 5, -2, 125, 125, 32892, 132692, 2**33, 0]
+packed = binascii.unhexlify(''.join([
+  '00', '05', 'f9', '807f00', '00', '800080ff7f0000', '800080d8850100',
+  '80008000000080' + 'acf9fdff01000000',
+  '80008000000080' + '00000000feffffff']))
+
+def random_pixels(n, seed=0):
+  '''Pixel values with a mixture of small and large differences, covering
+  every escape level.'''
+  rng = random.Random(seed)
+  values = []
+  for j in range(n):
+    scale = rng.choice((10, 10, 10, 200, 40000, 3000000000, 2**40))
+    values.append(rng.randint(-scale, scale))
+  return values
+
+def test_pack_values():
+  from xia2.Modules.UnpackByteOffset import pack_values
+  assert pack_values(values) == packed
+  assert pack_values([]) == b''
+
+def test_unpack_values():
+  from xia2.Modules.UnpackByteOffset import unpack_values
+  # trailing bytes after the binary section must be ignored
+  data = packed + b'\x80\x80\x80\r\n--CIF-BINARY-FORMAT-SECTION----\r\n'
+  assert list(unpack_values(data, len(values))) == values
+
+def test_round_trip():
+  from xia2.Modules.UnpackByteOffset import pack_values, unpack_values
+  values = [0, -128, 127, -127, 126, -32768, 32767, 32766, -2147483648,
+            2147483647, 2147483646, -3, -3, 0]
+  assert list(unpack_values(pack_values(values), len(values))) == values
+  values = random_pixels(10000)
+  assert list(unpack_values(pack_values(values), len(values))) == values
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000, 20000])
+def test_iter_unpack_values(chunk_size):
+  from xia2.Modules.UnpackByteOffset import iter_unpack_values, pack_values
+  values = random_pixels(10000, seed=3)
+  packed = b'header' + pack_values(values) + b'\x80\x80\x80'
+  chunks = list(iter_unpack_values(packed, len(values), chunk_size,
+                                   offset=len(b'header')))
+  assert max(len(chunk) for chunk in chunks) == min(chunk_size, len(values))
+  assert [v for chunk in chunks for v in chunk] == values
+
+@pytest.mark.slow
+def test_round_trip_large_image():
+  from xia2.Modules.UnpackByteOffset import pack_values, unpack_values
+  rng = random.Random(2)
+  n = 1024 * 1024
+  values = [rng.randint(0, 200) if rng.random() < 0.95 else
+            rng.randint(0, 2**20) for j in range(n)]
+  assert list(unpack_values(pack_values(values), n)) == values
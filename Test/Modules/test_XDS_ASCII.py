@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function
+
+header = '''\
+!FORMAT=XDS_ASCII    MERGE=FALSE    FRIEDEL'S_LAW=TRUE
+!NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD=5
+!END_OF_HEADER
+'''
+
+records = [
+  '     1     2     3  1.000E+02  1.000E+01\n',
+  '     1     2    -3  5.000E+01 -1.000E+00\n',
+  '    -4     0     7  2.500E+01  5.000E+00\n',
+  '     0     0     8 -2.000E+00 -9.900E+01\n',
+]
+
+def test_xds_reflection_file(tmpdir):
+  from xia2.Modules.XDS_ASCII import XDSReflectionFile
+  hkl = tmpdir.join('XDS_ASCII.HKL')
+  hkl.write(header + ''.join(records) + '!END_OF_DATA\n')
+  with XDSReflectionFile(hkl.strpath) as xds_file:
+    assert xds_file.header() == header
+    assert xds_file.header_records()[1] == \
+      'NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD=5'
+    assert xds_file.trailer() == '!END_OF_DATA\n'
+    # chunks smaller than a record still return whole records
+    columns = list(xds_file.columns([0, 4], chunk_size=10))
+  assert sum(c.shape[0] for c in columns) == 4
+  assert [list(c[0]) for c in columns] == [
+    [1, 10], [1, -1], [-4, 5], [0, -99]]
+
+def test_xds_reflection_file_malformed(tmpdir):
+  import pytest
+  from xia2.Modules.XDS_ASCII import XDSReflectionFile
+  hkl = tmpdir.join('XDS_ASCII.HKL')
+  hkl.write(header + records[0] + records[1].replace('5.000E+01', '5.000X+01')
+            + ''.join(records[2:]) + '!END_OF_DATA\n')
+  with XDSReflectionFile(hkl.strpath) as xds_file:
+    with pytest.raises(RuntimeError) as e:
+      list(xds_file.chunks())
+  assert hkl.strpath in str(e.value)
+
+def test_remove_misfits(tmpdir):
+  from xia2.Modules.XDS_ASCII import remove_misfits
+  xdsin = tmpdir.join('XDS_ASCII.HKL')
+  xdsout = tmpdir.join('XDS_ASCII_NO_MISFITS.HKL')
+  xdsin.write(header + ''.join(records) + '!END_OF_DATA\n')
+  assert remove_misfits(xdsin.strpath, xdsout.strpath) == 2
+  assert xdsout.read() == \
+    header + records[0] + records[2] + '!END_OF_DATA\n'
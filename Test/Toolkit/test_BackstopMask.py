@@ -0,0 +1,117 @@
+from __future__ import absolute_import, division, print_function
+
+import binascii
+
+import numpy as np
+import pytest
+
+# backstop corners read off images at three distances
+site = '''150.0 1230.0 0.0 1205.0 1190.0 1255.0 1190.0 1240.0 0.0
+250.0 1232.0 0.0 1210.0 1205.0 1250.0 1205.0 1238.0 0.0
+400.0 1235.0 0.0 1215.0 1220.0 1245.0 1220.0 1236.0 0.0
+'''
+
+header = { 'distance': 200.0, 'size': (2463, 2527), 'pixel': (0.172, 0.172) }
+
+# a backstop along the rows 100.2 to 200.2 from the left edge of the image
+# to x = distance / 2 + 0.2, given at two distances
+square_site = '''100.0 0.0 100.2 50.2 100.2 50.2 200.2 0.0 200.2
+300.0 0.0 100.2 150.2 100.2 150.2 200.2 0.0 200.2
+'''
+
+square_header = { 'distance': 200.0, 'size': (400, 300),
+                  'pixel': (0.172, 0.172) }
+
+def square_mask(distance):
+  '''The mask for square_site, of the pixels with centres inside.'''
+  mask = np.zeros((300, 400), dtype=bool)
+  mask[100:200, :int(distance / 2)] = True
+  return mask
+
+@pytest.fixture
+def backstop_mask(tmpdir):
+  from xia2.Toolkit.BackstopMask import BackstopMask
+  site_file = tmpdir.join('backstop.dat')
+  site_file.write(site)
+  return BackstopMask(site_file.strpath)
+
+@pytest.fixture
+def square_backstop_mask(tmpdir):
+  from xia2.Toolkit.BackstopMask import BackstopMask
+  site_file = tmpdir.join('square_backstop.dat')
+  site_file.write(square_site)
+  return BackstopMask(site_file.strpath)
+
+@pytest.mark.parametrize('distance', [150.0, 200.0, 250.0])
+def test_mask(square_backstop_mask, distance):
+  h = dict(square_header, distance=distance)
+  mask = square_backstop_mask.mask(h)
+  assert mask.shape == (300, 400)
+  assert (mask == square_mask(distance)).all()
+
+  # the mask is only computed once for each distance
+  assert square_backstop_mask.mask(dict(h)) is mask
+
+@pytest.mark.parametrize('distance', [150.0, 200.0, 333.3])
+def test_mask_inside_backstop(backstop_mask, distance):
+  nx, ny = header['size']
+  h = dict(header, distance=distance)
+  mask = backstop_mask.mask(h)
+  assert mask.shape == (ny, nx)
+
+  # every pixel is masked just when its centre is inside the backstop, all
+  # of which lie within its limits
+  r = backstop_mask.rectangle(h)
+  x0, x1, y0, y1 = [int(l) for l in r.limits()]
+  assert not mask[:y0].any() and not mask[y1 + 1:].any()
+  assert not mask[:, :x0].any() and not mask[:, x1 + 1:].any()
+  rng = np.random.RandomState(0)
+  for x, y in zip(rng.randint(x0, x1 + 1, 1000), rng.randint(y0, y1 + 1, 1000)):
+    assert mask[y, x] == r.is_inside((x + 0.5, y + 0.5))
+
+def test_rectangle_mask():
+  from xia2.Toolkit.BackstopMask import rectangle
+
+  rng = np.random.RandomState(0)
+  for j in range(20):
+    # corners which may be outside the image
+    p = [tuple(c) for c in rng.uniform(-5, 45, size=(4, 2))]
+    # a convex quadrilateral, from the corners in order of angle
+    centre = np.mean(p, axis=0)
+    p.sort(key=lambda c: np.arctan2(c[1] - centre[1], c[0] - centre[0]))
+    r = rectangle(*p)
+    mask = r.mask(40, 40)
+    expected = np.zeros((40, 40), dtype=bool)
+    for x in range(40):
+      for y in range(40):
+        expected[y, x] = r.is_inside((x + 0.5, y + 0.5))
+    assert (mask == expected).all()
+
+def test_untrusted_quadrilateral(backstop_mask):
+  record = backstop_mask.untrusted_quadrilateral(header)
+  assert record.startswith('UNTRUSTED_QUADRILATERAL= ')
+  corners = [int(c) for c in record.split()[1:]]
+  assert len(corners) == 8
+  p1, p2, p3, p4 = backstop_mask.calculate_mask(header)
+  assert corners[:2] == [int(round(p1[0] + 0.5)), int(round(p1[1] + 0.5))]
+
+def test_apply_mask_xds(square_backstop_mask, tmpdir):
+  from xia2.Modules.UnpackByteOffset import pack_values, unpack_values
+
+  nx, ny = square_header['size']
+  values = np.random.RandomState(1).randint(0, 100, size=nx * ny)
+  start_tag = binascii.unhexlify('0c1a04d5')
+  cbf_header = ('X-Binary-Number-of-Elements: %d\n'
+                'X-Binary-Size-Fastest-Dimension: %d\n'
+                'X-Binary-Size-Second-Dimension: %d\n' % (nx * ny, nx, ny))
+  cbf_in = tmpdir.join('BKGINIT.sav')
+  cbf_in.write_binary(cbf_header.encode() + start_tag + pack_values(values))
+  cbf_out = tmpdir.join('BKGINIT.cbf')
+
+  square_backstop_mask.apply_mask_xds(square_header, cbf_in.strpath,
+                                      cbf_out.strpath)
+
+  data = cbf_out.read_binary()
+  masked = unpack_values(data[data.find(start_tag) + 4:], nx * ny)
+  values[square_mask(square_header['distance']).ravel()] = -3
+  assert masked.tolist() == values.tolist()
@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+
+def bkginit(value=10):
+  """A 13 x 13 image of the given value, with pixels to mend at (6, 6) and
+  (7, 7) - the only ones at least 5 from the edge - and the untrusted
+  (7, 5), given in XDS coordinates (x, y) = (fast + 1, slow + 1), with
+  100 at (5, 5) and 200 at (9, 9). Returned with the untrusted rectangles
+  and the image as mended."""
+
+  pixels = np.full((13, 13), value, dtype=np.int64)
+  pixels[5, 5] = 100
+  pixels[9, 9] = 200
+  pixels[6, 6] = pixels[7, 7] = pixels[7, 5] = pixels[2, 6] = -1
+  untrusted = [[6, 6, 8, 8]]
+
+  # the 5 x 5 box about (6, 6) has 22 positive pixels, 21 of them 10, and
+  # that about (7, 7) 22, 20 of them 10
+  mended = pixels.copy()
+  mended[6, 6] = (21 * value + 100) // 22
+  mended[7, 7] = (20 * value + 300) // 22
+  return pixels, untrusted, mended
+
+def test_mend_pixels():
+  from xia2.Toolkit.MendBKGINIT import mend_pixels
+
+  pixels, untrusted, mended = bkginit()
+  assert mended[6, 6] == 14 and mended[7, 7] == 22
+
+  positions, values = mend_pixels(pixels, untrusted)
+  assert positions.tolist() == [6 * 13 + 6, 7 * 13 + 7]
+  assert values.tolist() == [14, 22]
+
+  # without overflow for the largest pixel values
+  pixels = np.full((13, 13), 2**31 - 1, dtype=np.int64)
+  pixels[6, 6] = -1
+  positions, values = mend_pixels(pixels, [])
+  assert positions.tolist() == [6 * 13 + 6]
+  assert values.tolist() == [2**31 - 1]
+
+def test_recompute_BKGINIT(tmpdir):
+  import binascii
+  from cbflib_adaptbx import compress, uncompress
+  from scitbx.array_family import flex
+  from xia2.Toolkit.MendBKGINIT import recompute_BKGINIT
+
+  pixels, untrusted, mended = bkginit()
+  slow, fast = pixels.shape
+
+  header = '\n'.join([
+    'X-Binary-Number-of-Elements: %d' % (slow * fast),
+    'X-Binary-Size-Fastest-Dimension: %d' % fast,
+    'X-Binary-Size-Second-Dimension: %d' % slow, ''])
+  start_tag = binascii.unhexlify('0c1a04d5')
+  tmpdir.join('BKGINIT.cbf').write(
+    header + start_tag + compress(flex.int(pixels.ravel().tolist())),
+    mode='wb')
+  tmpdir.join('INIT.LP').write(
+    ' UNTRUSTED_RECTANGLE= %d %d %d %d\n' % tuple(untrusted[0]))
+
+  recompute_BKGINIT(tmpdir.join('BKGINIT.cbf').strpath,
+                    tmpdir.join('INIT.LP').strpath,
+                    tmpdir.join('BKGINIT_mended.cbf').strpath)
+
+  data = tmpdir.join('BKGINIT_mended.cbf').read(mode='rb')
+  assert data.startswith(header + start_tag)
+  assert list(
+    uncompress(packed=data[len(header) + 4:], fast=fast, slow=slow)) == \
+    mended.ravel().tolist()
@@ -0,0 +1,149 @@
+from __future__ import absolute_import, division, print_function
+
+import math
+
+import pytest
+
+def unmerged_mtz(write_unmerged_mtz, filename, observations):
+  '''Write an MTZ file of the observations, (hkl, I, SIGI, M_ISYM, BATCH),
+  in P 1 2 1.'''
+
+  from cctbx import crystal, miller
+  from cctbx.array_family import flex
+
+  cs = crystal.symmetry(unit_cell=(50, 60, 70, 90, 105, 90),
+                        space_group_symbol='P 1 2 1')
+  indices, data, sigmas, m_isym, batches = zip(*observations)
+  intensities = miller.array(
+    miller.set(cs, flex.miller_index(indices), anomalous_flag=False),
+    data=flex.double(data), sigmas=flex.double(sigmas))
+  write_unmerged_mtz(filename, intensities,
+                     intensities.customized_copy(data=flex.int(batches)),
+                     m_isym=m_isym)
+
+# I+ (odd M_ISYM) and I- (even M_ISYM) observations of three reflections:
+# (1,2,3) merges to 100 +/- sqrt(50), the centric (2,0,1) to 200 +/-
+# sqrt(1 / 0.015) and (0,1,4) is seen once
+observations = [((1, 2, 3), 90, 10, 1, 1), ((2, 0, 1), 200, 10, 1, 1),
+                ((0, 1, 4), 50, 5, 1, 2), ((1, 2, 3), 110, 10, 2, 2),
+                ((2, 0, 1), 220, 20, 1, 3), ((2, 0, 1), 180, 20, 2, 3)]
+
+def test_merger_statistics(tmpdir, write_unmerged_mtz):
+  from xia2.Toolkit.Merger import merger
+
+  hklin = tmpdir.join('unmerged.mtz').strpath
+  unmerged_mtz(write_unmerged_mtz, hklin, observations)
+  m = merger(hklin)
+
+  merged = m.get_merged_reflections()
+  assert sorted(merged) == [(0, 1, 4), (1, 2, 3), (2, 0, 1)]
+  assert merged[(1, 2, 3)] == pytest.approx((100, math.sqrt(50)))
+  assert merged[(2, 0, 1)] == pytest.approx((200, math.sqrt(1 / 0.015)))
+  assert merged[(0, 1, 4)] == pytest.approx((50, 5))
+
+  # |I - <I>| summed over reflections seen more than once: 20 + 40 from
+  # 2 * 100 + 3 * 200; for I+ and I- separately only (2,0,1) I+ counts,
+  # with <I+> = (200 / 100 + 220 / 400) / (1 / 100 + 1 / 400) = 204
+  assert m.calculate_rmerge() == pytest.approx(60 / 800)
+  assert m.calculate_rmerge_anomalous() == pytest.approx(20 / 408)
+  # (I - <I>) / sigma are -1, 1, 0, 1, -1, 0
+  assert m.calculate_chisq() == pytest.approx((0, math.sqrt(4 / 6)),
+                                              abs=1e-6)
+  assert m.calculate_multiplicity() == pytest.approx(2)
+  assert m.calculate_merged_isigma() == pytest.approx(
+    (100 / math.sqrt(50) + 200 * math.sqrt(0.015) + 10) / 3)
+  assert m.calculate_unmerged_isigma() == pytest.approx(70 / 6)
+  # centric: 200 alone; acentric: 100 and 50 about their mean of 75
+  assert m.calculate_z2() == pytest.approx((1, (16 / 9 + 4 / 9) / 2))
+
+  # and for a list of reflections
+  assert m.calculate_rmerge([(1, 2, 3)]) == pytest.approx(0.1)
+  assert m.calculate_multiplicity([(1, 2, 3), (0, 1, 4)]) == 1.5
+  with pytest.raises(KeyError):
+    m.calculate_rmerge([(3, 2, 1)])
+
+  # reindexing changes only the indices, to the equivalents in the
+  # asymmetric unit of (h,-k,-l)
+  m.reindex('h,-k,-l')
+  assert sorted(m.get_merged_reflections().values()) == sorted(
+    merged.values())
+  assert sorted(m.get_merged_reflections()) == [
+    (-2, 0, 1), (-1, 2, 3), (0, 1, 4)]
+  assert m.calculate_rmerge() == pytest.approx(60 / 800)
+  assert m.calculate_unmerged_isigma() == pytest.approx(70 / 6)
+
+  # now at 18.2, 24.9 and 16.3 A
+  m.apply_resolution_limit(17)
+  assert sorted(m.get_merged_reflections()) == [(-2, 0, 1), (-1, 2, 3)]
+  assert m.calculate_rmerge() == pytest.approx(60 / 800)
+  assert m.calculate_multiplicity() == pytest.approx(2.5)
+  assert m.calculate_unmerged_isigma() == pytest.approx(60 / 5)
+
+def complete_mtz(write_unmerged_mtz, filename, d_min, remove=()):
+  '''Write an MTZ file of all of the reflections to d_min bar those to
+  remove, each observed as I+ and I- with I/sigma 100 / (d*^2 * 1000) and
+  the two differing by 20%, and return the number of reflections.'''
+
+  from cctbx import crystal, miller
+
+  cs = crystal.symmetry(unit_cell=(50, 60, 70, 90, 105, 90),
+                        space_group_symbol='P 1 2 1')
+  ms = miller.build_set(cs, anomalous_flag=False, d_min=d_min)
+  observations = []
+  for hkl, d_star_sq in zip(ms.indices(), ms.d_star_sq().data()):
+    if hkl in remove:
+      continue
+    sigma = d_star_sq * 1000
+    observations.append((hkl, 90, sigma, 1, 1))
+    observations.append((hkl, 110, sigma, 2, 2))
+  unmerged_mtz(write_unmerged_mtz, filename, observations)
+  return ms.size(), ms.d_min()
+
+def test_merger_resolution(tmpdir, write_unmerged_mtz):
+  from xia2.Toolkit.Merger import merger
+
+  hklin = tmpdir.join('unmerged.mtz').strpath
+  n, d_min = complete_mtz(write_unmerged_mtz, hklin, d_min=2.5)
+  m = merger(hklin)
+  m.calculate_resolution_ranges(nbins=20)
+  bins, ranges = m.get_resolution_bins()
+
+  # the bins from low to high resolution, together holding every reflection
+  assert len(bins) == 19
+  assert sum(len(b) for b in bins) == n
+  assert ranges[0][1] > ranges[-1][0] == pytest.approx(d_min)
+
+  for j, b in enumerate(bins):
+    assert m.calculate_rmerge(b) == pytest.approx(0.1)
+    assert m.calculate_multiplicity(b) == 2
+    assert m.calculate_completeness(j) == 1
+  assert m.calculate_completeness() == 1
+
+  # none of these fall below their limits
+  for name, limit in (('resolution_rmerge', 0.5),
+                      ('resolution_merged_isigma', 0.1),
+                      ('resolution_completeness', 0.8)):
+    assert getattr(m, name)(limit=limit) == pytest.approx(d_min), name
+
+  # I/sigma is 100 / (1000 d*^2) = 0.1 d^2, so 1.0 at 3.16 A
+  assert m.resolution_unmerged_isigma(limit=1.0) == pytest.approx(
+    math.sqrt(10), abs=0.05)
+
+def test_merger_completeness(tmpdir, write_unmerged_mtz):
+  from xia2.Toolkit.Merger import merger
+
+  hklin = tmpdir.join('unmerged.mtz').strpath
+  n, d_min = complete_mtz(write_unmerged_mtz, hklin, d_min=2.5,
+                          remove=[(1, 2, 3), (2, 0, 1), (0, 1, 4)])
+  m = merger(hklin)
+  m.calculate_resolution_ranges(nbins=20)
+  bins, ranges = m.get_resolution_bins()
+
+  # the three reflections are missing from the lowest resolution bin, which
+  # is the last of the bins counted from high resolution
+  low = len(bins) - 1
+  assert m.calculate_completeness(low) == pytest.approx(
+    len(bins[0]) / (len(bins[0]) + 3))
+  for j in range(low):
+    assert m.calculate_completeness(j) == 1
+  assert m.calculate_completeness() == pytest.approx((n - 3) / n)
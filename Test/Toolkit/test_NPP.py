@@ -0,0 +1,78 @@
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+def test_unmerged_npp():
+  from cctbx import crystal, miller
+  from cctbx.array_family import flex
+  from xia2.Toolkit.NPP import quantiles, unmerged_npp
+
+  cs = crystal.symmetry(unit_cell=(10, 11, 12, 90, 95, 90),
+                        space_group_symbol='P 1 2 1')
+  # (1,0,0) three times, once as its equivalent (-1,0,0), mean 100 and
+  # variance 3 * 100 / 3; (0,0,1) four times, mean 25 and variance 25;
+  # (0,1,0) only twice, so left out
+  observations = [((1, 0, 0), 90, 10), ((0, 0, 1), 10, 5),
+                  ((-1, 0, 0), 110, 10), ((0, 1, 0), 7, 1),
+                  ((0, 0, 1), 30, 5), ((1, 0, 0), 100, 10),
+                  ((0, 0, 1), 20, 5), ((0, 1, 0), 9, 1),
+                  ((0, 0, 1), 40, 5)]
+  indices, data, sigmas = zip(*observations)
+  intensities = miller.array(
+    miller.set(cs, flex.miller_index(indices), anomalous_flag=False),
+    data=flex.double(data), sigmas=flex.double(sigmas))
+  intensities.set_observation_type_xray_intensity()
+
+  npp, imean, variobs = unmerged_npp(intensities)
+
+  assert [imean.indices()[int(g)] for g in npp.groups] == [
+    (0, 0, 1), (1, 0, 0)]
+  assert npp.multiplicity.tolist() == [4, 3]
+  assert [imean.data()[int(g)] for g in npp.groups] == pytest.approx(
+    [25, 100])
+  assert [variobs[int(g)] for g in npp.groups] == pytest.approx([25, 100])
+
+  # the sorted deviations in sigma are (-3, -1, 1, 3) and (-1, 0, 1)
+  # against the quantiles (-b, -a, a, b) and (-q, 0, q), all within 2
+  a, b = quantiles(4)[2:]
+  q = quantiles(3)[2]
+  assert b < 2
+  assert npp.slope_all == pytest.approx([(a + 3 * b) / (a * a + b * b), 1 / q])
+  assert npp.slope_central == pytest.approx(npp.slope_all)
+
+  expected, observed = npp.overall()
+  assert expected.tolist() == pytest.approx(
+    sorted([-b, -a, a, b, -q, 0, q]))
+  assert sorted(observed.tolist()) == pytest.approx([-3, -1, -1, 0, 1, 1, 3])
+  expected, observed = npp.overall(n_points=2)
+  assert expected.size == 2
+
+def test_unmerged_npp_outside_asu(random_unmerged):
+  import random
+  from cctbx import miller
+  from cctbx.array_family import flex
+  from xia2.Toolkit.NPP import unmerged_npp
+
+  intensities, batches = random_unmerged(
+    d_min=2, multiplicity=8, vary_multiplicity=True, shuffle=True)
+
+  # the same observations with their indices anywhere in reciprocal space
+  sg = intensities.space_group()
+  random.seed(0)
+  indices = flex.miller_index()
+  for hkl in intensities.indices():
+    equivalents = miller.sym_equiv_indices(sg, hkl).indices()
+    h = equivalents[random.randrange(len(equivalents))].h()
+    if random.random() < 0.5:
+      h = tuple(-i for i in h)
+    indices.append(h)
+  outside = intensities.customized_copy(indices=indices)
+  assert not outside.is_in_asu()
+
+  npp, imean, variobs = unmerged_npp(intensities)
+  npp_outside, imean_outside, variobs_outside = unmerged_npp(outside)
+  assert npp.groups.size > 0
+  assert list(imean_outside.indices()) == list(imean.indices())
+  assert (npp_outside.groups == npp.groups).all()
+  assert npp_outside.slope_all == pytest.approx(npp.slope_all)
+  assert npp_outside.slope_central == pytest.approx(npp.slope_central)
@@ -0,0 +1,78 @@
+from __future__ import absolute_import, division, print_function
+
+import binascii
+import collections
+import json
+import random
+import sys
+
+def write_cbf(filename, pixels, fast, slow, cutoff):
+  '''Write pixels to filename as a byte offset CBF image, with the count
+  cutoff given in the header.'''
+
+  from xia2.Modules.UnpackByteOffset import pack_values
+
+  packed = pack_values(pixels)
+  header = '\n'.join([
+    '# Count_cutoff %d counts' % cutoff,
+    'X-Binary-Size: %d' % len(packed),
+    'X-Binary-Number-of-Elements: %d' % (slow * fast),
+    'X-Binary-Size-Fastest-Dimension: %d' % fast,
+    'X-Binary-Size-Second-Dimension: %d' % slow, ''])
+  with open(filename, 'wb') as fh:
+    fh.write(header.encode('latin-1') + binascii.unhexlify('0c1a04d5') +
+             packed)
+
+def test_overload(tmpdir, monkeypatch):
+  from xia2.command_line.overload import build_hist, cbf_image_chunks
+
+  fast, slow, cutoff = 37, 29, 1000
+  rng = random.Random(0)
+  images = []
+  pixels = []
+  for j in range(3):
+    image = [rng.choice((rng.randint(0, 50), rng.randint(-1, 10000)))
+             for k in range(fast * slow)]
+    images.append(tmpdir.join('image_%d.cbf' % j).strpath)
+    write_cbf(images[-1], image, fast, slow, cutoff)
+    pixels.extend(image)
+
+  # decoded a chunk at a time, with a short last chunk
+  chunks = list(cbf_image_chunks(images[0], chunk_size=100))
+  assert [chunk.size for chunk in chunks] == [100] * 10 + [73]
+  assert [v for chunk in chunks for v in chunk.tolist()] == \
+    pixels[:fast * slow]
+
+  tmpdir.chdir()
+  monkeypatch.setattr(sys, 'argv', ['xia2.overload', 'nproc=1'] + images)
+  build_hist()
+
+  with open('overload.json') as fh:
+    result = json.load(fh)
+  expected = collections.Counter(v for v in pixels if 0 <= v <= 5 * cutoff)
+  assert result['overload_limit'] == cutoff
+  assert result['counts'] == dict(
+    (str(v), count) for v, count in expected.items())
+  assert sum(result['log_binned']['counts']) == sum(expected.values())
+  assert result['log_binned']['edges'][-1] == 5 * cutoff + 1
+
+def test_hdf5_image_chunks(tmpdir):
+  import numpy as np
+  import pytest
+  h5py = pytest.importorskip('h5py')
+  from xia2.command_line.overload import hdf5_image_chunks
+
+  # images split over two data sets, stored four rows to a chunk
+  images = np.arange(5 * 13 * 10).reshape(5, 13, 10)
+  filename = tmpdir.join('master.h5').strpath
+  with h5py.File(filename, 'w') as fh:
+    data = fh.create_group('entry/data')
+    data.create_dataset('data_000001', data=images[:2], chunks=(1, 4, 10))
+    data.create_dataset('data_000002', data=images[2:], chunks=(1, 4, 10))
+
+  for index in range(5):
+    chunks = list(hdf5_image_chunks(filename, index, chunk_size=50))
+    assert [chunk.size for chunk in chunks] == [40, 40, 40, 10]
+    assert np.concatenate(chunks).tolist() == images[index].ravel().tolist()
+  with pytest.raises(RuntimeError):
+    list(hdf5_image_chunks(filename, 5))
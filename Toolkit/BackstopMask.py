@@ -26,8 +26,11 @@
 
 import binascii
 import math
+import os
 import sys
 
+import numpy as np
+
 from xia2.Modules.UnpackByteOffset import pack_values, unpack_values
 
 def mmcc(ds, xs, ys):
@@ -40,9 +43,9 @@ def mmcc(ds, xs, ys):
   assert(len(ds) == len(xs))
   assert(len(ds) == len(ys))
 
-  ds = map(float, ds)
-  xs = map(float, xs)
-  ys = map(float, ys)
+  ds = list(map(float, ds))
+  xs = list(map(float, xs))
+  ys = list(map(float, ys))
 
   _d = sum(ds) / len(ds)
   _x = sum(xs) / len(xs)
@@ -138,14 +141,14 @@ def equation_of_line(p1, p2):
   # then check for the special case: vertical line
   if p1[0] == p2[0]:
     if p1[1] > p2[1]:
-      return -1.0, 0.0, -1.0 * p1[0]
+      return -1.0, 0.0, p1[0]
     else:
       return 1.0, 0.0, -1.0 * p1[0]
 
   # then the special case of the horizontal line
   if p1[1] == p2[1]:
     if p1[0] > p2[0]:
-      return 0.0, -1.0, -1.0 * p1[1]
+      return 0.0, -1.0, p1[1]
     else:
       return 0.0, 1.0, -1.0 * p1[1]
 
@@ -169,6 +172,9 @@ def work_equation_of_line():
   assert(equation_of_line((0.0, 0.0), (0.0, 2.0)) == (1.0, 0.0, 0.0))
   assert(equation_of_line((2.0, 1.0), (2.0, 2.0)) == (1.0, 0.0, -2.0))
 
+  assert(equation_of_line((2.0, 2.0), (1.0, 2.0)) == (0.0, -1.0, 2.0))
+  assert(equation_of_line((2.0, 2.0), (2.0, 1.0)) == (-1.0, 0.0, 2.0))
+
   for j in range(1000):
     p1 = (2.0 * random.random(), 2.0 * random.random())
     p2 = (2.0 * random.random(), 2.0 * random.random())
@@ -186,6 +192,10 @@ class BackstopMask(object):
   set of masks as a function of distance derived from inspection
   of images in ADXV.'''
 
+  # rasterised masks, shared by all instances, keyed by the fitted
+  # geometry, the distance and the image size
+  _masks = {}
+
   def __init__(self, site_file):
     '''Parse a site file containing records which begin:
 
@@ -201,7 +211,7 @@ def __init__(self, site_file):
     coordinates = {}
 
     for record in open(site_file):
-      values = map(float, record.split()[:9])
+      values = list(map(float, record.split()[:9]))
       if not values:
         continue
       distances.append(values[0])
@@ -260,12 +270,57 @@ def calculate_mask_mosflm(self, header):
     return tuple([self.to_mosflm_frame(header, p) \
                   for p in self.calculate_mask(header)])
 
+  def mask(self, header):
+    '''The backstop mask for images with the given header, as a read-only
+    boolean numpy array of shape (slow, fast) which is True for the pixels
+    with centres inside the backstop. This is computed once for each
+    distance and image size.'''
+
+    nx, ny = header['size']
+    key = (self._p2, self._p3, self._d21, self._d34,
+           header['distance'], int(nx), int(ny))
+
+    if not key in BackstopMask._masks:
+      mask = self.rectangle(header).mask(int(nx), int(ny))
+      mask.flags.writeable = False
+      BackstopMask._masks[key] = mask
+
+    return BackstopMask._masks[key]
+
+  def untrusted_quadrilateral(self, header):
+    '''The backstop as an XDS UNTRUSTED_QUADRILATERAL= record, in XDS pixel
+    coordinates which count from 1 at the centre of the first pixel.'''
+
+    return 'UNTRUSTED_QUADRILATERAL= %d %d %d %d %d %d %d %d' % tuple(
+      int(round(c + 0.5)) for p in self.calculate_mask(header) for c in p)
+
+  def dials_mask(self, header):
+    '''The backstop mask as a DIALS mask: a tuple of one flex.bool per
+    panel which is False for the masked pixels.'''
+
+    from scitbx.array_family import flex
+
+    mask = self.mask(header)
+    slow, fast = mask.shape
+
+    trusted = flex.bool(slow * fast, True)
+    trusted.set_selected(
+      flex.size_t(np.flatnonzero(mask).tolist()), False)
+    trusted.reshape(flex.grid(slow, fast))
+    return (trusted,)
+
+  def write_dials_mask(self, header, mask_file):
+    '''Write the backstop mask to mask_file as a DIALS mask pickle.'''
+
+    import six.moves.cPickle as pickle
+
+    with open(mask_file, 'wb') as fh:
+      pickle.dump(self.dials_mask(header), fh, pickle.HIGHEST_PROTOCOL)
+
   def apply_mask_xds(self, header, cbf_in, cbf_out):
     '''Apply the calculated backstop mask to a BKGINIT.cbf - do this
     immediately after the INIT step.'''
 
-    r = self.rectangle(header)
-
     data = open(cbf_in, 'rb').read()
 
     start_tag = binascii.unhexlify('0c1a04d5')
@@ -278,12 +333,12 @@ def apply_mask_xds(self, header, cbf_in, cbf_out):
     slow = 0
     length = 0
 
-    for record in cbf_header.split('\n'):
-      if 'X-Binary-Size-Fastest-Dimension' in record:
+    for record in cbf_header.split(b'\n'):
+      if b'X-Binary-Size-Fastest-Dimension' in record:
         fast = int(record.split()[-1])
-      elif 'X-Binary-Size-Second-Dimension' in record:
+      elif b'X-Binary-Size-Second-Dimension' in record:
         slow = int(record.split()[-1])
-      elif 'X-Binary-Number-of-Elements' in record:
+      elif b'X-Binary-Number-of-Elements' in record:
         length = int(record.split()[-1])
 
     assert(length == fast * slow)
@@ -291,22 +346,17 @@ def apply_mask_xds(self, header, cbf_in, cbf_out):
     assert(slow == int(header['size'][1]))
 
     values = unpack_values(data[data_offset:], length)
+    values[self.mask(header).ravel()] = -3
 
-    # or perhaps mask it out a little more cleverly
-
-    limits = r.limits()
-
-    for x in range(int(limits[0]), int(limits[1]) + 1):
-      for y in range(int(limits[2]), int(limits[3]) + 1):
-        j = y * fast + x
-        if r.is_inside((x + 0.5, y + 0.5)):
-          values[j] = -3
-
-    # and write out the updated file
+    # and write out the updated file - as a new file, so that any other
+    # link to cbf_out is left as it was
 
     result = cbf_header + start_tag + pack_values(values)
 
-    open(cbf_out, 'w').write(result)
+    if os.path.lexists(cbf_out):
+      os.remove(cbf_out)
+    with open(cbf_out, 'wb') as fh:
+      fh.write(result)
 
   def rectangle(self, header):
     '''Return a configured rectangle object to test whether pixels are
@@ -353,6 +403,32 @@ def limits(self):
 
     return min(xs), max(xs), min(ys), max(ys)
 
+  def mask(self, fast, slow):
+    '''Rasterise the rectangle onto an image of fast x slow pixels, testing
+    the centres of all pixels in the bounding box against the four sides
+    at once. Returns a boolean numpy array of shape (slow, fast), True for
+    those pixels where is_inside() is True for the centre.'''
+
+    x0, x1, y0, y1 = self.limits()
+    xs = np.arange(max(int(x0), 0), min(int(x1) + 1, fast))
+    ys = np.arange(max(int(y0), 0), min(int(y1) + 1, slow))
+
+    result = np.zeros((slow, fast), dtype=bool)
+    if not xs.size or not ys.size:
+      return result
+
+    px = (xs + 0.5)[np.newaxis, :]
+    py = (ys + 0.5)[:, np.newaxis]
+
+    inside = np.ones((ys.size, xs.size), dtype=bool)
+    for line, sign in ((self._l12, self._in12), (self._l23, self._in23),
+                       (self._l34, self._in34), (self._l41, self._in41)):
+      a, b, c = line
+      inside &= ~(sign * (a * px + b * py + c) < 0.0)
+
+    result[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1] = inside
+    return result
+
   def is_inside(self, p):
     if self._in12 * self._evaluate(self._l12, p) < 0.0:
       return False
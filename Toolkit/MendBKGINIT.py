@@ -5,12 +5,57 @@
 from __future__ import absolute_import, division, print_function
 
 import binascii
-import copy
 import sys
 
+import numpy as np
 from cbflib_adaptbx import compress, uncompress
 from scitbx.array_family import flex
 
+def untrusted_mask(untrusted, fast, slow):
+  '''Rasterise the untrusted rectangles (x0, x1, y0, y1), in XDS pixel
+  coordinates counting from 1 and inclusive, to a (slow, fast) mask.'''
+
+  mask = np.zeros((slow, fast), dtype=bool)
+  for x0, x1, y0, y1 in untrusted:
+    mask[max(y0 - 1, 0):max(y1, 0), max(x0 - 1, 0):max(x1, 0)] = True
+  return mask
+
+def box_sum(values, half_width=2):
+  '''The sum of values over the (2 * half_width + 1) square box about each
+  pixel well inside the image (by half_width), from the summed area
+  table.'''
+
+  table = np.zeros((values.shape[0] + 1, values.shape[1] + 1),
+                   dtype=np.int64)
+  table[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+  w = 2 * half_width + 1
+  return (table[w:, w:] - table[:-w, w:] - table[w:, :-w] + table[:-w, :-w])
+
+def mend_pixels(pixels, untrusted):
+  '''Replace each negative trusted pixel of the (slow, fast) array pixels
+  at least 5 pixels from the edge with the mean, truncated to an integer,
+  of the positive pixels in the 5x5 box about it (which is left alone if
+  there are none). Returns the positions (as indices into the flattened
+  array) and new values of the pixels replaced.'''
+
+  slow, fast = pixels.shape
+  mend = np.zeros((slow, fast), dtype=bool)
+  mend[5:slow - 5, 5:fast - 5] = pixels[5:slow - 5, 5:fast - 5] < 0
+  mend &= ~untrusted_mask(untrusted, fast, slow)
+
+  positive = pixels > 0
+  total = box_sum(np.where(positive, pixels, 0))
+  count = box_sum(positive.astype(np.int64))
+
+  # box sums are about pixel (s, f) at [s - 2, f - 2]
+  s, f = np.nonzero(mend)
+  total = total[s - 2, f - 2]
+  count = count[s - 2, f - 2]
+  keep = count > 0
+  s, f, total, count = s[keep], f[keep], total[keep], count[keep]
+
+  return s * fast + f, np.trunc(total / count).astype(np.int64)
+
 def recompute_BKGINIT(bkginit_in, init_lp, bkginit_out):
 
   start_tag = binascii.unhexlify('0c1a04d5')
@@ -40,31 +85,13 @@ def recompute_BKGINIT(bkginit_in, init_lp, bkginit_out):
 
   for record in open(init_lp):
     if 'UNTRUSTED_RECTANGLE=' in record:
-      untrusted.append(map(int, record.replace('.', ' ').split()[1:5]))
-
-  modified_pixel_values = copy.deepcopy(pixel_values)
-
-  for s in range(5, slow - 5):
-    y = s + 1
-    for f in range(5, fast - 5):
-      x = f + 1
-      trusted = True
-      for x0, x1, y0, y1 in untrusted:
-        if (x >= x0) and (x <= x1) and (y >= y0) and (y <= y1):
-          trusted = False
-          break
-
-      if trusted:
-        pixel = pixel_values[s * fast + f]
-        if pixel < 0:
-          pixels = []
-          for j in range(-2, 3):
-            for i in range(-2, 3):
-              p = pixel_values[(s + j) * fast + f + i]
-              if p > 0:
-                pixels.append(p)
-          modified_pixel_values[s * fast + f] = int(
-                                  sum(pixels) / len(pixels))
+      untrusted.append(list(map(int, record.replace('.', ' ').split()[1:5])))
+
+  positions, values = mend_pixels(
+    pixel_values.as_numpy_array().reshape(slow, fast), untrusted)
+
+  modified_pixel_values = pixel_values.set_selected(
+    flex.size_t(positions.tolist()), flex.int(values.tolist()))
 
   open(bkginit_out, 'wb').write(cbf_header + start_tag +
                                 compress(modified_pixel_values))
@@ -30,11 +30,11 @@
 from __future__ import absolute_import, division, print_function
 
 import copy
-import itertools
 import math
 import os
 import sys
 
+import numpy as np
 from cctbx.array_family import flex
 from cctbx.crystal import symmetry as crystal_symmetry
 from cctbx.miller import build_set, map_to_asu
@@ -45,6 +45,7 @@
 from xia2.Toolkit.MtzFactory import mtz_file
 from xia2.Toolkit.PolyFitter import (fit, get_positive_values,
                                      interpolate_value, log_fit, log_inv_fit)
+from xia2.lib.bits import group_by_key, hkl_keys, miller_indices_as_numpy
 
 def nint(a):
   return int(round(a))
@@ -211,16 +212,43 @@ def ism(x): return not x[0] % 2
 
     return result
 
+class resolution_shell_table(object):
+  '''Cumulative sums of per-reflection quantities, with the unique
+  reflections sorted by resolution (d ascending, then Miller index). The
+  sum of any quantity over a contiguous resolution range, such as one of
+  the shells from calculate_resolution_ranges or everything beyond a
+  cutoff, is then the difference of two entries.'''
+
+  def __init__(self, d, hkl, **columns):
+    self.order = np.lexsort((hkl[:, 2], hkl[:, 1], hkl[:, 0], d))
+    self.d = d[self.order]
+    self._sums = { }
+    for name, values in columns.items():
+      self._sums[name] = np.append(0, np.cumsum(values[self.order]))
+
+  def __len__(self):
+    return self.d.size
+
+  def total(self, name, start, end):
+    '''Sum of the named quantity over reflections start to end - 1.'''
+    return self._sums[name][end] - self._sums[name][start]
+
+  def ratio(self, top, bottom, start, end):
+    '''Ratio of sums of two quantities, or 0.0 if the bottom is zero.'''
+    b = self.total(bottom, start, end)
+    if not b:
+      return 0.0
+    return self.total(top, start, end) / b
+
 class merger(object):
-  '''A class to calculate things from merging reflections.'''
+  '''A class to calculate things from merging reflections. The observations
+  are held as columns sorted by Miller index, so that merging and the
+  statistics are segmented reductions over runs of equivalent observations
+  rather than loops over per-reflection Python objects.'''
 
   def __init__(self, hklin):
 
     self._mf = mtz_file(hklin)
-    self._unmerged_reflections = { }
-    self._merged_reflections = { }
-    self._merged_reflections_anomalous = { }
-    self._unmerged_di = { }
 
     all_columns = self._mf.get_column_names()
 
@@ -235,127 +263,156 @@ def __init__(self, hklin):
     else:
       raise RuntimeError('no baseline column (DOSE or BATCH) found')
 
+    self._complete = None
     self._read_unmerged_reflections()
-    self._merge_reflections()
-    self._merge_reflections_anomalous()
-
-    # self._calculate_unmerged_di()
 
   def debug_info(self):
     '''Pull out some information for debugging, namely total intensity,
     number of reflections &c.'''
 
-    n = 0
-    I = 0.0
-
-    for hkl in self._unmerged_reflections:
-      for o in self._unmerged_reflections[hkl].get():
-        n += 1
-        I += o[1]
-
-    return n, I
+    return self._i.size, float(self._i.sum())
 
   def reload(self):
     '''Reload the reflection list &c.'''
 
-    self._unmerged_reflections = { }
-    self._merged_reflections = { }
-    self._merged_reflections_anomalous = { }
-
     self._read_unmerged_reflections()
-    self._merge_reflections()
-    self._merge_reflections_anomalous()
 
   def accumulate(self, other_merger):
     '''Accumulate all of the measurements from another merger class
     instance.'''
 
-    # self._unmerged_reflections = { }
-    # self._merged_reflections = { }
-    # self._merged_reflections_anomalous = { }
-
-    # self._read_unmerged_reflections()
-
-    other_unmerged_reflections = other_merger.get_unmerged_reflections()
-
-    for hkl in other_unmerged_reflections:
-      if not hkl in self._unmerged_reflections:
-        self._unmerged_reflections[hkl] = unmerged_intensity()
-      for observation in other_unmerged_reflections[hkl].get():
-        m_isym, i, sigi, b = observation
-        self._unmerged_reflections[hkl].add(m_isym, i, sigi, b)
-
-    self._merge_reflections()
-    self._merge_reflections_anomalous()
+    self._set_observations(*[
+      np.concatenate((mine, other)) for mine, other in zip(
+        self._get_observations(), other_merger._get_observations())])
 
     return
 
   def _read_unmerged_reflections(self):
     '''Actually read the reflections in to memory.'''
 
-    mi = self._mf.get_miller_indices()
-    m_isym = self._mf.get_column_values('M_ISYM')
-    i = self._mf.get_column_values('I')
-    sigi = self._mf.get_column_values('SIGI')
-    b = self._mf.get_column_values(self._b_column)
+    def column(name):
+      return self._mf.get_column_values(name).as_numpy_array()
 
-    for j in range(len(i)):
-      hkl = mi[j]
-      if not hkl in self._unmerged_reflections:
-        self._unmerged_reflections[hkl] = unmerged_intensity()
-      self._unmerged_reflections[hkl].add(
-          m_isym[j], i[j], sigi[j], b[j])
+    self._set_observations(
+      miller_indices_as_numpy(self._mf.get_miller_indices()),
+      column('M_ISYM').round().astype(np.int64), column('I'),
+      column('SIGI'), column(self._b_column))
 
     return
 
-  def _merge_reflections(self):
-    '''Merge the currently recorded unmerged reflections.'''
+  def _get_observations(self):
+    '''Return the columns hkl, m_isym, i, sigi, b of all observations.'''
 
-    for hkl in self._unmerged_reflections:
-      self._merged_reflections[hkl] = self._unmerged_reflections[
-          hkl].merge()
+    return (np.repeat(self._hkl, self._multiplicity, axis=0), self._m_isym,
+            self._i, self._sigi, self._b)
 
-    return
+  def _set_observations(self, hkl, m_isym, i, sigi, b):
+    '''Sort the observations by Miller index into groups of equivalent
+    observations, then merge them.'''
 
-  def _merge_reflections_anomalous(self):
-    '''Merge the currently recorded unmerged reflections.'''
+    perm, self._keys, self._group, offsets = group_by_key(hkl_keys(hkl))
+    self._hkl = hkl[perm[offsets[:-1]]]
+    self._m_isym = m_isym[perm]
+    self._i = i[perm]
+    self._sigi = sigi[perm]
+    self._b = b[perm]
+    self._multiplicity = np.diff(offsets)
 
-    for hkl in self._unmerged_reflections:
-      self._merged_reflections_anomalous[
-          hkl] = self._unmerged_reflections[hkl].merge_anomalous()
+    miller_indices = flex.miller_index([tuple(h) for h in self._hkl.tolist()])
+    sg = self._mf.get_space_group()
+    self._d = self._mf.get_unit_cell().d(miller_indices).as_numpy_array()
+    self._centric = sg.is_centric(miller_indices).as_numpy_array()
+    self._sys_absent = sg.is_sys_absent(miller_indices).as_numpy_array()
 
-    return
+    self._merged_reflections = None
+    self._merge_reflections()
 
-  def _calculate_unmerged_di(self):
-    '''Calculate a set of unmerged intensity differences.'''
+  def _group_sum(self, values):
+    return np.bincount(self._group, weights=values,
+                       minlength=self._keys.size)
 
-    for hkl in self._unmerged_reflections:
-      self._unmerged_di[hkl] = self._unmerged_reflections[
-          hkl].calculate_unmerged_di()
+  def _merge_reflections(self):
+    '''Merge the currently recorded unmerged reflections, for I and for
+    I+, I- separately (+/- defined by M_ISYM record, which if odd = I+,
+    even I-), and tabulate the per-reflection sums needed for the
+    statistics.'''
+
+    w = 1.0 / (self._sigi * self._sigi)
+    sum_w = self._group_sum(w)
+    self._i_mean = self._group_sum(w * self._i) / sum_w
+    self._sigi_mean = np.sqrt(1.0 / sum_w)
+
+    plus = (self._m_isym % 2).astype(bool)
+    sum_w_p = self._group_sum(np.where(plus, w, 0.0))
+    sum_w_m = sum_w - sum_w_p
+    sum_wi_p = self._group_sum(np.where(plus, w * self._i, 0.0))
+    sum_wi_m = self._group_sum(np.where(plus, 0.0, w * self._i))
+    with np.errstate(divide='ignore', invalid='ignore'):
+      self._i_mean_p = np.where(sum_w_p > 0, sum_wi_p / sum_w_p, 0.0)
+      self._sigi_mean_p = np.where(sum_w_p > 0, np.sqrt(1.0 / sum_w_p), 0.0)
+      self._i_mean_m = np.where(sum_w_m > 0, sum_wi_m / sum_w_m, 0.0)
+      self._sigi_mean_m = np.where(sum_w_m > 0, np.sqrt(1.0 / sum_w_m), 0.0)
+
+    # Rmerge: reflections with only one observation do not contribute
+
+    multiple = self._multiplicity > 1
+    self._rmerge_top = np.where(multiple, self._group_sum(
+      np.abs(self._i - self._i_mean[self._group])), 0.0)
+    self._rmerge_bottom = np.where(
+      multiple, self._multiplicity * self._i_mean, 0.0)
+
+    mult_p = self._group_sum(plus.astype(np.float64))
+    mult_m = self._multiplicity - mult_p
+    self._rmerge_anomalous_top = self._group_sum(np.abs(self._i - np.where(
+      plus, self._i_mean_p[self._group], self._i_mean_m[self._group])))
+    self._rmerge_anomalous_bottom = \
+      np.where(mult_p == 1, 0, mult_p) * self._i_mean_p + \
+      np.where(mult_m == 1, 0, mult_m) * self._i_mean_m
+
+    self._isigma_sum = self._group_sum(self._i / self._sigi)
+
+    self._shells = resolution_shell_table(
+      self._d, self._hkl,
+      n_unique=np.ones(self._keys.size, dtype=np.int64),
+      n_present=(~self._sys_absent).astype(np.int64),
+      n_obs=self._multiplicity,
+      rmerge_top=self._rmerge_top,
+      rmerge_bottom=self._rmerge_bottom,
+      isigma_sum=self._isigma_sum,
+      merged_isigma=self._i_mean / self._sigi_mean)
 
     return
 
+  def _groups(self, hkl_list):
+    '''Return the group indices for a list of Miller indices, or of all
+    reflections if no list is given.'''
+
+    if not hkl_list:
+      return np.arange(self._keys.size)
+
+    keys = hkl_keys(np.array(hkl_list, dtype=np.int64).reshape(-1, 3))
+    groups = np.minimum(np.searchsorted(self._keys, keys), self._keys.size - 1)
+    missing = self._keys[groups] != keys
+    if missing.any():
+      raise KeyError(tuple(hkl_list[np.flatnonzero(missing)[0]]))
+    return groups
+
+  def _observations(self, groups):
+    '''Return a selection of the observations belonging to the groups.'''
+
+    selected = np.zeros(self._keys.size, dtype=bool)
+    selected[groups] = True
+    return selected[self._group]
+
   def apply_kb(self, k, b):
     '''Apply kB scale factors to the recorded measurements, for all
     merged and unmerged observations.'''
 
-    for hkl in self._merged_reflections:
-      d = self.resolution(hkl)
-      scale = k * math.exp(-1 * b / (d * d))
-      i, sigi = self._merged_reflections[hkl]
-      self._merged_reflections[hkl] = (i * scale, sigi * scale)
-
-    for hkl in self._merged_reflections_anomalous:
-      d = self.resolution(hkl)
-      scale = k * math.exp(-1 * b / (d * d))
-      ip, sigip, im, sigim = self._merged_reflections_anomalous[hkl]
-      self._merged_reflections_anomalous[hkl] = (
-          ip * scale, sigip * scale, im * scale, sigim * scale)
-
-    for hkl in self._unmerged_reflections:
-      d = self.resolution(hkl)
-      scale = k * math.exp(-1 * b / (d * d))
-      self._unmerged_reflections[hkl].apply_scale(scale)
+    scale = (k * np.exp(-1 * b / (self._d * self._d)))[self._group]
+    self._i = self._i * scale
+    self._sigi = self._sigi * scale
+    self._merged_reflections = None
+    self._merge_reflections()
 
     return
 
@@ -363,70 +420,41 @@ def reindex(self, reindex_operation):
     '''Reindex the reflections by the given reindexing operation.'''
 
     R = rt_mx(reindex_operation).inverse()
+    r = np.array(R.r().as_double()).reshape(3, 3)
+    t = np.array(R.t().as_double())
 
-    # first construct mapping table - native, anomalous
-
-    map_native = { }
-
-    hkls = flex.miller_index()
-
-    for hkl in self._merged_reflections:
-      Fhkl = R * hkl
-      Rhkl = nint(Fhkl[0]), nint(Fhkl[1]), nint(Fhkl[2])
-      hkls.append(Rhkl)
-
+    Fhkl = np.dot(self._hkl, r.T) + t
+    Rhkl = np.copysign(np.floor(np.abs(Fhkl) + 0.5), Fhkl).astype(np.int64)
+    hkls = flex.miller_index([tuple(h) for h in Rhkl.tolist()])
     map_to_asu(self._mf.get_space_group().type(), False, hkls)
 
-    for j, hkl in enumerate(self._merged_reflections):
-      map_native[hkl] = hkls[j]
-
-    map_anomalous = { }
-
-    hkls = flex.miller_index()
-
-    for hkl in self._merged_reflections_anomalous:
-      Fhkl = R * hkl
-      Rhkl = nint(Fhkl[0]), nint(Fhkl[1]), nint(Fhkl[2])
-      hkls.append(Rhkl)
-
-    map_to_asu(self._mf.get_space_group().type(), True, hkls)
-
-    for j, hkl in enumerate(self._merged_reflections_anomalous):
-      map_anomalous[hkl] = hkls[j]
-
-    # then remap the actual measurements
-
-    merged_reflections = { }
-
-    for hkl in self._merged_reflections:
-      Rhkl = map_native[hkl]
-      merged_reflections[Rhkl] = self._merged_reflections[hkl]
-
-    self._merged_reflections = merged_reflections
-
-    merged_reflections = { }
-
-    for hkl in self._merged_reflections_anomalous:
-      Rhkl = map_anomalous[hkl]
-      merged_reflections[Rhkl] = self._merged_reflections_anomalous[hkl]
-
-    self._merged_reflections_anomalous = merged_reflections
-
-    unmerged_reflections = { }
-
-    for hkl in self._unmerged_reflections:
-      Rhkl = map_native[hkl]
-      unmerged_reflections[Rhkl] = self._unmerged_reflections[hkl]
-
-    self._unmerged_reflections = unmerged_reflections
+    hkl, m_isym, i, sigi, b = self._get_observations()
+    self._set_observations(
+      np.repeat(miller_indices_as_numpy(hkls), self._multiplicity, axis=0),
+      m_isym, i, sigi, b)
 
     return
 
   def get_merged_reflections(self):
+    if self._merged_reflections is None:
+      self._merged_reflections = dict(zip(
+        map(tuple, self._hkl.tolist()),
+        zip(self._i_mean.tolist(), self._sigi_mean.tolist())))
     return self._merged_reflections
 
   def get_unmerged_reflections(self):
-    return self._unmerged_reflections
+    '''Return the observations as a dictionary of unmerged_intensity
+    objects keyed by Miller index.'''
+
+    unmerged_reflections = { }
+    offsets = np.append(0, np.cumsum(self._multiplicity)).tolist()
+    observations = list(zip(self._m_isym.tolist(), self._i.tolist(),
+                            self._sigi.tolist(), self._b.tolist()))
+    for j, hkl in enumerate(map(tuple, self._hkl.tolist())):
+      unmerged_reflections[hkl] = unmerged_intensity()
+      unmerged_reflections[hkl]._observations = observations[
+        offsets[j]:offsets[j + 1]]
+    return unmerged_reflections
 
   def resolution(self, hkl):
     '''Compute the resolution corresponding to this miller index.'''
@@ -434,77 +462,93 @@ def resolution(self, hkl):
     return self._mf.get_unit_cell().d(hkl)
 
   def calculate_resolution_ranges(self, nbins = 20):
-    '''Calculate semi-useful resolution ranges for analysis.'''
+    '''Calculate semi-useful resolution ranges for analysis, as ranges of
+    positions in the resolution shell table.'''
 
-    miller_indices = list(self._merged_reflections)
-    uc = self._mf.get_unit_cell()
+    n = len(self._shells)
 
-    d_mi = []
+    chunk_size = int(round(float(n) / nbins))
 
-    for mi in miller_indices:
-      d = uc.d(mi)
-      d_mi.append((d, mi))
+    starts = list(range(0, n, chunk_size))
+    bin_ranges = list(zip(starts, starts[1:] + [n]))
 
-    d_mi.sort()
-
-    chunk_size = int(round(float(len(d_mi)) / nbins))
+    # stitch together the two low res bins
 
-    hkl_ranges = []
-    resolution_ranges = []
+    self._bin_ranges = bin_ranges[:-1]
+    self._bin_ranges[-1] = (self._bin_ranges[-1][0], n)
 
-    for chunk in [d_mi[i:i + chunk_size] \
-                  for i in range(0, len(d_mi), chunk_size)]:
-      mi = [c[1] for c in chunk]
-      d = [c[0] for c in chunk]
-      hkl_ranges.append(mi)
-      resolution_ranges.append((min(d), max(d)))
+    self._resolution_ranges = [
+      (self._shells.d[start], self._shells.d[end - 1])
+      for start, end in self._bin_ranges]
 
-    # stitch together the two low res bins
+    # the number of reflections in each range were the data complete: the
+    # complete set is sorted in the same order as the table, so each range
+    # starts at the position its first reflection would take in that set,
+    # with any beyond the observed limits counted in the outermost ranges
 
-    self._hkl_ranges = hkl_ranges[:-1]
-    for mi in hkl_ranges[-1]:
-      self._hkl_ranges[-1].append(mi)
-
-    self._resolution_ranges = resolution_ranges[:-1]
-    self._resolution_ranges[-1] = (self._resolution_ranges[-1][0],
-                                   resolution_ranges[-1][1])
+    d, hkl = self._complete_set()
+    positions = [0]
+    for start, end in self._bin_ranges[1:]:
+      d0, hkl0 = self._shells.d[start], self._hkl[self._shells.order[start]]
+      lo = np.searchsorted(d, d0, side='left')
+      hi = np.searchsorted(d, d0, side='right')
+      positions.append(lo + sum(
+        tuple(h) < tuple(hkl0) for h in hkl[lo:hi].tolist()))
+    self._n_calc = np.diff(positions + [d.size])
 
     return
 
+  def _complete_set(self):
+    '''The resolutions and Miller indices of all of the reflections in the
+    resolution range of the file, sorted as the resolution shell table and
+    computed only once.'''
+
+    if self._complete is None:
+      # the range from the same unit cell as the observed resolutions, as
+      # the one recorded in the file may be rounded, and inclusive at both
+      # ends where build_set excludes d_max
+
+      uc = self._mf.get_unit_cell()
+      resolution_range = flex.min_max_mean_double(
+        uc.d(self._mf.get_miller_indices()))
+      cs = crystal_symmetry(unit_cell = uc,
+                            space_group = self._mf.get_space_group())
+      complete_set = build_set(cs, False, d_min = resolution_range.min)
+      d = complete_set.d_spacings().data().as_numpy_array()
+      within = d <= resolution_range.max
+      d = d[within]
+      hkl = miller_indices_as_numpy(complete_set.indices())[within]
+      order = np.lexsort((hkl[:, 2], hkl[:, 1], hkl[:, 0], d))
+      self._complete = d[order], hkl[order]
+
+    return self._complete
+
+  def _get_resolution_bins(self):
+    '''As get_resolution_bins, with each bin as a (start, end) range of
+    the resolution shell table.'''
+
+    return list(reversed(self._bin_ranges)), \
+           list(reversed(self._resolution_ranges))
+
   def get_resolution_bins(self):
     '''Return the reversed resolution limits - N.B. this is most
     important when considering resolution calculations, see
     resolution_completeness.'''
 
-    return list(reversed(self._hkl_ranges)), \
+    hkl_ranges = [
+      list(map(tuple, self._hkl[self._shells.order[start:end]].tolist()))
+      for start, end in self._bin_ranges]
+
+    return list(reversed(hkl_ranges)), \
            list(reversed(self._resolution_ranges))
 
   def apply_resolution_limit(self, dmin):
     '''Remove reflections with resolution < dmin.'''
 
-    delete = []
-    for hkl in self._merged_reflections:
-      if self.resolution(hkl) < dmin:
-        delete.append(hkl)
-
-    for hkl in delete:
-      del(self._merged_reflections[hkl])
-
-    delete = []
-    for hkl in self._merged_reflections_anomalous:
-      if self.resolution(hkl) < dmin:
-        delete.append(hkl)
-
-    for hkl in delete:
-      del(self._merged_reflections_anomalous[hkl])
-
-    delete = []
-    for hkl in self._unmerged_reflections:
-      if self.resolution(hkl) < dmin:
-        delete.append(hkl)
-
-    for hkl in delete:
-      del(self._unmerged_reflections[hkl])
+    keep = (self._d >= dmin)[self._group]
+    hkl, m_isym, i, sigi, b = self._get_observations()
+    self._set_observations(
+      hkl[keep], m_isym[keep], i[keep], sigi[keep], b[keep])
 
     return
 
@@ -513,46 +557,25 @@ def calculate_completeness(self, resolution_bin = None):
     resolution bin.'''
 
     if resolution_bin is None:
-      resolution_range = self._mf.get_resolution_range()
-      hkl_list = list(self._merged_reflections)
+      shell_range = 0, len(self._shells)
+      n_calc = self._complete_set()[0].size
     else:
-      resolution_range = self._resolution_ranges[resolution_bin]
-      hkl_list = self._hkl_ranges[resolution_bin]
-
-    uc = self._mf.get_unit_cell()
-    sg = self._mf.get_space_group()
-
-    dmin = min(resolution_range)
-    dmax = max(resolution_range)
-
-    cs = crystal_symmetry(unit_cell = uc, space_group = sg)
-    hkl_calc = [hkl for hkl in build_set(
-        cs, False, d_min = dmin, d_max = dmax).indices()]
+      shell_range = self._bin_ranges[resolution_bin]
+      n_calc = self._n_calc[resolution_bin]
 
-    # remove systematically absent reflections
+    # do not count systematically absent reflections
 
-    hkl_list = [hkl for hkl in
-                itertools.ifilterfalse(sg.is_sys_absent, hkl_list)]
+    n_obs = self._shells.total('n_present', *shell_range)
 
-    return float(len(hkl_list)) / float(len(hkl_calc))
+    return float(n_obs) / float(n_calc)
 
   def calculate_rmerge(self, hkl_list = None):
     '''Calculate the overall Rmerge.'''
 
-    t = 0.0
-    b = 0.0
+    groups = self._groups(hkl_list)
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
-
-    for hkl in hkl_list:
-      # if we have only one observation, do not include in the
-      # rmerge calculations
-      if self._unmerged_reflections[hkl].multiplicity() > 1:
-        i_mean = self._merged_reflections[hkl][0]
-        t += self._unmerged_reflections[hkl].rmerge_contribution(
-            i_mean)
-        b += self._unmerged_reflections[hkl].multiplicity() * i_mean
+    t = self._rmerge_top[groups].sum()
+    b = self._rmerge_bottom[groups].sum()
 
     if not b:
       return 0.0
@@ -562,31 +585,10 @@ def calculate_rmerge(self, hkl_list = None):
   def calculate_rmerge_anomalous(self, hkl_list = None):
     '''Calculate the overall Rmerge, separating anomalous pairs.'''
 
-    t = 0.0
-    b = 0.0
-
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
-
-    for hkl in hkl_list:
-      is_pm = self._merged_reflections_anomalous[hkl]
-      i_mean_p, i_mean_m = is_pm[0], is_pm[2]
-      r_pm = self._unmerged_reflections[
-          hkl].rmerge_contribution_anomalous(i_mean_p, i_mean_m)
-      t += r_pm[0] + r_pm[1]
-
-      # if we have only one observation, do not include in the
-      # rmerge calculations
+    groups = self._groups(hkl_list)
 
-      mult_p, mult_m = self._unmerged_reflections[
-          hkl].multiplicity_anomalous()
-
-      if mult_p == 1:
-        mult_p = 0
-      if mult_m == 1:
-        mult_m = 0
-
-      b += mult_p * i_mean_p + mult_m * i_mean_m
+    t = self._rmerge_anomalous_top[groups].sum()
+    b = self._rmerge_anomalous_bottom[groups].sum()
 
     if not b:
       return 0.0
@@ -596,86 +598,52 @@ def calculate_rmerge_anomalous(self, hkl_list = None):
   def calculate_chisq(self, hkl_list = None):
     '''Calculate the overall ersatz chi^2.'''
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
+    sel = self._observations(self._groups(hkl_list))
 
-    deltas = []
+    deltas = (self._i[sel] - self._i_mean[self._group[sel]]) / self._sigi[sel]
 
-    for hkl in hkl_list:
-      i_mean = self._merged_reflections[hkl][0]
-      for d in self._unmerged_reflections[hkl].chisq_contribution(
-          i_mean):
-        deltas.append(d)
-
-    mean = sum(deltas) / len(deltas)
-    var = sum([(d - mean) * (d - mean) for d in deltas]) / len(deltas)
+    mean = deltas.mean()
+    var = ((deltas - mean) * (deltas - mean)).mean()
 
     return mean, math.sqrt(var)
 
   def calculate_multiplicity(self, hkl_list = None):
     '''Calculate the overall average multiplicity.'''
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
-
-    multiplicity = [float(self._unmerged_reflections[hkl].multiplicity()) \
-                    for hkl in hkl_list]
-
-    return sum(multiplicity) / len(multiplicity)
+    return float(self._multiplicity[self._groups(hkl_list)].mean())
 
   def calculate_merged_isigma(self, hkl_list = None):
     '''Calculate the average merged I/sigma.'''
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
-
-    isigma_values = [self._merged_reflections[hkl][0] / \
-                     self._merged_reflections[hkl][1] \
-                     for hkl in hkl_list]
+    groups = self._groups(hkl_list)
 
-    return sum(isigma_values) / len(isigma_values)
+    return float((self._i_mean[groups] / self._sigi_mean[groups]).mean())
 
   def calculate_unmerged_isigma(self, hkl_list = None):
     '''Calculate the average unmerged I/sigma.'''
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
+    groups = self._groups(hkl_list)
 
-    return sum([self._unmerged_reflections[hkl].isigma_contribution() \
-                for hkl in hkl_list]) / \
-                sum([self._unmerged_reflections[hkl].multiplicity() \
-                     for hkl in hkl_list])
+    return self._isigma_sum[groups].sum() / \
+      self._multiplicity[groups].sum()
 
   def calculate_z2(self, hkl_list = None):
     '''Calculate average Z^2 values, where Z = I/<I> in the bin,
     from the merged observations. Now also separate centric and
     acentric reflections.'''
 
-    if not hkl_list:
-      hkl_list = list(self._merged_reflections)
+    groups = self._groups(hkl_list)
 
     # separate centric and acentric reflections
 
-    sg = self._mf.get_space_group()
-
-    hkl_centric = [hkl for hkl in
-                   itertools.ifilter(sg.is_centric, hkl_list)]
-    hkl_acentric = [hkl for hkl in
-                    itertools.ifilterfalse(sg.is_centric, hkl_list)]
-
-    i_s = [self._merged_reflections[hkl][0] for hkl in hkl_centric]
-    mean_i = sum(i_s) / len(i_s)
-
-    z_s = [i / mean_i for i in i_s]
-    z_centric = sum([z * z for z in z_s]) / len(z_s)
-
-    i_s = [self._merged_reflections[hkl][0] for hkl in hkl_acentric]
-    mean_i = sum(i_s) / len(i_s)
+    z2 = []
 
-    z_s = [i / mean_i for i in i_s]
-    z_acentric = sum([z * z for z in z_s]) / len(z_s)
+    for i_s in (self._i_mean[groups[self._centric[groups]]],
+                self._i_mean[groups[~self._centric[groups]]]):
+      z_s = i_s / i_s.mean()
+      z2.append(float((z_s * z_s).mean()))
 
-    return z_centric, z_acentric
+    return tuple(z2)
 
   def resolution_rmerge(self, limit = None, log = None):
     '''Compute a resolution limit where either rmerge = 1.0 (limit if
@@ -685,13 +653,13 @@ def resolution_rmerge(self, limit = None, log = None):
     if limit is None:
       limit = Flags.get_rmerge()
 
-    bins, ranges = self.get_resolution_bins()
+    bins, ranges = self._get_resolution_bins()
 
     if limit == 0.0:
       return ranges[-1][0]
 
     rmerge_s = get_positive_values(
-        [self.calculate_rmerge(bin) for bin in bins])
+        [self._shells.ratio('rmerge_top', 'rmerge_bottom', *bin) for bin in bins])
 
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(rmerge_s)]
 
@@ -726,10 +694,10 @@ def new_resolution_unmerged_isigma(self, limit = None, log = None):
     if limit is None:
       limit = Flags.get_isigma()
 
-    bins, ranges = self.get_resolution_bins()
+    bins, ranges = self._get_resolution_bins()
 
     isigma_s = get_positive_values(
-        [self.calculate_unmerged_isigma(bin) for bin in bins])
+        [self._shells.ratio('isigma_sum', 'n_obs', *bin) for bin in bins])
 
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(isigma_s)]
 
@@ -779,10 +747,10 @@ def resolution_unmerged_isigma(self, limit = None, log = None):
     if limit is None:
       limit = Flags.get_isigma()
 
-    bins, ranges = self.get_resolution_bins()
+    bins, ranges = self._get_resolution_bins()
 
     isigma_s = get_positive_values(
-        [self.calculate_unmerged_isigma(bin) for bin in bins])
+        [self._shells.ratio('isigma_sum', 'n_obs', *bin) for bin in bins])
 
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(isigma_s)]
 
@@ -814,10 +782,10 @@ def new_resolution_merged_isigma(self, limit = None, log = None):
     if limit is None:
       limit = Flags.get_misigma()
 
-    bins, ranges = self.get_resolution_bins()
+    bins, ranges = self._get_resolution_bins()
 
     misigma_s = get_positive_values(
-        [self.calculate_merged_isigma(bin) for bin in bins])
+        [self._shells.ratio('merged_isigma', 'n_unique', *bin) for bin in bins])
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(misigma_s)]
 
     if min(misigma_s) > limit:
@@ -866,10 +834,10 @@ def resolution_merged_isigma(self, limit = None, log = None):
     if limit is None:
       limit = Flags.get_misigma()
 
-    bins, ranges = self.get_resolution_bins()
+    bins, ranges = self._get_resolution_bins()
 
     misigma_s = get_positive_values(
-        [self.calculate_merged_isigma(bin) for bin in bins])
+        [self._shells.ratio('merged_isigma', 'n_unique', *bin) for bin in bins])
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(misigma_s)]
 
     if min(misigma_s) > limit:
@@ -903,7 +871,7 @@ def resolution_completeness(self, limit = None, log = None):
     if limit is None:
       limit = Flags.get_completeness()
 
-    bins, ranges = self.get_resolution_bins()
+    bins, ranges = self._get_resolution_bins()
 
     s_s = [1.0 / (r[0] * r[0]) for r in reversed(ranges)]
 
@@ -2,6 +2,7 @@
 
 import math
 
+import numpy as np
 from scitbx.array_family import flex
 from scitbx.math import distributions
 from scitbx.random import poisson_distribution, variate
@@ -42,5 +43,138 @@ def npp_ify(values, input_mean_variance=None):
 
   return expected, scaled
 
+_quantile_tables = { }
+
+def quantiles(n):
+  '''The expected normal quantiles for a sample of n values, as a numpy
+  array - computed only once for each n.'''
+
+  n = int(n)
+  if not n in _quantile_tables:
+    distribution = distributions.normal_distribution()
+    _quantile_tables[n] = distribution.quantiles(n).as_numpy_array()
+  return _quantile_tables[n]
+
+def _slopes(x, y):
+  '''The least squares slope of each row of y against x.'''
+
+  dx = x - x.mean()
+  return (y - y.mean(axis=1)[:, None]).dot(dx) / dx.dot(dx)
+
+class grouped_npp(object):
+  '''The normal probability analysis of npp_ify for many groups of values
+  at once, each against the mean and variance given for its group, with the
+  slopes of the fits to all of the points and to those within 2 sigma. The
+  values are sorted once by multiplicity, group and value, after which all
+  of the groups of each multiplicity are transformed together. Groups of
+  fewer than min_multiplicity values are left out.
+
+  group is the group of each value, counting from 0, and means and
+  variances are by group; the results are by group in order of group.'''
+
+  def __init__(self, group, values, means, variances, min_multiplicity=3):
+    group = np.asarray(group)
+    values = np.asarray(values, dtype=np.float64)
+    means = np.asarray(means, dtype=np.float64)
+    variances = np.asarray(variances, dtype=np.float64)
+
+    multiplicity = np.bincount(group, minlength=means.size)
+    sel = np.flatnonzero(multiplicity[group] >= min_multiplicity)
+    order = sel[np.lexsort(
+      (values[sel], group[sel], multiplicity[group[sel]]))]
+
+    groups = []
+    slope_all = []
+    slope_central = []
+    expected = []
+    observed = []
+
+    start = 0
+    for m, count in zip(*np.unique(multiplicity[group[order]],
+                                   return_counts=True)):
+      n = count // m
+      block = order[start:start + n * m].reshape(n, m)
+      start += n * m
+
+      g = group[block[:, 0]]
+      x = quantiles(m)
+      y = (values[block] - means[g][:, None]) / \
+        np.sqrt(variances[g])[:, None]
+      central = np.abs(x) < 2
+
+      groups.append(g)
+      slope_all.append(_slopes(x, y))
+      slope_central.append(_slopes(x[central], y[:, central]))
+      expected.append(np.tile(x, n))
+      observed.append(y.ravel())
+
+    def concatenate(arrays, dtype=np.float64):
+      if not arrays:
+        return np.zeros(0, dtype=dtype)
+      return np.concatenate(arrays)
+
+    groups = concatenate(groups, dtype=np.int64)
+    perm = np.argsort(groups)
+
+    self.groups = groups[perm]
+    self.multiplicity = multiplicity[self.groups]
+    self.slope_all = concatenate(slope_all)[perm]
+    self.slope_central = concatenate(slope_central)[perm]
+
+    # the overall normal probability plot, of all of the groups together
+    self.expected = concatenate(expected)
+    self.observed = concatenate(observed)
+
+  def mean_slopes(self):
+    '''The mean slopes, fitting all values and those within 2 sigma.'''
+
+    return self.slope_all.mean(), self.slope_central.mean()
+
+  def overall(self, n_points=None):
+    '''The overall normal probability plot, as (expected, observed) sorted
+    by expected value - optionally reduced to n_points by averaging points
+    adjacent in order.'''
+
+    perm = np.argsort(self.expected, kind='mergesort')
+    expected = self.expected[perm]
+    observed = self.observed[perm]
+    if n_points is not None and n_points < expected.size:
+      chunks = np.array_split(np.arange(expected.size), n_points)
+      expected = np.array([expected[c].mean() for c in chunks])
+      observed = np.array([observed[c].mean() for c in chunks])
+    return expected, observed
+
+def unmerged_npp(intensities, min_multiplicity=3):
+  '''The grouped_npp of unmerged intensities, each against the mean of its
+  reflection with the variance from the sigmas scaled up by the
+  multiplicity - to account for the sqrt(multiplicity) effective scaling.
+  Also returns the merged intensities, with variances.'''
+
+  from xia2.lib.bits import hkl_keys, miller_indices_as_numpy
+
+  # the merged reflections have their indices in the asymmetric unit, so
+  # the observations must too to be found among them
+  intensities = intensities.map_to_asu()
+
+  # merging: use external variance i.e. variances derived from SIGI column
+  merger = intensities.merge_equivalents(use_internal_variance=False)
+  mult = merger.redundancies().data()
+  imean = merger.array()
+  variobs = (imean.sigmas() ** 2) * mult.as_double()
+
+  unique_keys = hkl_keys(miller_indices_as_numpy(imean.indices()))
+  keys = hkl_keys(miller_indices_as_numpy(intensities.indices()))
+  sorter = np.argsort(unique_keys)
+  position = np.searchsorted(unique_keys, keys, sorter=sorter)
+  group = sorter[np.minimum(position, unique_keys.size - 1)]
+  assert (unique_keys[group] == keys).all(), \
+    'observations not found among the merged reflections'
+
+  result = grouped_npp(group, intensities.data().as_numpy_array(),
+                       imean.data().as_numpy_array(),
+                       variobs.as_numpy_array(),
+                       min_multiplicity=min_multiplicity)
+  return result, imean, variobs
+
 if __name__ == '__main__':
   test()
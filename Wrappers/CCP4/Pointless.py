@@ -248,6 +248,10 @@ def decide_pointgroup(self, ignore_errors=False, batches=None):
         self.add_command_line('hklref')
         self.add_command_line(self._hklref)
 
+      # the input files are on the command line: declare the output, so
+      # that the results may be replayed from a run cache
+      self.add_output_file('%d_pointless.xml' % self.get_xpid())
+
       self.start()
 
       if self._allow_out_of_sequence_files:
@@ -515,6 +519,9 @@ def decide_spacegroup(self):
       self.add_command_line('hklout')
       self.add_command_line('pointless.mtz')
 
+      self.add_output_file('%d_pointless.xml' % self.get_xpid())
+      self.add_output_file('pointless.mtz')
+
       self.start()
 
       self.input('lauegroup hklin')
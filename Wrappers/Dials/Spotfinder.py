@@ -140,6 +140,17 @@ def run(self):
         self.add_command_line("hot_mask_prefix=%s" %self._hot_mask_prefix)
       if self._gain:
         self.add_command_line("gain=%f" % self._gain)
+
+      # declare what the run reads and writes, so that its results may be
+      # replayed from a run cache - unless it writes a hot mask too
+      if not self._write_hot_mask:
+        self.add_input_file(self._input_sweep_filename)
+        if self._phil_file is not None:
+          self.add_input_file(self._phil_file)
+        self.add_output_file(self._input_spot_filename)
+        if self._output_sweep_filename is not None:
+          self.add_output_file(self._output_sweep_filename)
+
       self.start()
       self.close_wait()
       self.check_for_errors()
@@ -14,6 +14,7 @@
 import shutil
 
 from xia2.Driver.DriverFactory import DriverFactory
+from xia2.Handlers.Artifacts import ArtifactStore
 from xia2.Handlers.Streams import Chatter, Debug
 # interfaces that this inherits from ...
 from xia2.Schema.Interfaces.FrameProcessor import FrameProcessor
@@ -149,7 +150,12 @@ def run(self):
         dst = os.path.join(
             self.get_working_directory(), file_name)
         if src != dst:
-          shutil.copyfile(src, dst)
+          ArtifactStore.place(src, dst)
+
+      # the outputs may be written over files placed by earlier runs
+      ArtifactStore.release(self.get_working_directory(),
+                            self._output_data_files_list,
+                            keep=self._input_data_files_list)
 
       self.start()
       self.close_wait()
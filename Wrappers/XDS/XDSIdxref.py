@@ -18,6 +18,7 @@
 from xia2.Experts.LatticeExpert import SortLattices, s2l
 # helpful expertise from elsewhere
 from xia2.Experts.SymmetryExpert import lattice_to_spacegroup_number
+from xia2.Handlers.Artifacts import ArtifactStore
 from xia2.Handlers.Phil import PhilIndex
 from xia2.Handlers.Streams import Debug
 # interfaces that this inherits from ...
@@ -354,7 +355,19 @@ def run(self, ignore_errors = False):
         dst = os.path.join(
             self.get_working_directory(), file_name)
         if src != dst:
-          shutil.copyfile(src, dst)
+          ArtifactStore.place(src, dst)
+
+      # the outputs may be written over files placed by earlier runs
+      ArtifactStore.release(self.get_working_directory(),
+                            self._output_data_files_list,
+                            keep=self._input_data_files_list)
+
+      # declare what the run reads and writes, so that its results may be
+      # replayed from a run cache
+      for file_name in ['XDS.INP'] + self._input_data_files_list:
+        self.add_input_file(file_name)
+      for file_name in self._output_data_files_list + ['IDXREF.LP']:
+        self.add_output_file(file_name)
 
       self.start()
       self.close_wait()
@@ -14,6 +14,7 @@
 import shutil
 
 from xia2.Driver.DriverFactory import DriverFactory
+from xia2.Handlers.Artifacts import ArtifactStore
 # interfaces that this inherits from ...
 from xia2.Schema.Interfaces.FrameProcessor import FrameProcessor
 # generic helper stuff
@@ -140,7 +141,19 @@ def run(self):
         dst = os.path.join(
             self.get_working_directory(), file_name)
         if src != dst:
-          shutil.copyfile(src, dst)
+          ArtifactStore.place(src, dst)
+
+      # the outputs may be written over files placed by earlier runs
+      ArtifactStore.release(self.get_working_directory(),
+                            self._output_data_files_list,
+                            keep=self._input_data_files_list)
+
+      # declare what the run reads and writes, so that its results may be
+      # replayed from a run cache
+      for file_name in ['XDS.INP'] + self._input_data_files_list:
+        self.add_input_file(file_name)
+      for file_name in self._output_data_files_list + ['INIT.LP']:
+        self.add_output_file(file_name)
 
       self.start()
       self.close_wait()
@@ -290,16 +290,15 @@ def parse(self):
         if 'Completeness vs. ' in key:
           comp_keys.append(key)
           comp_data[key.split()[-1]] = transpose_loggraph(
-              results[key])
+              results[key], numeric=True)
 
         elif 'R vs. ' in key:
           rd_keys.append(key)
           wavelength = key.split()[-1]
           rd_data[wavelength] = transpose_loggraph(
-              results[key])
+              results[key], numeric=True)
 
-          values = map(float, rd_data[wavelength]['2_Rd'])
-          digest = self.digest_rd(values)
+          digest = self.digest_rd(rd_data[wavelength]['2_Rd'])
 
           # stream.write('Rd score (%s): %.2f' % \
           # (wavelength, digest))
@@ -308,7 +307,7 @@ def parse(self):
             datasets_damaged.append((wavelength, digest))
 
         elif 'Normalised radiation' in key:
-          scp_data = transpose_loggraph(results[key])
+          scp_data = transpose_loggraph(results[key], numeric=True)
 
         elif 'Dose vs. BATCH' in key:
           self._dose_profile = transpose_loggraph(results[key])
@@ -337,7 +336,7 @@ def parse(self):
         local_50 = None
         local_90 = None
 
-        max_comp = max(map(float, completeness))
+        max_comp = max(completeness)
 
         for j, dose in enumerate(comp_data[dataset][dose_col]):
 
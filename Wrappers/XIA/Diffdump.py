@@ -57,30 +57,111 @@
 
 
 class _HeaderCache(object):
-  '''A cache for image headers.'''
+  '''A cache for image headers (and gains), each valid for as long as the
+  image keeps the same modification time and size. The cache may be kept
+  in a file shared between runs of xia2 and processes - see attach().
+
+  The values are shared, not copied: they must not be changed.'''
 
   def __init__(self):
     self._headers = { }
-
-  def put(self, image, header):
-    self._headers[image] = copy.deepcopy(header)
-
-  def get(self, image):
-    return self._headers[image]
-
-  def check(self, image):
-    return image in self._headers
+    self._filename = None
+    self._changed = False
+
+  @staticmethod
+  def _stat(image):
+    st = os.stat(image)
+    return (st.st_mtime, st.st_size)
+
+  @staticmethod
+  def _to_json(value):
+    '''Encode value for JSON, with each tuple tagged so that it can be told
+    from a list when read back.'''
+
+    if isinstance(value, dict):
+      return dict((k, _HeaderCache._to_json(v)) for k, v in value.items())
+    if isinstance(value, tuple):
+      return { '__tuple__': [_HeaderCache._to_json(v) for v in value] }
+    if isinstance(value, list):
+      return [_HeaderCache._to_json(v) for v in value]
+    return value
+
+  @staticmethod
+  def _from_json(value):
+    '''Restore a value read back from JSON as it was put: the tagged tuples
+    as tuples, and strings as str rather than unicode.'''
+
+    if isinstance(value, dict):
+      if list(value.keys()) == ['__tuple__']:
+        return tuple(_HeaderCache._from_json(v) for v in value['__tuple__'])
+      return dict((_HeaderCache._from_json(k), _HeaderCache._from_json(v))
+                  for k, v in value.items())
+    if isinstance(value, list):
+      return [_HeaderCache._from_json(v) for v in value]
+    if str is bytes and isinstance(value, unicode):
+      return value.encode('utf-8')
+    return value
+
+  def put(self, image, header, kind='header'):
+    stat = self._stat(image)
+    entry = self._headers.get(image)
+    if entry is None or entry['stat'] != stat:
+      entry = self._headers[image] = { 'stat': stat }
+    entry[kind] = header
+    self._changed = True
+
+  def get(self, image, kind='header'):
+    return self._headers[image][kind]
+
+  def check(self, image, kind='header'):
+    entry = self._headers.get(image)
+    if entry is None or not kind in entry:
+      return False
+    try:
+      return entry['stat'] == self._stat(image)
+    except OSError:
+      return False
 
   def write(self, filename):
     import json
-    json.dump(self._headers, open(filename, 'w'))
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'w') as fh:
+      json.dump(self._to_json(self._headers), fh)
+    os.rename(tmp, filename)
     return
 
   def read(self, filename):
-    assert(self._headers == { })
     import json
-    self._headers = json.load(open(filename, 'r'))
-    return len(self._headers)
+    try:
+      with open(filename, 'r') as fh:
+        headers = json.load(fh)
+    except (IOError, ValueError):
+      return 0
+    for image, entry in headers.items():
+      image = self._from_json(image)
+      if not image in self._headers:
+        self._headers[image] = self._from_json(entry)
+    return len(headers)
+
+  def attach(self, filename):
+    '''Keep the cache in filename: read it now, and write to it on save().'''
+
+    if filename != self._filename:
+      self._filename = filename
+      self.read(filename)
+
+  def get_filename(self):
+    return self._filename
+
+  def save(self):
+    '''Write any new entries to the attached file, merged with any written
+    there by other processes since it was read.'''
+
+    if self._filename is None or not self._changed:
+      return
+    self.read(self._filename)
+    self.write(self._filename)
+    self._changed = False
 
 HeaderCache = _HeaderCache()
 
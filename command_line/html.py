@@ -115,6 +115,7 @@ def generate_xia2_html(xinfo, filename='xia2.html', params=None, args=[]):
 
       json_data.update(report.multiplicity_vs_resolution_plot())
       json_data.update(report.multiplicity_histogram())
+      json_data.update(report.normal_probability_plot())
       json_data.update(report.completeness_plot())
       json_data.update(report.scale_rmerge_vs_batch_plot())
       json_data.update(report.cc_one_half_plot())
@@ -156,7 +157,8 @@ def generate_xia2_html(xinfo, filename='xia2.html', params=None, args=[]):
 
       misc_graphs = collections.OrderedDict(
         (k + '_' + wname, json_data[k]) for k in
-        ('cumulative_intensity_distribution', 'l_test', 'multiplicities') if k in json_data)
+        ('cumulative_intensity_distribution', 'l_test', 'multiplicities',
+         'normal_probability_plot') if k in json_data)
 
       for k, v in report.multiplicity_plots().iteritems():
         misc_graphs[k + '_' + wname] = {'img': v}
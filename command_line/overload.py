@@ -2,6 +2,8 @@
 
 import binascii
 import json
+import mmap
+import multiprocessing
 import sys
 import timeit
 
@@ -39,16 +41,14 @@ def open_file(filename, mode='rb'):
 
   return open(filename, mode)
 
-def read_cbf_image(cbf_image):
-  from cbflib_adaptbx import uncompress
+def read_cbf_header(data):
+  '''Find the binary data in the CBF image data (the file contents, or
+  a mmap of them), returning its offset, size and dimensions.'''
 
   start_tag = binascii.unhexlify('0c1a04d5')
 
-  with open_file(cbf_image, 'rb') as fh:
-    data = fh.read()
-
   data_offset = data.find(start_tag) + 4
-  cbf_header = data[:data_offset - 4]
+  cbf_header = data[:data_offset - 4].decode('latin-1')
 
   fast = 0
   slow = 0
@@ -66,92 +66,197 @@ def read_cbf_image(cbf_image):
 
   assert(length == fast * slow)
 
-  pixel_values = uncompress(packed = data[data_offset:data_offset + size],
-                            fast = fast, slow = slow)
+  return data_offset, size, fast, slow
+
+def cbf_image_chunks(cbf_image, chunk_size=1 << 20):
+  '''The pixel values of a CBF image, decoded chunk_size at a time, from a
+  mmap of the file unless it is compressed - so that the whole image is
+  never held in memory.'''
+
+  from xia2.Modules.UnpackByteOffset import iter_unpack_values
+
+  if is_bz2(cbf_image) or is_gzip(cbf_image):
+    with open_file(cbf_image, 'rb') as fh:
+      data = fh.read()
+    data_offset, size, fast, slow = read_cbf_header(data)
+    for values in iter_unpack_values(data, fast * slow, chunk_size,
+                                     offset=data_offset):
+      yield values
+    return
+
+  with open(cbf_image, 'rb') as fh:
+    data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      data_offset, size, fast, slow = read_cbf_header(data)
+      for values in iter_unpack_values(data, fast * slow, chunk_size,
+                                       offset=data_offset):
+        yield values
+    finally:
+      data.close()
+
+# the image sets read through the dxtbx in this process, by source
+_imagesets = { }
+
+def get_imageset(source):
+  '''The image set from source, which is ('json', datablock file) or
+  ('file', image file) - made only once in each process.'''
+
+  if not source in _imagesets:
+    from dxtbx.datablock import DataBlockFactory
+    kind, filename = source
+    if kind == 'json':
+      datablocks = DataBlockFactory.from_json_file(filename)
+    else:
+      datablocks = DataBlockFactory.from_filenames([filename])
+    _imagesets[source] = datablocks[0].extract_imagesets()[0]
+  return _imagesets[source]
+
+def hdf5_image_chunks(filename, index, chunk_size=1 << 20):
+  '''The pixel values of image index in the HDF5 / NeXus file filename,
+  read from the image data sets in /entry/data directly a block of rows at
+  a time. The blocks are whole chunks of the HDF5 data set, so nothing is
+  decompressed twice - when each image is stored as one chunk, that is the
+  whole image.'''
+
+  import h5py
+
+  with h5py.File(filename, 'r') as fh:
+    data = fh['/entry/data']
+    for name in sorted(data.keys()):
+      dataset = data[name]
+      if not isinstance(dataset, h5py.Dataset) or dataset.ndim != 3:
+        continue
+      if index >= dataset.shape[0]:
+        index -= dataset.shape[0]
+        continue
+      rows = max(1, chunk_size // dataset.shape[2])
+      if dataset.chunks is not None:
+        rows = max(dataset.chunks[1], rows // dataset.chunks[1] *
+                   dataset.chunks[1])
+      for j in range(0, dataset.shape[1], rows):
+        yield dataset[index, j:j + rows].ravel()
+      return
+
+  raise RuntimeError('no image %d in %s' % (index, filename))
+
+def image_chunks(image, chunk_size=1 << 20):
+  '''The pixel values of image - a CBF file name, or an image source and
+  index in the image set (for HDF5 / NeXus or anything else read by the
+  dxtbx) - chunk_size at a time as numpy arrays.'''
 
-  return pixel_values
+  if not isinstance(image, tuple):
+    for values in cbf_image_chunks(image, chunk_size):
+      yield values
+    return
+
+  source, index = image
+  imageset = get_imageset(source)
+  path = imageset.get_path(index)
+  if path.endswith(('.h5', '.nxs')):
+    for values in hdf5_image_chunks(path, imageset.indices()[index],
+                                    chunk_size):
+      yield values
+    return
+
+  # other formats can only be decoded whole by the dxtbx, but are not then
+  # copied whole again
+  for panel in imageset.get_raw_data(index):
+    values = panel.as_1d()
+    for j in range(0, values.size(), chunk_size):
+      yield values[j:j + chunk_size].as_numpy_array()
+
+def histogram_images(job):
+  '''The pixel_histogram of a list of images, up to max_value.'''
+
+  from xia2.Modules.PixelHistogram import pixel_histogram
+
+  images, max_value = job
+  hist = pixel_histogram(max_value)
+  for image in images:
+    for values in image_chunks(image):
+      hist.add(values)
+  return hist, len(images)
 
 def get_overload(cbf_file):
   with open_file(cbf_file, 'rb') as fh:
     for record in fh:
-      if 'Count_cutoff' in record:
+      if b'Count_cutoff' in record:
         return float(record.split()[-2])
 
 def build_hist(nproc=1):
-  from scitbx.array_family import flex
-  from libtbx import easy_mp
-  from collections import Counter
+  from xia2.Modules.PixelHistogram import pixel_histogram
 
   # FIXME use proper optionparser here. This works for now
   if len(sys.argv) >= 2 and sys.argv[1].startswith('nproc='):
     nproc=int(sys.argv[1][6:])
     sys.argv = sys.argv[1:]
+
+  # images in CBF files are decoded here, anything else is read through
+  # the dxtbx as (source, index)
+  source = None
   if len(sys.argv) == 2 and sys.argv[1].endswith('.json'):
-    from dxtbx import datablock
-    db = datablock.DataBlockFactory.from_json_file(sys.argv[1])[0]
-    image_list = db.extract_imagesets()[0].paths()
-  else:
+    source = ('json', sys.argv[1])
+  elif len(sys.argv) == 2 and sys.argv[1].endswith(('.h5', '.nxs')):
+    source = ('file', sys.argv[1])
+
+  if source is None:
     image_list = sys.argv[1:]
+  else:
+    imageset = get_imageset(source)
+    if all(path.endswith('.cbf') for path in imageset.paths()):
+      image_list = list(imageset.paths())
+    else:
+      image_list = [(source, j) for j in range(len(imageset))]
   image_count = len(image_list)
 
-  # Faster, yet still less than ideal and wasting a lot of resources.
-  limit = get_overload(image_list[0])
+  if isinstance(image_list[0], tuple):
+    limit = get_imageset(source).get_detector()[0].get_trusted_range()[1]
+  else:
+    limit = get_overload(image_list[0])
   binfactor = 5 # register up to 500% counts
-  histmax = (limit * binfactor) + 0.0
-  histbins = int(limit * binfactor) + 1
-  use_python_counter = histbins > 90000000 # empirically determined
+  max_value = int(limit * binfactor)
 
-  print("Processing %d images in %d processes using %s\n" % (image_count, nproc, \
-    "python Counter" if use_python_counter else "flex arrays"))
+  print("Processing %d images in %d processes\n" % (image_count, nproc))
 
-  def process_image(process):
-    last_update = start = timeit.default_timer()
+  # hand out small batches of images as processes become free, merging the
+  # histograms as they come back
+  batch = max(1, min(16, image_count // (nproc * 8)))
+  jobs = [(image_list[j:j + batch], max_value)
+          for j in range(0, image_count, batch)]
 
-    i = process
-    if use_python_counter:
-      local_hist = Counter()
-    else:
-      local_hist = flex.histogram(flex.double(), data_min=0.0, data_max=histmax, n_slots=histbins)
-
-    max_images = image_count // nproc
-    if process >= image_count % nproc:
-      max_images += 1
-    while i < image_count:
-      data = read_cbf_image(image_list[i])
-      if not use_python_counter:
-        data = flex.histogram(data.as_double().as_1d(), data_min=0.0, data_max=histmax, n_slots=histbins)
-      local_hist.update(data)
-      i = i + nproc
-      if process == 0:
-        if timeit.default_timer() > (last_update + 3):
-          last_update = timeit.default_timer()
-          if sys.stdout.isatty():
-            sys.stdout.write('\033[A')
-          print('Processed %d%% (%d seconds remain)    ' % (100 * i // image_count, round((image_count - i) * (last_update - start) / (i+1))))
-    return local_hist
-
-  results = easy_mp.parallel_map(
-    func=process_image,
-    iterable=range(nproc),
-    processes=nproc,
-    preserve_exception_message=True)
-
-  print("Merging results")
-  result_hist = None
-  for hist in results:
-    if result_hist is None:
-      result_hist = hist
-    else:
-      result_hist.update(hist)
+  if nproc > 1:
+    pool = multiprocessing.Pool(processes=nproc)
+    results = pool.imap_unordered(histogram_images, jobs)
+  else:
+    pool = None
+    results = (histogram_images(job) for job in jobs)
 
-  if not use_python_counter:
-    # reformat histogram into dictionary
-    result = list(result_hist.slots())
-    result_hist = { b: count for b, count in enumerate(result) if count > 0 }
+  result_hist = pixel_histogram(max_value)
+  processed = 0
+  last_update = start = timeit.default_timer()
+  try:
+    for hist, n in results:
+      result_hist.merge(hist)
+      processed += n
+      if timeit.default_timer() > (last_update + 3):
+        last_update = timeit.default_timer()
+        if sys.stdout.isatty():
+          sys.stdout.write('\033[A')
+        print('Processed %d%% (%d seconds remain)    ' % (
+          100 * processed // image_count,
+          round((image_count - processed) * (last_update - start) /
+                processed)))
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
 
+  edges, counts = result_hist.log_binned()
   results = { 'scale_factor': 1 / limit,
               'overload_limit': limit,
-              'counts': result_hist }
+              'counts': result_hist.counts(),
+              'log_binned': { 'edges': edges.tolist(),
+                              'counts': counts.tolist() } }
 
   print("Writing results to overload.json")
   with open('overload.json', 'w') as fh:
@@ -549,6 +549,48 @@ def multiplicity_histogram(self):
     }
 
 
+  def normal_probability_plot(self, n_points=500):
+    from xia2.Toolkit.NPP import unmerged_npp
+
+    if self.intensities.sigmas() is None:
+      return {}
+    npp = unmerged_npp(self.intensities)[0]
+    if not npp.groups.size:
+      return {}
+    expected, observed = npp.overall(n_points=n_points)
+    slope_all, slope_central = npp.mean_slopes()
+
+    return {
+      'normal_probability_plot': {
+        'data': [
+          {
+            'x': expected.tolist(),
+            'y': observed.tolist(),
+            'type': 'scatter',
+            'name': 'Observed',
+            'mode': 'markers',
+          },
+          {
+            'x': [expected[0], expected[-1]],
+            'y': [expected[0], expected[-1]],
+            'type': 'scatter',
+            'name': 'Expected',
+            'mode': 'lines',
+            'line': {
+              'color': 'rgb(31, 119, 180)',
+              'dash': 'dot',
+            },
+          },
+        ],
+        'layout': {
+          'title': 'Normal probability plot (mean slopes %.2f, %.2f within '
+                   '2 sigma)' % (slope_all, slope_central),
+          'xaxis': {'title': 'Expected deviation'},
+          'yaxis': {'title': 'Observed deviation'},
+        },
+      }
+    }
+
   def multiplicity_vs_resolution_plot(self):
 
     multiplicity_bins = [
@@ -882,6 +924,7 @@ def run(args):
 
   json_data.update(report.multiplicity_vs_resolution_plot())
   json_data.update(report.multiplicity_histogram())
+  json_data.update(report.normal_probability_plot())
   json_data.update(report.completeness_plot())
   json_data.update(report.scale_rmerge_vs_batch_plot())
   json_data.update(report.cc_one_half_plot())
@@ -910,7 +953,8 @@ def run(args):
 
   misc_graphs = OrderedDict(
     (k, json_data[k]) for k in
-    ('cumulative_intensity_distribution', 'l_test', 'multiplicities') if k in json_data)
+    ('cumulative_intensity_distribution', 'l_test', 'multiplicities',
+     'normal_probability_plot') if k in json_data)
 
   for k, v in report.multiplicity_plots().iteritems():
     misc_graphs[k] = {'img': v}
@@ -13,7 +13,8 @@
 # Needed to make xia2 imports work correctly
 import libtbx.load_env
 from dials.util.version import dials_version
-from xia2.Applications.xia2_helpers import process_one_sweep
+from xia2.Applications.xia2_helpers import (process_one_sweep,
+                                            schedule_sweeps, update_sweep)
 from xia2.Applications.xia2_main import (check_environment, get_command_line,
                                          help, write_citations)
 from xia2.Handlers.Citations import Citations
@@ -176,14 +177,24 @@ def xia2_main(stop_after=None):
       qsub_command = 'qsub'
     qsub_command = '%s -V -cwd -pe smp %d' %(qsub_command, nproc)
 
-    from libtbx import easy_mp
-    results = easy_mp.parallel_map(
-      process_one_sweep, args, processes=njob,
-      #method=method,
-      method="multiprocessing",
-      qsub_command=qsub_command,
-      preserve_order=True,
-      preserve_exception_message=True)
+    if mp_params.in_process:
+      if mp_params.ncores is not None and len(args) < njob:
+        # give the cores of the jobs which will not be run to the others
+        from xia2.Modules.TaskScheduler import split_core_budget
+        njob, nproc = split_core_budget(
+          mp_params.ncores, njob=njob, nsweeps=len(args))
+        PhilIndex.params.xia2.settings.multiprocessing.nproc = nproc
+      results = schedule_sweeps(crystals, args, njob)
+
+    else:
+      from libtbx import easy_mp
+      results = easy_mp.parallel_map(
+        process_one_sweep, args, processes=njob,
+        #method=method,
+        method="multiprocessing",
+        qsub_command=qsub_command,
+        preserve_order=True,
+        preserve_exception_message=True)
 
     # Hack to update sweep with the serialized indexers/refiners/integraters
     i_sweep = 0
@@ -193,20 +204,18 @@ def xia2_main(stop_after=None):
         remove_sweeps = []
         sweeps = wavelength.get_sweeps()
         for sweep in sweeps:
-          success, output, xsweep_dict = results[i_sweep]
+          success, output, xsweep_dict, duration = results[i_sweep]
           if output is not None:
             Chatter.write(output)
+          Chatter.write('Processing sweep %s took %s' % (sweep.get_name(),
+                        time.strftime("%Hh %Mm %Ss", time.gmtime(duration))))
           if not success:
             Chatter.write('Sweep failed: removing %s' %sweep.get_name())
             remove_sweeps.append(sweep)
           else:
             assert xsweep_dict is not None
             Chatter.write('Loading sweep: %s' % sweep.get_name())
-            from xia2.Schema.XSweep import XSweep
-            new_sweep = XSweep.from_dict(xsweep_dict)
-            sweep._indexer = new_sweep._indexer
-            sweep._refiner = new_sweep._refiner
-            sweep._integrater = new_sweep._integrater
+            update_sweep(sweep, xsweep_dict)
           i_sweep += 1
         for sweep in remove_sweeps:
           wavelength.remove_sweep(sweep)
@@ -335,6 +344,8 @@ def chdir_override(arg):
     Debug.write('\n------\nTiming summary:')
     import xia2.Driver.DefaultDriver
     xia2.Driver.DefaultDriver.output_timing_information()
+    from xia2.Handlers.Artifacts import ArtifactStore
+    Debug.write(ArtifactStore.summary())
     return xinfo
   except Sorry as s:
     Chatter.write('Error: %s' % str(s))
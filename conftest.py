@@ -36,3 +36,99 @@ def ccp4():
     return os.environ['CCP4']
   except KeyError:
     pytest.skip("CCP4 installation required for this test")
+
+def _random_unmerged(d_min=3, n_datasets=1, multiplicity=2,
+                     vary_multiplicity=False, completeness=1.0,
+                     batches_per_dataset=10, anomalous_flag=False,
+                     falloff=False, shuffle=False):
+  '''Random unmerged intensities in P 41 21 2, with their batches. Each
+  dataset observes a random part (completeness) of the reflections to d_min
+  multiplicity times - or from 1 to multiplicity times if vary_multiplicity
+  - with its own level of noise, in batches_per_dataset batches separated
+  from those of the next dataset by a gap in the batch numbers. The true
+  intensities are random, or fall off with resolution if falloff.'''
+
+  from cctbx import crystal, miller
+  from cctbx.array_family import flex
+
+  cs = crystal.symmetry(unit_cell=(57, 57, 150, 90, 90, 90),
+                        space_group_symbol='P 41 21 2')
+  ms = miller.build_set(cs, anomalous_flag=anomalous_flag, d_min=d_min)
+  flex.set_random_seed(0)
+  if falloff:
+    truth = 1000 * flex.exp(-20 * ms.d_star_sq().data())
+  else:
+    truth = flex.random_double(ms.size()) * 1000
+
+  indices = flex.miller_index()
+  data = flex.double()
+  batches = flex.int()
+  for i in range(n_datasets):
+    observed = flex.random_double(ms.size()) < completeness
+    if vary_multiplicity:
+      n_obs = (flex.random_size_t(ms.size()) % multiplicity).as_int() + 1
+    else:
+      n_obs = flex.int(ms.size(), multiplicity)
+    for j in range(multiplicity):
+      sel = observed & (n_obs > j)
+      indices.extend(ms.indices().select(sel))
+      data.extend(truth.select(sel) + (
+        flex.random_double(sel.count(True)) - 0.5) * 100 * (i + 1))
+      batches.extend((flex.random_size_t(sel.count(True)) %
+                      batches_per_dataset).as_int() +
+                     2 * batches_per_dataset * i + 1)
+
+  if shuffle:
+    perm = flex.random_permutation(indices.size())
+    indices = indices.select(perm)
+    data = data.select(perm)
+    batches = batches.select(perm)
+
+  sigmas = flex.sqrt(flex.abs(data)) + 1
+  intensities = miller.array(
+    miller.set(cs, indices, anomalous_flag=anomalous_flag),
+    data=data, sigmas=sigmas)
+  intensities.set_observation_type_xray_intensity()
+  return intensities, miller.array(intensities, data=batches)
+
+@pytest.fixture
+def random_unmerged():
+  '''A function returning random unmerged intensities and their batches,
+  as miller arrays: see _random_unmerged for the options.'''
+  return _random_unmerged
+
+def _write_unmerged_mtz(filename, intensities, batches, m_isym=None):
+  '''Write unmerged intensities to an MTZ file as a scaled unmerged file:
+  H, K, L in the asymmetric unit with M_ISYM recording the symmetry operator
+  to the original indices - unless the M_ISYM values are given - then BATCH,
+  I and SIGI.'''
+
+  from cctbx.array_family import flex
+  from iotbx import mtz
+
+  m = mtz.object()
+  m.set_space_group_info(intensities.space_group_info())
+  dataset = m.add_crystal(
+    'XTAL', 'XIA2', intensities.unit_cell().parameters()).add_dataset(
+      'DATA', 1)
+  m.adjust_column_array_sizes(intensities.size())
+  m.set_n_reflections(intensities.size())
+  for label, column_type in (('H', 'H'), ('K', 'H'), ('L', 'H'),
+                             ('M_ISYM', 'Y')):
+    dataset.add_column(label, column_type).set_values(
+      flex.float(intensities.size()))
+  m.replace_original_index_miller_indices(intensities.indices())
+  if m_isym is not None:
+    m.get_column('M_ISYM').set_values(flex.double(m_isym).as_float())
+  for label, column_type, values in (
+      ('BATCH', 'B', batches.data().as_double()),
+      ('I', 'J', intensities.data()),
+      ('SIGI', 'Q', intensities.sigmas())):
+    dataset.add_column(label, column_type).set_values(values.as_float())
+  m.write(filename)
+
+@pytest.fixture
+def write_unmerged_mtz():
+  '''A function writing unmerged intensities to an MTZ file: see
+  _write_unmerged_mtz.'''
+  return _write_unmerged_mtz
@@ -16,6 +16,8 @@
 import os
 from multiprocessing import Lock, Value
 
+import numpy as np
+
 from xia2.Handlers.Streams import Chatter, Debug
 
 def is_mtz_file(filename):
@@ -149,9 +151,16 @@ def unique_elements(list_of_tuples):
   '''Extract unique elements from list of tuples, return as sorted list.'''
   return sorted(set(sum(map(list, list_of_tuples), [])))
 
-def transpose_loggraph(loggraph_dict):
+def transpose_loggraph(loggraph_dict, numeric=False):
   '''Transpose the information in the CCP4-parsed-loggraph dictionary
-  into a more useful structure.'''
+  into a more useful structure - with the values converted to numbers
+  where possible if numeric.'''
+
+  if hasattr(loggraph_dict, 'transposed'):
+    # as parsed by lib.loggraph, which keeps the transposed table
+    if numeric:
+      return loggraph_dict.numeric()
+    return loggraph_dict.transposed()
 
   columns = loggraph_dict['columns']
   data = loggraph_dict['data']
@@ -176,6 +185,10 @@ def transpose_loggraph(loggraph_dict):
     for j in range(nc):
       results[new_columns[j]].append(record[j])
 
+  if numeric:
+    from xia2.lib.loggraph import numeric_columns
+    return numeric_columns(results)
+
   return results
 
 def message_Darwin(text):
@@ -247,5 +260,32 @@ def nint(a):
 
   return i
 
+def miller_indices_as_numpy(indices):
+  '''Convert a flex.miller_index to an (n, 3) numpy int64 array.'''
+
+  return indices.as_vec3_double().as_double().as_numpy_array().reshape(
+    -1, 3).round().astype(np.int64)
+
+def hkl_keys(hkl):
+  '''Encode the rows of an (n, 3) array of Miller indices as int64 keys
+  which sort in the same order as the indices themselves.'''
+
+  offset = 2**20
+  return (((hkl[:, 0] + offset) << 42) + ((hkl[:, 1] + offset) << 21)
+          + (hkl[:, 2] + offset))
+
+def group_by_key(keys):
+  '''Group equal keys together. Returns the (stable) permutation sorting
+  the keys, the distinct keys in order, the group index of every sorted
+  element and the offsets of the groups, the last of which is len(keys).'''
+
+  perm = np.argsort(keys, kind='mergesort')
+  sorted_keys = keys[perm]
+  first = np.ones(sorted_keys.size, dtype=bool)
+  first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+  group = np.cumsum(first) - 1
+  offsets = np.append(np.flatnonzero(first), sorted_keys.size)
+  return perm, sorted_keys[first], group, offsets
+
 if __name__ == '__main__':
   message("This is a test")
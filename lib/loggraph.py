@@ -0,0 +1,155 @@
+from __future__ import absolute_import, division, print_function
+
+class loggraph_table(dict):
+  '''A CCP4 loggraph table, as a dictionary of 'columns' (the column
+  labels) and 'data' (the records with one token per column), which also
+  provides the column-wise view of the data made by transpose_loggraph,
+  computed only once - each call returns a copy of this, which the caller
+  is free to change.'''
+
+  def __init__(self):
+    super(loggraph_table, self).__init__(columns=[], data=[])
+    self._transposed = None
+    self._numeric = None
+
+  def transposed(self):
+    '''The data by column, keyed by column number (counting from 1) and
+    label, e.g. '1_N' - column labels are not always unique.'''
+
+    if self._transposed is None:
+      new_columns = ['%d_%s' % (j + 1, c)
+                     for j, c in enumerate(self['columns'])]
+      self._transposed = dict((c, []) for c in new_columns)
+      for record in self['data']:
+        for c, value in zip(new_columns, record):
+          self._transposed[c].append(value)
+    return _copy_columns(self._transposed)
+
+  def numeric(self):
+    '''The column-wise view of the data with the values converted to
+    numbers - see numeric_columns.'''
+
+    if self._numeric is None:
+      self._numeric = numeric_columns(self.transposed())
+    return _copy_columns(self._numeric)
+
+def _copy_columns(columns):
+  return dict((c, list(values)) for c, values in columns.items())
+
+def numeric_columns(transposed):
+  '''Convert the columns of a transposed loggraph table to int where
+  every value in the column is an integer, else to float where every
+  value is a number; any other column (e.g. of dataset names) is left
+  as strings.'''
+
+  result = { }
+  for column, values in transposed.items():
+    for kind in (int, float):
+      try:
+        result[column] = [kind(value) for value in values]
+        break
+      except ValueError:
+        pass
+    else:
+      result[column] = list(values)
+  return result
+
+class loggraph_parser(object):
+  '''Incrementally parse program output for CCP4 loggraph tables, one
+  record at a time as it is produced, so that the output need not be
+  scanned again afterwards. Also notes any CCP4 library error signals.
+
+  As feed() is called while the program runs, a table which can not be
+  parsed does not raise an error there: the error is kept, parsing of
+  tables stops and the error is raised by finish().'''
+
+  def __init__(self):
+    self.loggraph = { }
+    self.n_records = 0
+
+    # lines reporting errors, for CCP4Decorator.check_ccp4_errors
+    self.library_signals = []
+    self.system_signals = []
+
+    # tables still being read: [title, table, number of $$, records]
+    self._open = []
+
+    # the first error found parsing the tables
+    self.error = None
+
+  def feed(self, record):
+    self.n_records += 1
+
+    if 'CCP4 library signal' in record:
+      self.library_signals.append(record)
+    if '>>>>>> System signal' in record:
+      self.system_signals.append(record)
+
+    if self.error is not None:
+      return
+
+    try:
+      self._feed_tables(record)
+    except RuntimeError as e:
+      self.error = e
+    except Exception as e:
+      self.error = RuntimeError(
+        'loggraph output could not be parsed at "%s": %s' %
+        (record.strip(), str(e)))
+
+  def _feed_tables(self, record):
+    # as in the original implementation each table runs from its $TABLE
+    # line to the line which brings the count of $$ to at least four -
+    # the $TABLE line itself being counted twice - and a $TABLE line
+    # inside another table starts a new one
+
+    if '$TABLE' in record:
+      title = record.split(':')[1].replace('>', '').strip()
+      table = loggraph_table()
+      self.loggraph[title] = table
+      self._open.append([title, table, record.count('$$'), []])
+
+    still_open = []
+    for table in self._open:
+      table[2] += record.count('$$')
+      table[3].append(record)
+      if table[2] >= 4:
+        self._close(*table)
+      else:
+        still_open.append(table)
+    self._open = still_open
+
+  def _close(self, title, table, n_dollar, records):
+    tokens = ''.join(records).split('$$')
+
+    if len(tokens) < 4:
+      raise RuntimeError('loggraph "%s" broken' % title)
+
+    table['columns'] = tokens[1].split()
+    columns = len(table['columns'])
+
+    # code around cases where columns merge together...
+
+    for line in tokens[3].split('\n'):
+      record = line.split()
+      if len(record) == columns:
+        table['data'].append(record)
+
+  def finish(self):
+    '''Return the loggraph tables found, raising any error found while
+    parsing them, and checking that none is left incomplete at the end
+    of the output.'''
+
+    if self.error is not None:
+      raise self.error
+    if self._open:
+      raise RuntimeError('loggraph "%s" broken' % self._open[0][0])
+    return self.loggraph
+
+def parse_loggraph(records):
+  '''Parse all of the loggraph tables from a list of records.'''
+
+  parser = loggraph_parser()
+  for record in records:
+    parser.feed(record)
+  return parser.finish()
@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+aimless_output = '''\
+ Some preamble
+ $TABLE:  Analysis against Batch:
+ $GRAPHS: Rmerge v Batch:N:1,5: $$
+  N  Batch    Mn(I)   Rmerge $$
+ $$
+  1     1   1234.5   0.031
+  2     2   1200.1   0.035
+  3     3     1.0e+03
+ $$
+ $TABLE:  Completeness vs resolution:
+ $GRAPHS: Completeness:A:1,2:
+ $$
+  N  1/d^2  Dmid  %poss $$ $$
+  1  0.01  10.0  99.8
+  2  0.02   7.1  99.9
+ $$
+ CCP4 library signal ccp4_map:Write failed (Error)
+ >>>>>> System signal 28:No space left on device (Error)
+'''
+
+def test_loggraph_parser():
+  from xia2.lib.bits import transpose_loggraph
+  from xia2.lib.loggraph import loggraph_parser
+  records = aimless_output.splitlines(True) + ['']
+  parser = loggraph_parser()
+  for record in records:
+    parser.feed(record)
+  loggraph = parser.finish()
+  # the row with too few values is left out
+  assert loggraph == {
+    'Analysis against Batch': {
+      'columns': ['N', 'Batch', 'Mn(I)', 'Rmerge'],
+      'data': [['1', '1', '1234.5', '0.031'],
+               ['2', '2', '1200.1', '0.035']]},
+    'Completeness vs resolution': {
+      'columns': ['N', '1/d^2', 'Dmid', '%poss'],
+      'data': [['1', '0.01', '10.0', '99.8'], ['2', '0.02', '7.1', '99.9']]}}
+  assert transpose_loggraph(loggraph['Completeness vs resolution']) == {
+    '1_N': ['1', '2'], '2_1/d^2': ['0.01', '0.02'],
+    '3_Dmid': ['10.0', '7.1'], '4_%poss': ['99.8', '99.9']}
+  assert len(parser.library_signals) == 1
+  assert len(parser.system_signals) == 1
+
+def test_loggraph_parser_broken_table():
+  from xia2.lib.loggraph import parse_loggraph
+  with pytest.raises(RuntimeError):
+    parse_loggraph(aimless_output.splitlines(True)[:8])
+
+def test_loggraph_parser_error_is_raised_by_finish():
+  from xia2.lib.loggraph import loggraph_parser
+  parser = loggraph_parser()
+  records = aimless_output.splitlines(True)
+  # a $TABLE line with no title is an error, but not while feeding
+  for record in [' $TABLE without a title\n'] + records:
+    parser.feed(record)
+  assert len(parser.library_signals) == 1
+  with pytest.raises(RuntimeError) as e:
+    parser.finish()
+  assert '$TABLE without a title' in str(e.value)
+
+def test_numeric_loggraph():
+  from xia2.lib.bits import transpose_loggraph
+  from xia2.lib.loggraph import parse_loggraph
+  table = parse_loggraph(aimless_output.splitlines(True))[
+    'Completeness vs resolution']
+  numeric = transpose_loggraph(table, numeric=True)
+  assert numeric == {
+    '1_N': [1, 2], '2_1/d^2': [0.01, 0.02],
+    '3_Dmid': [10.0, 7.1], '4_%poss': [99.8, 99.9]}
+  assert isinstance(numeric['1_N'][0], int)
+  # each is a copy, which may be changed without changing the table
+  numeric['1_N'].append(3)
+  del numeric['3_Dmid']
+  assert transpose_loggraph(table, numeric=True) == {
+    '1_N': [1, 2], '2_1/d^2': [0.01, 0.02],
+    '3_Dmid': [10.0, 7.1], '4_%poss': [99.8, 99.9]}
+  transposed = transpose_loggraph(table)
+  transposed['1_N'].append('3')
+  assert transpose_loggraph(table)['1_N'] == ['1', '2']
+
+  # the same from a table parsed elsewhere, keeping columns of text
+  assert transpose_loggraph(
+    {'columns': ['BATCH', 'DOSE', 'DATASET'],
+     'data': [['1', '0.5', 'NATIVE'], ['2', '1e1', 'NATIVE']]},
+    numeric=True) == {
+      '1_BATCH': [1, 2], '2_DOSE': [0.5, 10.0],
+      '3_DATASET': ['NATIVE', 'NATIVE']}